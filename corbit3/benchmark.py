@@ -0,0 +1,656 @@
+#! /usr/bin/env python3
+"""Benchmarks for the simulation core. Run from this directory, like server.py:
+
+    python3 benchmark.py gravity
+
+Use --help on any of the benchmarks for its options.
+"""
+import argparse
+import gc
+import math
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+from unum.units import s, m, kg, N, rad
+
+import corbit.mysqlio
+import corbit.gravity
+import corbit.barneshut
+import corbit.integrators
+import corbit.hierarchy
+import corbit.objects
+import corbit.store
+import corbit.physics
+import corbit.collision
+import corbit.encounters
+import corbit.snapshot
+from corbit import units
+
+
+def load_arrays(filename):
+    """Loads a scenario and returns it as arrays
+    :return: (entities, NBody with the entities gathered into it)
+    """
+    with open(filename, "r") as loadfile:
+        entities = corbit.mysqlio.load_json(loadfile)
+    nbody = corbit.gravity.NBody()
+    nbody.gather(entities)
+    return entities, nbody
+
+
+def add_belt(positions, velocities, masses, count, inner, outer, seed=0):
+    """Adds a belt of asteroids on circular orbits around the most massive body
+    :param count: how many asteroids to add
+    :param inner: inner radius of the belt, in m
+    :param outer: outer radius of the belt, in m
+    :return: (positions, velocities, masses) with the asteroids appended
+    """
+    random = numpy.random.RandomState(seed)
+    star = numpy.argmax(masses)
+    radius = random.uniform(inner, outer, count)
+    theta = random.uniform(0, 2 * math.pi, count)
+    speed = numpy.sqrt(corbit.gravity.G * masses[star] / radius)
+    belt_positions = positions[star] + numpy.column_stack((radius * numpy.cos(theta), radius * numpy.sin(theta)))
+    belt_velocities = velocities[star] + numpy.column_stack((-speed * numpy.sin(theta), speed * numpy.cos(theta)))
+    belt_masses = 10 ** random.uniform(12, 19, count)  # 1e12 to 1e19 kg, comets up to big asteroids
+    return (numpy.concatenate((positions, belt_positions)),
+            numpy.concatenate((velocities, belt_velocities)),
+            numpy.concatenate((masses, belt_masses)))
+
+
+def timed(function, *args, **kwargs):
+    """Calls function, returns (its result, the best wall-clock time of a few runs, in s)"""
+    best = float("inf")
+    for attempt in range(3):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+        if best > 1:
+            break  # slow enough that noise doesn't matter
+    return result, best
+
+
+def bench_gravity(args):
+    """Direct summation vs Barnes-Hut, on the scenario plus a main belt of asteroids"""
+    entities, nbody = load_arrays(args.scenario)
+    print("%8s %12s %12s %8s %12s %12s" % ("N", "direct (s)", "tree (s)", "speedup", "median err", "max err"))
+    for count in args.sizes:
+        positions, velocities, masses = add_belt(nbody.positions, nbody.velocities, nbody.masses,
+                                                 count - len(nbody), 3.1e11, 4.9e11)
+        _, direct_time = timed(corbit.gravity.direct_accelerations, positions, positions, masses)
+        _, tree_time = timed(corbit.barneshut.accelerations, positions, positions, masses, args.opening_angle)
+        error = corbit.barneshut.error_report(positions, masses, args.opening_angle)
+        print("%8d %12.4f %12.4f %8.2f %12.2e %12.2e" % (len(masses), direct_time, tree_time,
+                                                       direct_time / tree_time, error["median"], error["max"]))
+
+
+def bench_test_particles(args):
+    """Full N-body vs the restricted problem, with thousands of test particles added to the scenario"""
+    entities, nbody = load_arrays(args.scenario)
+    tick = 1 / 30  # the server runs at 30 Hz
+    print("%8s %8s %12s %15s %12s" % ("massive", "test", "full (s)", "restricted (s)", "% of a tick"))
+    for count in args.sizes:
+        # debris strewn around the inner solar system
+        positions, velocities, masses = add_belt(nbody.positions, nbody.velocities, nbody.masses,
+                                                 count, 1.0e11, 2.5e11)
+        massive = numpy.concatenate((nbody.massive, numpy.zeros(count, dtype=bool)))
+        _, full_time = timed(corbit.gravity.direct_accelerations, positions, positions, masses)
+        _, restricted_time = timed(corbit.gravity.direct_accelerations, positions, positions[massive], masses[massive])
+        print("%8d %8d %12.4f %15.4f %12.1f" % (massive.sum(), len(masses) - massive.sum(), full_time,
+                                               restricted_time, 100 * restricted_time / tick))
+
+
+def semi_major_axes(nbody, satellites, primaries):
+    """Semi-major axis of each satellite's orbit around its primary, in m. Negative once it's escaped"""
+    r = nbody.positions[satellites] - nbody.positions[primaries]
+    v = nbody.velocities[satellites] - nbody.velocities[primaries]
+    mu = corbit.gravity.G * (nbody.masses[satellites] + nbody.masses[primaries])
+    energy = (v ** 2).sum(axis=1) / 2 - mu / numpy.sqrt((r ** 2).sum(axis=1))
+    return -mu / (2 * energy)
+
+
+def bench_integrators(args):
+    """Energy drift of every integrator on the scenario, against the wall-clock time it takes.
+    max |da/a| is the worst change in the size of any orbit, which is how far the moons drift off.
+    substeps is the average number of internal steps per step, for the adaptive integrators, and
+    evals is how many times per step the force on a single body was worked out"""
+    span = args.days * 24 * 3600
+    print("%14s %10s %8s %9s %9s %10s %12s %16s %12s" % ("integrator", "dt (s)", "steps", "substeps", "evals",
+                                                         "wall (s)", "max |dE/E|", "|dE/E| per wall s",
+                                                         "max |da/a|"))
+    for dt in args.dt:
+        for name in sorted(corbit.integrators.integrators):
+            entities, nbody = load_arrays(args.scenario)
+            nbody.external[:] = 0  # the accelerations saved in the file are last tick's gravity, not thrust
+            integrator = corbit.integrators.create(name)
+            initial_energy = nbody.energy()
+            parent = corbit.hierarchy.primaries(nbody.positions, nbody.masses, nbody.massive)
+            satellites = numpy.flatnonzero(parent >= 0)
+            initial_axes = semi_major_axes(nbody, satellites, parent[satellites])
+            worst = 0
+            worst_orbit = 0
+            steps = int(span / dt)
+            substeps = 0
+            wall = 0
+            nbody.evaluations = 0
+            for step in range(steps):
+                start = time.perf_counter()
+                integrator.step(nbody, dt)
+                nbody.advance_clock(dt)
+                wall += time.perf_counter() - start
+                substeps += integrator.substeps if integrator.adaptive else 1
+                if step % 10 == 0 or step == steps - 1:
+                    worst = max(worst, abs((nbody.energy() - initial_energy) / initial_energy))
+                    axes = semi_major_axes(nbody, satellites, parent[satellites])
+                    worst_orbit = max(worst_orbit, numpy.abs(axes / initial_axes - 1).max())
+            print("%14s %10.1f %8d %9.1f %9.1f %10.3f %12.3e %16.3e %12.3e" % (
+                name, dt, steps, substeps / steps, nbody.evaluations / steps, wall, worst, worst / wall, worst_orbit))
+
+
+def bench_collisions(args):
+    """Collision detection with the sweep and prune broad phase vs the narrow phase on every pair,
+    on the scenario plus a main belt of asteroids, for one tick at 100000x"""
+    entities, nbody = load_arrays(args.scenario)
+    dt = 100000 / 30
+    print("%8s %12s %12s %12s %14s %14s" % ("N", "pairs", "candidates", "broad (s)", "broad+narrow (s)",
+                                           "all pairs (s)"))
+    for count in args.sizes:
+        positions, velocities, masses = add_belt(nbody.positions, nbody.velocities, nbody.masses,
+                                                 count - len(nbody), 3.1e11, 4.9e11)
+        radii = numpy.concatenate((nbody.radii, 10 ** numpy.random.RandomState(1).uniform(3, 5.5, count - len(nbody))))
+        asteroids = corbit.store.EntityStore(count)
+        belt = entities + [corbit.objects.Entity("asteroid " + str(i), float(masses[i]), float(radii[i]),
+                                                 (128, 128, 128), positions[i].tolist(), velocities[i].tolist(),
+                                                 [0.0, 0.0], 0.0, 0.0, 0.0, test_particle=True, store=asteroids)
+                           for i in range(len(entities), len(masses))]
+        tick = units.internal(dt, s)
+
+        (first, second), broad_time = timed(corbit.collision.candidate_pairs, positions, velocities, radii, dt)
+        candidates = len(first)
+        _, narrow_time = timed(corbit.physics.resolve_collisions, belt, positions, velocities, masses, radii,
+                               first, second, tick)
+        if len(masses) <= args.all_pairs_limit:
+            first, second = numpy.triu_indices(len(masses), 1)
+            _, all_pairs_time = timed(corbit.physics.resolve_collisions, belt, positions, velocities, masses, radii,
+                                      first, second, tick)
+            all_pairs = "%14.4f" % all_pairs_time
+        else:
+            all_pairs = "%14s" % "-"
+        print("%8d %12d %12d %12.4f %14.4f %s" % (len(masses), len(masses) * (len(masses) - 1) // 2, candidates,
+                                                 broad_time, broad_time + narrow_time, all_pairs))
+
+
+def belt_nbody(nbody, count, seed=0):
+    """:return: a new NBody with the bodies of nbody plus a main belt of count asteroids, which are
+    test particles with radii from 1 to 300 km"""
+    positions, velocities, masses = add_belt(nbody.positions, nbody.velocities, nbody.masses,
+                                             count, 3.1e11, 4.9e11, seed)
+    belt = corbit.gravity.NBody()
+    belt.resize(len(masses))
+    belt.positions[:] = positions
+    belt.velocities[:] = velocities
+    belt.masses[:] = masses
+    belt.radii[:] = numpy.concatenate((nbody.radii, 10 ** numpy.random.RandomState(seed + 1).uniform(3, 5.5, count)))
+    belt.massive[:len(nbody)] = nbody.massive
+    return belt
+
+
+def simulate(nbody, ticks, dt):
+    """Steps nbody with leapfrog
+    :return: list of (positions, velocities) at the start of every tick"""
+    integrator = corbit.integrators.create("leapfrog")
+    history = []
+    for tick in range(ticks):
+        history.append((nbody.positions.copy(), nbody.velocities.copy()))
+        integrator.step(nbody, dt)
+    return history
+
+
+def bench_hierarchy(args):
+    """Working out every body's primary from scratch every tick vs keeping it up to date with
+    corbit.hierarchy.Hierarchy, on the scenario plus a main belt of asteroids"""
+    entities, nbody = load_arrays(args.scenario)
+    print("%8s %8s %14s %18s %16s %10s %9s" % ("N", "ticks", "scratch (ms)", "incremental (ms)",
+                                                "evals per tick", "rebuilds", "speedup"))
+    for count in args.sizes:
+        belt = belt_nbody(nbody, count)
+        history = simulate(belt, args.ticks, args.dt)
+        start = time.perf_counter()
+        for positions, velocities in history:
+            from_scratch = corbit.hierarchy.primaries(positions, belt.masses, belt.massive)
+        scratch_time = (time.perf_counter() - start) / args.ticks
+        hierarchy = corbit.hierarchy.Hierarchy()
+        start = time.perf_counter()
+        for positions, velocities in history:
+            incremental = hierarchy.update(positions, belt.masses, belt.massive)
+        incremental_time = (time.perf_counter() - start) / args.ticks
+        assert numpy.array_equal(from_scratch, incremental)
+        print("%8d %8d %14.3f %18.3f %16.1f %10d %9.2f" % (len(belt), args.ticks, 1000 * scratch_time,
+                                                          1000 * incremental_time, hierarchy.evaluations / args.ticks,
+                                                          hierarchy.rebuilds, scratch_time / incremental_time))
+
+
+def bench_neighbors(args):
+    """Sweep and prune every tick vs a Verlet neighbor list, over a stretch of ticks of the scenario
+    plus a main belt of asteroids, for a few skin sizes"""
+    entities, nbody = load_arrays(args.scenario)
+    belt = belt_nbody(nbody, args.count)
+    radii = belt.radii
+    masses = belt.masses
+    history = simulate(belt, args.ticks, args.dt)
+
+    start = time.perf_counter()
+    candidates = 0
+    for positions, velocities in history:
+        candidates += len(corbit.collision.candidate_pairs(positions, velocities, radii, args.dt)[0])
+    sweep_time = (time.perf_counter() - start) / args.ticks
+    print("%d bodies, %d ticks of %.1f s, %.1f candidates per tick, sweep and prune every tick %.3f ms per tick" % (
+        len(masses), args.ticks, args.dt, candidates / args.ticks, 1000 * sweep_time))
+    print("%10s %10s %16s %12s %14s %10s" % ("skin ticks", "rebuilds", "ticks per rebuild", "list pairs",
+                                             "ms per tick", "speedup"))
+    for skin_ticks in args.skin_ticks:
+        neighbors = corbit.collision.NeighborList(skin_ticks)
+        start = time.perf_counter()
+        for positions, velocities in history:
+            neighbors.update(positions, velocities, radii, args.dt)
+        list_time = (time.perf_counter() - start) / args.ticks
+        statistics = neighbors.statistics()
+        print("%10d %10d %16.1f %12d %14.3f %10.2f" % (skin_ticks, statistics["rebuilds"],
+                                                       statistics["ticks per rebuild"], statistics["pairs"],
+                                                       1000 * list_time, sweep_time / list_time))
+
+
+def bench_encounters(args):
+    """The habitat on a flyby of the Moon, integrated with and without corbit.encounters solving
+    the close approach, against an adaptive dopri5 run with short ticks. error is how far the
+    habitat ends up from where the reference run has it"""
+    entities, nbody = load_arrays(args.scenario)
+    names = [entity.name for entity in entities]
+    habitat, moon = names.index("Habitat"), names.index("Moon")
+    # head for the Moon's trailing side at 2 km/s, aiming to miss it by args.miss
+    nbody.positions[habitat] = nbody.positions[moon] + [-2000 * args.hours * 3600 / 2, -args.miss]
+    nbody.velocities[habitat] = nbody.velocities[moon] + [2000, 0]
+    nbody.external[:] = 0  # the accelerations saved in the file are last tick's gravity, not thrust
+    span = args.hours * 3600
+    start_positions, start_velocities = nbody.positions.copy(), nbody.velocities.copy()
+
+    def run(integrator, steps):
+        nbody.positions[:], nbody.velocities[:], nbody.time = start_positions, start_velocities, 0.0
+        dt = span / steps
+        closest = numpy.inf
+        start = time.perf_counter()
+        for step in range(steps):
+            integrator.step(nbody, dt)
+            nbody.advance_clock(dt)
+            closest = min(closest, numpy.linalg.norm(nbody.positions[habitat] - nbody.positions[moon]))
+        return nbody.positions[habitat].copy(), closest, time.perf_counter() - start
+
+    reference, closest, wall = run(corbit.integrators.create("dopri5"), int(round(span / 60)))
+    print("reference: dopri5, 60 s ticks, %.1f s. Closest approach %.0f km, %.0f km above the Moon" % (
+        wall, closest / 1000, (closest - nbody.radii[moon]) / 1000))
+    print("%10s %10s %12s %14s %10s %12s" % ("integrator", "dt (s)", "encounters", "error (m)", "wall (s)",
+                                             "steps"))
+    for dt in args.dt:
+        for name in args.integrators:
+            for regularized in (False, True):
+                integrator = corbit.integrators.create(name)
+                if regularized:
+                    integrator = corbit.encounters.Regularized(integrator)
+                steps = max(int(round(span / dt)), 1)
+                position, closest, wall = run(integrator, steps)
+                print("%10s %10.1f %12s %14.3e %10.3f %12d" % (
+                    name, span / steps, integrator.encounters if regularized else "off",
+                    numpy.linalg.norm(position - reference), wall, steps))
+
+
+def bench_burns(args):
+    """The habitat burning its main engine for hours, starting from a circular orbit around Earth
+    pointing prograde, at a few time accelerations. "finite" is
+    corbit.burns, with the burn integrated as part of the equations of motion. "per tick" is how it
+    used to be: the thrust at the start of each tick held for the whole tick, and the fuel for the
+    tick taken out in one go. error is how far the habitat ends up from a dopri5 run with 1 s ticks"""
+    span = args.hours * 3600
+
+    def run(dt, integrator_name, finite):
+        entities = corbit.mysqlio.load_json(open(args.scenario, "r"))
+        for entity in entities:
+            entity.acceleration = units.internal(numpy.zeros(2), m / s / s)
+        habitat = corbit.objects.find_entity("Habitat", entities)
+        earth = corbit.objects.find_entity("Earth", entities)
+        earth_position = units.number(earth.displacement, m)
+        earth_velocity = units.number(earth.velocity, m / s)
+        speed = math.sqrt(corbit.gravity.G * units.number(earth.mass(), kg) / args.radius)
+        habitat.displacement = units.internal(earth_position + [args.radius, 0], m)
+        habitat.velocity = units.internal(earth_velocity + [0, speed], m / s)
+        habitat.angular_position = units.internal(math.pi / 2, rad)
+        habitat.angular_speed = units.internal(0.0, rad / s)
+        engines = habitat.engine_system
+        engines.fuel = units.internal(args.fuel, kg)
+        engines.throttle = 1 if finite else 0
+        nbody = corbit.gravity.NBody()
+        integrator = corbit.integrators.create(integrator_name)
+        scheduler = corbit.collision.Scheduler()
+        names = [entity.name for entity in entities]
+        ticks = int(round(span / dt))
+        dt = span / ticks
+        start = time.perf_counter()
+        for tick in range(ticks):
+            if not finite:
+                engines.throttle = 1
+                thrust = units.number(engines.thrust(units.internal(dt, s)), N) * len(engines.engine_placements)
+                heading = units.number(habitat.angular_position, rad)
+                habitat.acceleration = units.internal(
+                    thrust / units.number(habitat.mass(), kg) * numpy.array([math.cos(heading), math.sin(heading)]),
+                    m / s / s)
+                engines.throttle = 0
+            nbody.gather(entities)
+            scheduler.advance(nbody, integrator, dt, names)
+            nbody.scatter(entities)
+        return units.number(habitat.displacement, m), time.perf_counter() - start, ticks
+
+    reference, wall, ticks = run(1.0, "dopri5", True)
+    print("%g kg of fuel burnt over %g h. Reference: dopri5, %d ticks of 1 s, %.1f s" % (
+        args.fuel, args.hours, ticks, wall))
+    print("%10s %10s %10s %8s %14s %10s" % ("integrator", "dt (s)", "burn", "ticks", "error (m)", "wall (s)"))
+    for dt in args.dt:
+        for name in args.integrators:
+            for finite in (False, True):
+                position, wall, ticks = run(dt, name, finite)
+                print("%10s %10.1f %10s %8d %14.3e %10.3f" % (name, span / ticks, "finite" if finite else "per tick",
+                                                             ticks, numpy.linalg.norm(position - reference), wall))
+
+
+def bench_landed(args):
+    """The habitat landed on a planet, at rest on its surface, for a while at each of the server's
+    time accelerations, with each integrator, through the collision scheduler like the server does
+    it. It should stay on the ground: lowest is its lowest altitude at the end of any tick, which
+    mustn't be below zero, and collisions is how many the scheduler reported. Exits with an error
+    if it sank at any of them"""
+    entities = corbit.mysqlio.load_json(open(args.scenario, "r"))
+    names = [entity.name for entity in entities]
+    habitat, planet = names.index("Habitat"), names.index(args.planet)
+    sunk = []
+    print("%14s %10s %8s %14s %12s %10s" % ("integrator", "warp", "ticks", "lowest (m)", "collisions", "wall (s)"))
+    for name in args.integrators:
+        for warp in args.warps:
+            nbody = corbit.gravity.NBody()
+            nbody.gather(entities)
+            nbody.external[:] = 0  # the accelerations saved in the file are last tick's gravity, not thrust
+            # sitting on top of the planet, as seen from the Sun, and going along with it
+            up = nbody.positions[planet] / numpy.linalg.norm(nbody.positions[planet])
+            nbody.positions[habitat] = nbody.positions[planet] + up * (nbody.radii[planet] + nbody.radii[habitat])
+            nbody.velocities[habitat] = nbody.velocities[planet]
+            if args.rails:
+                nbody.rails.pin(nbody, entities, [args.planet], nbody.time)
+            integrator = corbit.integrators.create(name)
+            if not args.no_encounters:
+                integrator = corbit.encounters.Regularized(integrator)
+            scheduler = corbit.collision.Scheduler()
+            dt = warp / 30
+            lowest = numpy.inf
+            collisions = 0
+            start = time.perf_counter()
+            for tick in range(args.ticks):
+                collisions += len(scheduler.advance(nbody, integrator, dt, names))
+                altitude = numpy.linalg.norm(nbody.positions[habitat] - nbody.positions[planet]) - \
+                    (nbody.radii[planet] + nbody.radii[habitat])
+                lowest = min(lowest, altitude)
+            print("%14s %10g %8d %14.3e %12d %10.3f" % (name, warp, args.ticks, lowest, collisions,
+                                                       time.perf_counter() - start))
+            # positions that far from the origin are only good to a few times this
+            if lowest < -4 * numpy.spacing(numpy.linalg.norm(nbody.positions[planet])):
+                sunk.append((name, warp))
+    if sunk:
+        raise SystemExit("sank into " + args.planet + " with " + ", ".join("%s at %gx" % run for run in sunk))
+
+
+def measure_allocations(function, calls):
+    """Calls function over and over with tracemalloc and the garbage collector watching
+    :return: (most memory any one call allocated and freed again before returning, in bytes,
+    memory still allocated afterwards per call, in bytes, garbage collections per call, wall time per call, in s)
+    """
+    collections = [0]
+
+    def count(phase, info):
+        if phase == "start":
+            collections[0] += 1
+
+    function()  # the first call can set up caches and the like, which aren't churn
+    gc.collect()
+    gc.callbacks.append(count)
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        transient = 0
+        wall = 0.0
+        for call in range(calls):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            began = time.perf_counter()
+            function()
+            wall += time.perf_counter() - began
+            transient = max(transient, tracemalloc.get_traced_memory()[1] - before)
+        kept = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+        gc.callbacks.remove(count)
+    return transient, kept / calls, collections[0] / calls, wall / calls
+
+
+def bench_allocations(args):
+    """How much memory the tick loop churns through: the scenario plus a belt of asteroids, all in
+    one EntityStore. transient is the most any one call allocated and freed again, kept is what it
+    left allocated (per call, so that should be 0 once things are warmed up), and GCs is how many
+    garbage collections ran per 1000 calls. Timings are with tracemalloc on, so they're slow"""
+    entities, nbody = load_arrays(args.scenario)
+    store = entities[0].store
+    positions, velocities, masses = add_belt(nbody.positions, nbody.velocities, nbody.masses,
+                                             args.count, 3.1e11, 4.9e11)
+    entities += [corbit.objects.Entity("asteroid " + str(i), float(masses[i]), 1e4, (128, 128, 128),
+                                       positions[i].tolist(), velocities[i].tolist(), [0.0, 0.0], 0.0, 0.0, 0.0,
+                                       test_particle=True, store=store)
+                 for i in range(len(nbody), len(masses))]
+    for entity in entities:
+        entity.acceleration = units.internal(numpy.zeros(2), m / s / s)
+    dt = units.internal(args.dt, s)
+    force = units.internal(numpy.array([1.0, 0.0]), N)
+    nbody = corbit.gravity.NBody()
+    integrator = corbit.integrators.create(args.integrator)
+    scheduler = corbit.collision.Scheduler()
+    names = [entity.name for entity in entities]
+
+    def move():
+        for entity in entities:
+            entity.move(dt)
+
+    def accelerate():
+        for entity in entities:
+            entity.accelerate(force, 0.5)
+
+    def rotate_each():
+        for entity in entities:
+            entity.rotate(dt)
+
+    def gather_scatter():
+        nbody.gather(entities)
+        nbody.scatter(entities)
+
+    def tick():
+        # what the server does every tick
+        nbody.gather(entities)
+        scheduler.advance(nbody, integrator, args.dt, names)
+        nbody.scatter(entities)
+        corbit.objects.rotate(entities, dt)
+
+    print(len(entities), "entities,", args.integrator, "ticks of", args.dt, "s")
+    print("%26s %8s %14s %12s %10s %12s" % ("", "calls", "transient (B)", "kept (B)", "GCs/1000", "wall (us)"))
+    for name, function in (("Entity.move, each", move),
+                           ("Entity.accelerate, each", accelerate),
+                           ("Entity.rotate, each", rotate_each),
+                           ("objects.rotate, all", lambda: corbit.objects.rotate(entities, dt)),
+                           ("gather + scatter", gather_scatter),
+                           ("server tick", tick)):
+        transient, kept, collections, wall = measure_allocations(function, args.ticks)
+        print("%26s %8d %14d %12.1f %10.1f %12.1f" % (name, args.ticks, transient, kept, 1000 * collections,
+                                                      wall * 1e6))
+
+
+def bench_saves(args):
+    """Saving and loading the scenario plus a belt of asteroids, as JSON (objects.json_serialize and
+    mysqlio.load_scenario) and as a binary snapshot (corbit.snapshot). Loading the snapshot is
+    timed up to having the entities, and then again up to having them gathered into an NBody, since
+    that's when the memory-mapped columns actually get read"""
+    directory = tempfile.mkdtemp()
+    json_file = os.path.join(directory, "scenario.json")
+    snapshot_file = os.path.join(directory, "scenario.snap")
+    print("%9s %10s %10s %10s %10s %10s %12s %10s" % ("N", "JSON save", "JSON load", "JSON (MB)", "snap save",
+                                                       "snap load", "+gather (s)", "snap (MB)"))
+    try:
+        for count in args.sizes:
+            # the asteroids go straight into the scenario's store, it'd take ages through Entity's constructor
+            entities, settings = corbit.snapshot.load_scenario(args.scenario)
+            store = entities[0].store
+            nbody = corbit.gravity.NBody()
+            nbody.gather(entities)
+            positions, velocities, masses = add_belt(nbody.positions, nbody.velocities, nbody.masses,
+                                                     count - len(entities), 3.1e11, 4.9e11)
+            store.reserve(count)
+            rows = numpy.array([store.add() for i in range(len(entities), count)], dtype=numpy.intp)
+            store.positions[rows] = positions[len(entities):]
+            store.velocities[rows] = velocities[len(entities):]
+            store.dry_masses[rows] = masses[len(entities):]
+            store.radii[rows] = 1e4
+            store.test_particles[rows] = True
+            entities += [corbit.objects.Entity.view(store, row, "asteroid " + str(row), (128, 128, 128)) for row in rows]
+
+            json_times = ["", ""]
+            json_size = ""
+            if count <= args.json_limit:
+                start = time.perf_counter()
+                with open(json_file, "w") as output:
+                    corbit.objects.json_serialize(entities, output, settings=settings)
+                json_times[0] = "%10.3f" % (time.perf_counter() - start)
+                start = time.perf_counter()
+                with open(json_file, "r") as scenario:
+                    corbit.mysqlio.load_scenario(scenario)
+                json_times[1] = "%10.3f" % (time.perf_counter() - start)
+                json_size = "%10.2f" % (os.path.getsize(json_file) / 1e6)
+
+            start = time.perf_counter()
+            corbit.snapshot.save(snapshot_file, entities, settings)
+            save_time = time.perf_counter() - start
+            start = time.perf_counter()
+            loaded = corbit.snapshot.load(snapshot_file)[0]
+            load_time = time.perf_counter() - start
+            corbit.gravity.NBody().gather(loaded)
+            gather_time = time.perf_counter() - start
+            assert len(loaded) == count
+            del loaded  # lets go of the memory map
+            print("%9d %10s %10s %10s %10.3f %10.3f %12.3f %10.2f" % (
+                count, json_times[0], json_times[1], json_size, save_time, load_time, gather_time,
+                os.path.getsize(snapshot_file) / 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Corbit benchmarks")
+    parser.add_argument("--scenario", default="saves/OCESS.json", help="scenario file to start from")
+    benchmarks = parser.add_subparsers(dest="benchmark")
+
+    gravity = benchmarks.add_parser("gravity", help=bench_gravity.__doc__)
+    gravity.add_argument("--sizes", type=int, nargs="+", default=[500, 1000, 2000, 4000, 8000, 16000],
+                         help="total numbers of bodies to time")
+    gravity.add_argument("--opening-angle", type=float, default=0.5)
+    gravity.set_defaults(run=bench_gravity)
+
+    test_particles = benchmarks.add_parser("test-particles", help=bench_test_particles.__doc__)
+    test_particles.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000, 10000],
+                                help="numbers of test particles to add")
+    test_particles.set_defaults(run=bench_test_particles)
+
+    integrators = benchmarks.add_parser("integrators", help=bench_integrators.__doc__)
+    integrators.add_argument("--days", type=float, default=90, help="how much time to simulate")
+    integrators.add_argument("--dt", type=float, nargs="+", default=[100000 / 30, 10000 / 30],
+                             help="step sizes to try, in s. The defaults are one tick at 100000x and 10000x")
+    integrators.set_defaults(run=bench_integrators)
+
+    collisions = benchmarks.add_parser("collisions", help=bench_collisions.__doc__)
+    collisions.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000],
+                            help="total numbers of bodies to time")
+    collisions.add_argument("--all-pairs-limit", type=int, default=1000,
+                            help="largest N to time the narrow phase on every pair for, it's O(N^2)")
+    collisions.set_defaults(run=bench_collisions)
+
+    neighbors = benchmarks.add_parser("neighbors", help=bench_neighbors.__doc__)
+    neighbors.add_argument("--count", type=int, default=10000, help="number of asteroids to add")
+    neighbors.add_argument("--ticks", type=int, default=300)
+    neighbors.add_argument("--dt", type=float, default=1000 / 30, help="tick length in s, default 1000x")
+    neighbors.add_argument("--skin-ticks", type=int, nargs="+", default=[3, 10, 30, 100],
+                           help="skin sizes to try, in ticks of movement")
+    neighbors.set_defaults(run=bench_neighbors)
+
+    hierarchy = benchmarks.add_parser("hierarchy", help=bench_hierarchy.__doc__)
+    hierarchy.add_argument("--sizes", type=int, nargs="+", default=[0, 1000, 10000],
+                           help="numbers of asteroids to add")
+    hierarchy.add_argument("--ticks", type=int, default=300)
+    hierarchy.add_argument("--dt", type=float, default=10000 / 30, help="tick length in s, default 10000x")
+    hierarchy.set_defaults(run=bench_hierarchy)
+
+    encounters = benchmarks.add_parser("encounters", help=bench_encounters.__doc__)
+    encounters.add_argument("--integrators", nargs="+", default=["leapfrog", "yoshida4"],
+                            choices=sorted(corbit.integrators.integrators))
+    encounters.add_argument("--dt", type=float, nargs="+", default=[1000 / 30, 10000 / 30, 100000 / 30],
+                            help="tick lengths to try, in s. The defaults are 1000x, 10000x and 100000x")
+    encounters.add_argument("--hours", type=float, default=16, help="how long the flyby takes, closest approach halfway")
+    encounters.add_argument("--miss", type=float, default=5e6, help="how far the habitat's aim misses the Moon's center, in m")
+    encounters.set_defaults(run=bench_encounters)
+
+    burns = benchmarks.add_parser("burns", help=bench_burns.__doc__)
+    burns.add_argument("--integrators", nargs="+", default=["leapfrog", "yoshida4"],
+                       choices=sorted(corbit.integrators.integrators))
+    burns.add_argument("--dt", type=float, nargs="+", default=[100 / 30, 1000 / 30, 10000 / 30, 100000 / 30],
+                       help="tick lengths to try, in s. The defaults are 100x, 1000x, 10000x and 100000x")
+    burns.add_argument("--hours", type=float, default=6, help="how much time to simulate")
+    burns.add_argument("--fuel", type=float, default=50000, help="main engine fuel, in kg. The engine burns 5 kg/s")
+    burns.add_argument("--radius", type=float, default=3e7, help="radius of the starting orbit, in m")
+    burns.set_defaults(run=bench_burns)
+
+    landed = benchmarks.add_parser("landed", help=bench_landed.__doc__)
+    landed.add_argument("--integrators", nargs="+", default=sorted(corbit.integrators.integrators),
+                        choices=sorted(corbit.integrators.integrators))
+    landed.add_argument("--warps", type=float, nargs="+", default=[1, 5, 10, 50, 100, 1000, 10000, 100000],
+                        help="time accelerations to try, the defaults are server.py's")
+    landed.add_argument("--ticks", type=int, default=100, help="ticks to run at each of them")
+    landed.add_argument("--planet", default="Earth", help="what the habitat is landed on")
+    landed.add_argument("--rails", action="store_true", help="put the planet on rails")
+    landed.add_argument("--no-encounters", action="store_true",
+                        help="don't solve close encounters analytically, which the server does by default")
+    landed.set_defaults(run=bench_landed)
+
+    allocations = benchmarks.add_parser("allocations", help=bench_allocations.__doc__)
+    allocations.add_argument("--count", type=int, default=1000, help="number of asteroids to add")
+    allocations.add_argument("--ticks", type=int, default=300)
+    allocations.add_argument("--dt", type=float, default=1000 / 30, help="tick length in s, default 1000x")
+    allocations.add_argument("--integrator", default="leapfrog", choices=sorted(corbit.integrators.integrators))
+    allocations.set_defaults(run=bench_allocations)
+
+    saves = benchmarks.add_parser("saves", help=bench_saves.__doc__)
+    saves.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                       help="total numbers of entities to save and load")
+    saves.add_argument("--json-limit", type=int, default=100000, help="largest N to time JSON for, it's slow")
+    saves.set_defaults(run=bench_saves)
+
+    args = parser.parse_args()
+    if args.benchmark is None:
+        parser.print_help()
+    else:
+        args.run(args)
+
+
+if __name__ == "__main__":
+    main()
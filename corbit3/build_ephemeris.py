@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+"""Builds a Chebyshev ephemeris of the natural bodies in a scenario, see corbit.ephemeris.
+Run from this directory, like server.py:
+
+    python3 build_ephemeris.py --days 365
+
+That simulates the scenario for a year, fits every body that isn't a habitat, writes
+saves/OCESS.eph, and prints how far off the fit is for each body. Then point the scenario's
+"ephemeris" setting at the file.
+"""
+import argparse
+import math
+import os
+import time
+
+import numpy
+
+import corbit.objects
+import corbit.snapshot
+import corbit.gravity
+import corbit.integrators
+import corbit.ephemeris
+
+MIN_SAMPLES = 32  # fewest samples a segment is fitted to
+MAX_SAMPLES = 4096  # and the most
+
+
+def segment_samples(nbody, bodies, dt, total):
+    """How many samples each body's segments should span: about a radian of its fastest orbit,
+    rounded down to a power of two so the segments of all the bodies line up
+    :return: (len(bodies),) int array
+    """
+    times = corbit.gravity.dynamical_times(nbody.positions[bodies], nbody.positions[nbody.massive],
+                                           nbody.masses[nbody.massive])
+    with numpy.errstate(divide="ignore"):
+        exponents = numpy.floor(numpy.log2(times / dt))
+    exponents = numpy.clip(exponents, math.log2(MIN_SAMPLES), math.log2(min(MAX_SAMPLES, total)))
+    return (2 ** exponents).astype(numpy.intp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds a Chebyshev ephemeris of a scenario")
+    parser.add_argument("--scenario", default="saves/OCESS.json", help="scenario file to start from, JSON or a snapshot")
+    parser.add_argument("--output", help="ephemeris file to write, default the scenario with .eph on the end")
+    parser.add_argument("--days", type=float, default=30, help="how much time the ephemeris covers")
+    parser.add_argument("--dt", type=float, default=60, help="time between samples, in s. Also the integrator step")
+    parser.add_argument("--degree", type=int, default=12, help="degree of the Chebyshev polynomials")
+    parser.add_argument("--integrator", default="yoshida4", choices=sorted(corbit.integrators.integrators))
+    parser.add_argument("--bodies", nargs="+", help="names of the bodies to fit, default everything but habitats")
+    args = parser.parse_args()
+    output = args.output or os.path.splitext(args.scenario)[0] + ".eph"
+
+    entities, settings = corbit.snapshot.load_scenario(args.scenario)
+    nbody = corbit.gravity.NBody(settings["gravity solver"], settings["opening angle"])
+    nbody.gather(entities)
+    nbody.external[:] = 0  # the accelerations saved in the file are last tick's gravity, not thrust
+    integrator = corbit.integrators.create(args.integrator)
+    if args.bodies:
+        names = set(args.bodies)
+    else:
+        names = set(entity.name for entity in entities if not isinstance(entity, corbit.objects.Habitat))
+    bodies = numpy.array([i for i, entity in enumerate(entities) if entity.name in names], dtype=numpy.intp)
+
+    total = int(math.ceil(args.days * 24 * 3600 / args.dt))
+    samples = segment_samples(nbody, bodies, args.dt, total)
+    block = samples.max()
+    blocks = int(math.ceil(total / block))
+    print("Fitting", len(bodies), "bodies over", blocks * block * args.dt / (24 * 3600), "days,", blocks * block,
+          "steps of", args.dt, "s with", args.integrator)
+
+    # simulate a block at a time, and fit every body's segments in it. Blocks share their end points
+    coefficients = [[] for body in bodies]
+    errors = numpy.zeros(len(bodies))
+    buffer = numpy.empty((block + 1, len(bodies), 2))
+    buffer[0] = nbody.positions[bodies]
+    start = time.perf_counter()
+    for b in range(blocks):
+        for step in range(1, block + 1):
+            integrator.step(nbody, args.dt)
+            buffer[step] = nbody.positions[bodies]
+        for i in range(len(bodies)):
+            for first in range(0, block, samples[i]):
+                segment, error = corbit.ephemeris.fit(buffer[first:first + samples[i] + 1, i], args.degree)
+                coefficients[i].append(segment)
+                errors[i] = max(errors[i], error)
+        buffer[0] = buffer[-1]
+        print("block", b + 1, "of", blocks, "done,", round(time.perf_counter() - start, 1), "s")
+
+    header = []
+    first_segment = 0
+    for i, body in enumerate(bodies):
+        header.append({"name": entities[body].name, "first segment": first_segment,
+                       "segments": len(coefficients[i]), "segment length": float(samples[i] * args.dt),
+                       "max error": float(errors[i])})
+        first_segment += len(coefficients[i])
+    corbit.ephemeris.write(output, 0.0, float(blocks * block * args.dt), args.degree, header,
+                           numpy.concatenate([numpy.array(c) for c in coefficients]), args.scenario)
+
+    print("%12s %16s %10s %14s" % ("body", "segment (s)", "segments", "max error (m)"))
+    for body in header:
+        print("%12s %16.0f %10d %14.3e" % (body["name"], body["segment length"], body["segments"], body["max error"]))
+    print("Wrote", output, os.path.getsize(output), "bytes")
+
+
+if __name__ == "__main__":
+    main()
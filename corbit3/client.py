@@ -5,19 +5,24 @@ import corbit.physics
 import corbit.objects
 import corbit.network
 import corbit.mysqlio
+import corbit.units
+import corbit.hierarchy
 import sys  # used to exit the program
 import pygame  # used for drawing and a couple other things
 import pygame.locals as gui  # for things like KB_LEFT
 import unum
 import unum.units as un
 import scipy
+import numpy
 import numpy.linalg as LA
 import math
 
 print("Corbit PILOT " + __version__)
 fps = 30 * un.Hz
-entities = []  # this list will store all the entities
+registry = corbit.objects.EntityRegistry()  # the server's ids for the entities, and indexes to find them by
+entities = registry.entities  # this list will store all the entities
 ADDRESS = "localhost"
+hierarchy = corbit.hierarchy.Hierarchy()  # what orbits what, so the HUD knows what we're orbiting
 corbit.mysqlio.connect_to_db((ADDRESS, "root", "3.1415pi", "corbit"))
 
 
@@ -65,13 +70,26 @@ assert(intersects(100, [-99, -99], [80, 80]))
 assert(intersects(100, [-99, 79], [80, 80]))
 assert(intersects(100, [79, 79], [80, 80]))
 
+def update_reference():
+    """Points the HUD at whatever the controlled entity is orbiting right now, so its altitude,
+    orbit etc. are relative to the Moon when it's at the Moon"""
+    positions = numpy.array([corbit.units.number(entity.displacement, un.m) for entity in entities])
+    masses = numpy.array([corbit.units.number(entity.mass(), un.kg) for entity in entities])
+    massive = registry.massive_mask()
+    parent = hierarchy.update(positions, masses, massive)
+    i = registry.position(corbit.objects.control)
+    if i is not None and parent[i] >= 0:
+        corbit.objects.reference = entities[parent[i]].name
+
+
 def draw(display):
     for entity in entities:
         # Here I calculate the on-screen position and radius
+        relative_position = corbit.units.number(entity.displacement - camera.displacement, un.m)
         screen_position = \
-        [camera.zoom_level * (entity.displacement - camera.displacement).asNumber()[0] + screen_size[0]/2,
-         camera.zoom_level * (entity.displacement - camera.displacement).asNumber()[1] + screen_size[1]/2]
-        screen_radius = entity.radius.asNumber() * camera.zoom_level
+        [camera.zoom_level * relative_position[0] + screen_size[0]/2,
+         camera.zoom_level * relative_position[1] + screen_size[1]/2]
+        screen_radius = corbit.units.number(entity.radius, un.m) * camera.zoom_level
 
         if not intersects(screen_radius, screen_position, screen_size):
             continue
@@ -92,10 +110,11 @@ def draw(display):
         elif type(entity) == corbit.objects.Habitat:
             # habitat is the entity drawing, but with a line pointing forwards
             # print("circle drawing", entity.name, screen_position, screen_radius)
+            heading = corbit.units.number(entity.angular_position, un.rad)
             pygame.draw.circle(screen, entity.color, screen_position, screen_radius)
             pygame.draw.aaline(screen, (0, 255, 0), screen_position,
-                               [int(screen_position[0] + screen_radius * math.cos(entity.angular_position)),
-                                int(screen_position[1] + screen_radius * math.sin(entity.angular_position))])
+                               [int(screen_position[0] + screen_radius * math.cos(heading)),
+                                int(screen_position[1] + screen_radius * math.sin(heading))])
 
     # flip the screen upside down, so that y values increase upwards like on a cartesian plane
     screen.blit(pygame.transform.flip(screen, False, True), (0, 0))
@@ -112,41 +131,48 @@ def draw(display):
         # between the field name and the field value
         return line_number + 1
 
+    # the simulation works in plain SI numbers, units only get put back on here for display
+    control = registry.find(corbit.objects.control)
+    reference = registry.find(corbit.objects.reference)
     lines_to_draw = \
         [("Altitude:",
-          corbit.physics.altitude(corbit.objects.find_entity(corbit.objects.control, entities),
-                                  corbit.objects.find_entity(corbit.objects.reference, entities)).__str__()),
+          corbit.units.attach(
+              corbit.physics.altitude(control, reference),
+              un.m).__str__()),
          ("Speed:",
-          corbit.physics.speed(corbit.objects.find_entity(corbit.objects.control, entities),
-                               corbit.objects.find_entity(corbit.objects.reference, entities)).__str__()),
+          corbit.units.attach(
+              corbit.physics.speed(control, reference),
+              un.m / un.s).__str__()),
          ("Acceleration:",
           (un.m / un.s / un.s *
-           LA.norm((corbit.objects.find_entity(corbit.objects.control, entities).acceleration -
-                    corbit.physics.gravitational_force(corbit.objects.find_entity(corbit.objects.control, entities),
-                                                       corbit.objects.find_entity(corbit.objects.reference, entities))
-                    / corbit.objects.find_entity(corbit.objects.control, entities).mass()).asNumber(
+           LA.norm(corbit.units.number(
+               control.acceleration - corbit.physics.gravitational_force(control, reference) / control.mass(),
                un.m / un.s / un.s))).__str__()),
          ("Rotation:",
-          corbit.objects.find_entity(corbit.objects.control, entities).angular_speed.__str__()),
+          corbit.units.attach(control.angular_speed, un.rad / un.s).__str__()),
          ("Torque:",
-          corbit.objects.find_entity(corbit.objects.control, entities).angular_acceleration.__str__()),
+          corbit.units.attach(control.angular_acceleration, un.rad / un.s / un.s).__str__()),
          ("", ""),
          ("Orbital Speed:",
-          corbit.physics.Vorbit(corbit.objects.find_entity(corbit.objects.control, entities),
-                                corbit.objects.find_entity(corbit.objects.reference, entities)).__str__()),
+          corbit.units.attach(
+              corbit.physics.Vorbit(control, reference),
+              un.m / un.s).__str__()),
          ("Periapsis:",
-          corbit.physics.periapsis(corbit.objects.find_entity(corbit.objects.control, entities),
-                                   corbit.objects.find_entity(corbit.objects.reference, entities)).__str__()),
+          corbit.units.attach(
+              corbit.physics.periapsis(control, reference),
+              un.m).__str__()),
          ("Apoapsis:",
-          corbit.physics.apoapsis(corbit.objects.find_entity(corbit.objects.control, entities),
-                                  corbit.objects.find_entity(corbit.objects.reference, entities)).__str__()),
+          corbit.units.attach(
+              corbit.physics.apoapsis(control, reference),
+              un.m).__str__()),
          ("", ""),
          ("Stopping Acc:",
-         corbit.physics.stopping_acc(corbit.objects.find_entity(corbit.objects.control, entities),
-                                     corbit.objects.find_entity(corbit.objects.reference, entities)).__str__()),
+          corbit.units.attach(
+              corbit.physics.stopping_acc(control, reference),
+              un.m / un.s / un.s).__str__()),
          ("", ""),
          ("Fuel:",
-          corbit.objects.find_entity(corbit.objects.control, entities).engine_system.fuel.__str__()),
+          corbit.units.attach(control.engine_system.fuel, un.kg).__str__()),
          ("Zoom:",
           camera.zoom_level.__str__())
         ]
@@ -159,10 +185,14 @@ def draw(display):
 
 
 while not entities:
-    entities = corbit.mysqlio.get_entities()
+    registry.load(corbit.mysqlio.get_entities())
+    entities = registry.entities
 while True:
     while not entities:
-        entities = corbit.mysqlio.get_entities()
+        registry.load(corbit.mysqlio.get_entities())
+        entities = registry.entities
+    # commands say which entity they're for by its id, see corbit.objects.EntityRegistry
+    pilot = str(registry.id_of(corbit.objects.control))
 
     # commands_to_send is a : list of (COMMAND, TARGET, AMOUNT) 3-tuples
     # of type                         (string,  string, float)
@@ -185,30 +215,30 @@ while True:
                 camera.locked = not camera.locked
                 print("locked=", camera.locked)
             elif event.key == gui.K_LEFT:
-                camera.pan(un.m / un.s / un.s * scipy.array((-1, 0)))
+                camera.pan(corbit.units.internal(scipy.array((-1, 0)), un.m / un.s / un.s))
             elif event.key == gui.K_RIGHT:
-                camera.pan(un.m / un.s / un.s * scipy.array((1, 0)))
+                camera.pan(corbit.units.internal(scipy.array((1, 0)), un.m / un.s / un.s))
             elif event.key == gui.K_UP:
-                camera.pan(un.m / un.s / un.s * scipy.array((0, 1)))
+                camera.pan(corbit.units.internal(scipy.array((0, 1)), un.m / un.s / un.s))
             elif event.key == gui.K_DOWN:
-                camera.pan(un.m / un.s / un.s * scipy.array((0, -1)))
+                camera.pan(corbit.units.internal(scipy.array((0, -1)), un.m / un.s / un.s))
             elif event.unicode == "a":
                 commands_to_send += "fire_verniers|AC,-1 "
-                commands_to_send.append(("fire verniers", "AC", -1))
+                commands_to_send.append(("fire verniers", pilot, -1))
             elif event.unicode == "d":
-                commands_to_send.append(("fire_verniers", "AC", 1))
+                commands_to_send.append(("fire_verniers", pilot, 1))
             elif event.unicode == "w":
-                commands_to_send.append(("change_engines", "AC", 0.01))
+                commands_to_send.append(("change_engines", pilot, 0.01))
             elif event.unicode == "s":
-                commands_to_send.append(("change_engines", "AC", -0.01))
+                commands_to_send.append(("change_engines", pilot, -0.01))
             elif event.unicode == "W":
-                commands_to_send.append(("fire_rcs", "AC", 0))
+                commands_to_send.append(("fire_rcs", pilot, 0))
             elif event.unicode == "A":
-                commands_to_send.append(("fire_rcs", "AC", str(math.pi / 2)))
+                commands_to_send.append(("fire_rcs", pilot, str(math.pi / 2)))
             elif event.unicode == "S":
-                commands_to_send.append(("fire_rcs", "AC", str(math.pi)))
+                commands_to_send.append(("fire_rcs", pilot, str(math.pi)))
             elif event.unicode == "D":
-                commands_to_send.append(("fire_rcs", "AC", str(-math.pi / 2)))
+                commands_to_send.append(("fire_rcs", pilot, str(-math.pi / 2)))
             elif event.unicode == "-":
                 camera.zoom(-0.1)
             elif event.unicode == "+":
@@ -224,10 +254,11 @@ while True:
         print(commands_to_send)
         corbit.mysqlio.push_commands(commands_to_send)
 
-    camera.move(1 / fps)
+    camera.move(corbit.units.internal(1 / fps.asNumber(un.Hz), un.s))
     # print(corbit.objects.find_entity("Sun", entities))
-    camera.update(corbit.objects.find_entity(camera.center, entities))
+    camera.update(registry.find(camera.center))
 
+    update_reference()
     draw(screen)
     pygame.display.flip()
     screen.fill((0, 0, 0))
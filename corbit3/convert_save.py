@@ -0,0 +1,37 @@
+#! /usr/bin/env python3
+"""Converts scenario files between JSON and binary snapshots (see corbit.snapshot). Run from this
+directory, like server.py:
+
+    python3 convert_save.py saves/OCESS.json saves/OCESS.snap
+    python3 convert_save.py saves/OCESS.snap saves/OCESS.json
+
+Which way it goes depends on what the input file is. Settings are carried over, and JSON files
+only get the ones that aren't the defaults.
+"""
+import argparse
+import os
+
+import corbit.mysqlio
+import corbit.objects
+import corbit.snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts scenario files between JSON and binary snapshots")
+    parser.add_argument("input", help="scenario file to convert, JSON or a snapshot")
+    parser.add_argument("output", help="file to write, a snapshot if the input is JSON and the other way around")
+    parser.add_argument("--compact", action="store_true", help="don't pretty-print JSON output")
+    args = parser.parse_args()
+
+    entities, settings = corbit.snapshot.load_scenario(args.input)
+    overrides = {key: value for key, value in settings.items() if corbit.mysqlio.default_settings[key] != value}
+    if corbit.snapshot.is_snapshot(args.input):
+        with open(args.output, "w") as output:
+            corbit.objects.json_serialize(entities, output, pretty=not args.compact, settings=overrides)
+    else:
+        corbit.snapshot.save(args.output, entities, overrides)
+    print("Wrote", len(entities), "entities to", args.output, os.path.getsize(args.output), "bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""Barnes-Hut gravity, for scenarios with thousands of bodies.
+
+Direct summation is O(N^2). Barnes-Hut puts the bodies into a quadtree, and from far enough away
+a whole cell of the tree is treated as a single body at the cell's centre of mass. "Far enough" is
+decided by the opening angle theta: a cell of width s at distance d gets used as a whole if
+s / d < theta. theta = 0 is exactly direct summation, bigger is faster and less accurate.
+
+Everything is done with numpy arrays and no Python loop over bodies, so the tree can just be
+rebuilt from scratch every tick:
+1. every body gets a Morton key (the bits of its quantized x and y interleaved), and the bodies
+   are sorted by key. Every cell of the quadtree is then a contiguous range of the sorted bodies,
+   and the cells on level l are the runs of equal key >> 2 * (DEPTH - l).
+2. the tree is built top-down one level at a time, only subdividing cells that have more than
+   leaf_size bodies in them. Masses and centres of mass of a whole level come from one
+   numpy.add.reduceat over the sorted bodies.
+3. the tree is walked for all the targets at once. We keep a list of (target, cell) pairs, and
+   every pass either accepts a pair (far enough), sums a leaf directly, or replaces the pair with
+   one pair per child cell.
+"""
+import numpy
+
+import corbit.gravity
+
+DEPTH = 31  # bits per axis in the Morton keys, so keys fit in 62 bits and the tree is at most 31 levels deep
+LEAF_SIZE = 16  # cells with this many bodies or fewer aren't subdivided, their bodies are summed directly
+CHUNK_SIZE = 4096  # how many targets get walked through the tree at once, to keep the pair lists small
+
+
+def _spread_bits(x):
+    """Spreads the lower 32 bits of x out so there's a 0 between each bit, e.g. 0b111 -> 0b10101"""
+    x = x & numpy.uint64(0x00000000FFFFFFFF)
+    x = (x | (x << numpy.uint64(16))) & numpy.uint64(0x0000FFFF0000FFFF)
+    x = (x | (x << numpy.uint64(8))) & numpy.uint64(0x00FF00FF00FF00FF)
+    x = (x | (x << numpy.uint64(4))) & numpy.uint64(0x0F0F0F0F0F0F0F0F)
+    x = (x | (x << numpy.uint64(2))) & numpy.uint64(0x3333333333333333)
+    x = (x | (x << numpy.uint64(1))) & numpy.uint64(0x5555555555555555)
+    return x
+
+
+def _expand_ranges(starts, lengths):
+    """Turns a list of ranges into one array of all the indices in them
+    e.g. starts=[0, 10], lengths=[2, 3] -> [0, 1, 10, 11, 12]
+    :return: (indices, owner) where owner[k] is which range indices[k] came from
+    """
+    owner = numpy.repeat(numpy.arange(len(starts)), lengths)
+    offsets = numpy.arange(len(owner)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    return starts[owner] + offsets, owner
+
+
+def _range_sums(values, starts, ends):
+    """Sums values[starts[i]:ends[i]] for every i, for sorted ranges that don't overlap"""
+    padded = numpy.concatenate((values, numpy.zeros((1,) + values.shape[1:])))
+    # reduceat sums from each index up to the next one, so every other sum is a range we want
+    return numpy.add.reduceat(padded, numpy.column_stack((starts, ends)).ravel(), axis=0)[::2]
+
+
+class QuadTree:
+    """A quadtree over a set of bodies, stored as flat arrays of cells (cell 0 is the root).
+    The bodies are kept sorted by Morton key, and cell i holds sorted bodies start[i]:end[i]."""
+
+    def __init__(self, positions, masses, leaf_size=LEAF_SIZE):
+        """
+        :param positions: (n, 2) array of positions, in m
+        :param masses: (n,) array of masses, in kg
+        :param leaf_size: cells with at most this many bodies aren't subdivided
+        """
+        positions = numpy.asarray(positions, dtype=numpy.float64)
+        masses = numpy.asarray(masses, dtype=numpy.float64)
+
+        # a square that contains everything, slightly padded so nothing lands exactly on the far edge
+        self.origin = positions.min(axis=0)
+        self.width = max((positions.max(axis=0) - self.origin).max() * (1 + 1e-9), 1.0)
+        cells_per_side = 2 ** DEPTH
+        quantized = numpy.minimum((positions - self.origin) / self.width * cells_per_side,
+                                  cells_per_side - 1).astype(numpy.uint64)
+        keys = _spread_bits(quantized[:, 0]) | (_spread_bits(quantized[:, 1]) << numpy.uint64(1))
+
+        self.order = numpy.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+        self.positions = positions[self.order]
+        self.masses = masses[self.order]
+        self.build(leaf_size)
+
+    def build(self, leaf_size):
+        """Builds the cell arrays, one level at a time"""
+        n = len(self.masses)
+        weighted = self.positions * self.masses[:, numpy.newaxis]
+        level_starts, level_ends, level_numbers, level_leaves, level_masses, level_weighted = [], [], [], [], [], []
+
+        # the (start, end) ranges of the cells we still have to subdivide. Level 0 is just the root
+        starts, ends = numpy.array([0]), numpy.array([n])
+        level = 0
+        while len(starts):
+            leaf = (ends - starts <= leaf_size) | (level == DEPTH)
+            level_starts.append(starts)
+            level_ends.append(ends)
+            level_numbers.append(numpy.full(len(starts), level))
+            level_leaves.append(leaf)
+            level_masses.append(_range_sums(self.masses, starts, ends))
+            level_weighted.append(_range_sums(weighted, starts, ends))
+
+            # split every open cell into the runs of bodies that share the next two bits of key
+            bodies, _ = _expand_ranges(starts[~leaf], (ends - starts)[~leaf])
+            level += 1
+            if not len(bodies):
+                break
+            prefix = self.keys[bodies] >> numpy.uint64(2 * (DEPTH - level))
+            split = numpy.flatnonzero((prefix[1:] != prefix[:-1]) | (bodies[1:] != bodies[:-1] + 1)) + 1
+            first = numpy.concatenate(([0], split))
+            starts = bodies[first]
+            ends = bodies[numpy.concatenate((split - 1, [len(bodies) - 1]))] + 1
+
+        self.start = numpy.concatenate(level_starts)
+        self.end = numpy.concatenate(level_ends)
+        self.level = numpy.concatenate(level_numbers)
+        self.leaf = numpy.concatenate(level_leaves)
+        self.mass = numpy.concatenate(level_masses)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            self.center_of_mass = numpy.concatenate(level_weighted) / self.mass[:, numpy.newaxis]
+        massless = self.mass <= 0
+        self.center_of_mass[massless] = self.positions[self.start[massless]]
+        self.size = self.width / 2.0 ** self.level
+        # lower left corner of each cell, from the key of any body in it
+        cell_key = self.keys[self.start] >> (numpy.uint64(2) * (DEPTH - self.level).astype(numpy.uint64))
+        self.corner = self.origin + self.size[:, numpy.newaxis] * numpy.stack(
+            (_compact_bits(cell_key), _compact_bits(cell_key >> numpy.uint64(1))), axis=1)
+
+        # children of cell i are the cells first_child[i]:last_child[i]. The cells on each level are
+        # in the same order as the bodies, so the children of a cell are the cells on the next level
+        # down whose start is inside the parent's range
+        self.first_child = numpy.zeros(len(self.start), dtype=numpy.intp)
+        self.last_child = numpy.zeros(len(self.start), dtype=numpy.intp)
+        offset = 0
+        for level in range(len(level_starts) - 1):
+            parents = slice(offset, offset + len(level_starts[level]))
+            offset += len(level_starts[level])
+            children = level_starts[level + 1]
+            open_cells = ~level_leaves[level]
+            self.first_child[parents][open_cells] = \
+                offset + numpy.searchsorted(children, level_starts[level][open_cells])
+            self.last_child[parents][open_cells] = \
+                offset + numpy.searchsorted(children, level_ends[level][open_cells])
+
+    def __len__(self):
+        return len(self.start)
+
+    def accelerations(self, targets, opening_angle, out=None):
+        """Finds the gravitational acceleration at each target position
+        :param targets: (n, 2) array of positions, in m. They don't have to be bodies in the tree
+        :param opening_angle: theta, see the module docstring
+        :param out: optional (n, 2) array to write the result into
+        :return: (n, 2) array of accelerations, in m/s/s
+        """
+        targets = numpy.asarray(targets, dtype=numpy.float64)
+        if out is None:
+            out = numpy.empty((len(targets), 2))
+        for start in range(0, len(targets), CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, len(targets))
+            self._walk(targets[start:stop], opening_angle, out[start:stop])
+        return out
+
+    def _walk(self, targets, opening_angle, out):
+        n = len(targets)
+        out[:] = 0
+        target = numpy.arange(n)
+        cell = numpy.zeros(n, dtype=numpy.intp)
+
+        while len(target):
+            separation = self.center_of_mass[cell] - targets[target]
+            r_squared = numpy.einsum("ij,ij->i", separation, separation)
+            corner = self.corner[cell]
+            inside = numpy.all((targets[target] >= corner) &
+                               (targets[target] < corner + self.size[cell, numpy.newaxis]), axis=1)
+            far = ~inside & (self.size[cell] ** 2 < opening_angle ** 2 * r_squared)
+
+            # far away cells are treated as one body at their centre of mass
+            if far.any():
+                self._add(out, target[far], separation[far], r_squared[far], self.mass[cell[far]])
+
+            # close leaves are summed over directly
+            near_leaf = ~far & self.leaf[cell]
+            if near_leaf.any():
+                bodies, owner = _expand_ranges(self.start[cell[near_leaf]],
+                                               self.end[cell[near_leaf]] - self.start[cell[near_leaf]])
+                leaf_target = target[near_leaf][owner]
+                leaf_separation = self.positions[bodies] - targets[leaf_target]
+                leaf_r_squared = numpy.einsum("ij,ij->i", leaf_separation, leaf_separation)
+                self._add(out, leaf_target, leaf_separation, leaf_r_squared, self.masses[bodies])
+
+            # and close cells that aren't leaves get opened up
+            near_open = ~far & ~self.leaf[cell]
+            children, owner = _expand_ranges(self.first_child[cell[near_open]],
+                                             self.last_child[cell[near_open]] - self.first_child[cell[near_open]])
+            target = target[near_open][owner]
+            cell = children
+
+        out *= corbit.gravity.G
+
+    @staticmethod
+    def _add(out, target, separation, r_squared, masses):
+        """Adds m * r / |r|^3 onto out[target], skipping anything at zero distance (i.e. itself)"""
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            weight = masses / (r_squared * numpy.sqrt(r_squared))
+        weight[r_squared == 0] = 0
+        for axis in range(2):
+            out[:, axis] += numpy.bincount(target, weights=weight * separation[:, axis], minlength=len(out))
+
+
+def _compact_bits(x):
+    """The opposite of _spread_bits: takes every other bit of x, starting at bit 0"""
+    x = x & numpy.uint64(0x5555555555555555)
+    x = (x | (x >> numpy.uint64(1))) & numpy.uint64(0x3333333333333333)
+    x = (x | (x >> numpy.uint64(2))) & numpy.uint64(0x0F0F0F0F0F0F0F0F)
+    x = (x | (x >> numpy.uint64(4))) & numpy.uint64(0x00FF00FF00FF00FF)
+    x = (x | (x >> numpy.uint64(8))) & numpy.uint64(0x0000FFFF0000FFFF)
+    x = (x | (x >> numpy.uint64(16))) & numpy.uint64(0x00000000FFFFFFFF)
+    return x.astype(numpy.float64)
+
+
+def accelerations(targets, sources, masses, opening_angle, out=None):
+    """Same as corbit.gravity.direct_accelerations, but using a Barnes-Hut tree over the sources
+    :param opening_angle: theta, see the module docstring
+    """
+    if not len(sources):
+        out = numpy.zeros((len(targets), 2)) if out is None else out
+        out[:] = 0
+        return out
+    return QuadTree(sources, masses).accelerations(targets, opening_angle, out=out)
+
+
+def error_report(positions, masses, opening_angle, sample=1024, seed=0):
+    """Compares Barnes-Hut with direct summation on a random sample of the bodies
+    :param positions: (n, 2) array of positions, in m
+    :param masses: (n,) array of masses, in kg
+    :param opening_angle: theta, see the module docstring
+    :param sample: how many bodies to check. Checking them all is O(N^2), which is what we're avoiding
+    :return: dict of the median, 99th percentile, and max relative error of the accelerations, or
+    None if there's nothing to compare, because no body feels any gravity (one massive body or none)
+    """
+    positions = numpy.asarray(positions, dtype=numpy.float64)
+    picked = numpy.random.RandomState(seed).permutation(len(positions))[:sample]
+    approximate = accelerations(positions[picked], positions, masses, opening_angle)
+    exact = corbit.gravity.direct_accelerations(positions[picked], positions, masses)
+    magnitude = numpy.linalg.norm(exact, axis=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        error = numpy.linalg.norm(approximate - exact, axis=1) / magnitude
+    error = error[magnitude > 0]
+    if not len(error):
+        return None
+    return {"median": numpy.median(error), "99%": numpy.percentile(error, 99), "max": error.max(),
+            "sample": len(error)}
@@ -0,0 +1,116 @@
+"""Engine burns, integrated as part of the equations of motion.
+
+Every tick the engine systems that are firing (see corbit.objects.EngineSystem) get gathered into
+a Burns, along with the rest of the NBody. An engine system burning fuel at q kg/s with an exhaust
+speed of v_e (its I_sp, which is in m/s) pushes with q v_e newtons, and the ship gets lighter as it
+burns, so its acceleration t seconds into the burn is
+
+    a(t) = q v_e / (m0 - q t)
+
+until the tank runs dry at t = fuel / q. NBody.accelerations_at adds that in at whatever time into
+the tick the integrator asks about, so the burn gets integrated along with gravity instead of being
+one kick per tick, and integrating it gives the rocket equation, dv = v_e ln(m0 / m1), however
+high the time acceleration. The thrust points where the ship was pointing at the start of the
+tick. The collision Scheduler (corbit.collision) stops the integrator at every burnout, so no step
+straddles an engine cutting out, and scatter() takes the fuel that was burnt out of the tanks.
+"""
+import numpy
+from unum.units import kg, m, s, rad
+
+from corbit import units
+
+# a step that starts this close before a tank runs dry counts as starting after it, so a step the
+# Scheduler started at a burnout doesn't get the engine's thrust because of rounding in the clock
+BURNOUT_TOLERANCE = 1e-6  # s
+
+
+class Burns:
+    """The engine systems that are firing this tick, as arrays"""
+
+    def __init__(self):
+        self.bodies = numpy.zeros(0, dtype=numpy.intp)  # NBody row of each engine system's entity
+        self.flows = numpy.zeros(0)  # fuel burnt, in kg/s
+        self.exhaust_speeds = numpy.zeros(0)  # m/s
+        self.directions = numpy.zeros((0, 2))  # unit vectors of the thrust
+        self.burn_times = numpy.zeros(0)  # how long until each tank runs dry, in s
+        self.systems = []  # the EngineSystems themselves, to take the fuel out of
+        self.start = 0.0  # simulation time the burns started at, in s
+
+    def __len__(self):
+        return len(self.bodies)
+
+    def gather(self, entities, time):
+        """Collects the engine systems of the entities that are firing and have fuel left
+        :param entities: list of entities, in NBody row order
+        :param time: simulation time now, in s. Normally nbody.time
+        """
+        bodies, flows, exhaust_speeds, angles, fuel = [], [], [], [], []
+        self.systems = []
+        for i, entity in enumerate(entities):
+            for system in entity.engine_systems():
+                flow = abs(system.throttle) * units.number(system.rated_fuel_flow, kg / s)
+                tank = units.number(system.fuel, kg)
+                if flow <= 0 or tank <= 0:
+                    continue
+                self.systems.append(system)
+                bodies.append(i)
+                flows.append(flow)
+                exhaust_speeds.append(units.number(system.I_sp, m / s))
+                angles.append(units.number(entity.angular_position, rad) + system.direction)
+                fuel.append(tank)
+        self.bodies = numpy.array(bodies, dtype=numpy.intp)
+        self.flows = numpy.array(flows, dtype=numpy.float64)
+        self.exhaust_speeds = numpy.array(exhaust_speeds, dtype=numpy.float64)
+        angles = numpy.array(angles, dtype=numpy.float64)
+        self.directions = numpy.column_stack((numpy.cos(angles), numpy.sin(angles)))
+        self.burn_times = numpy.array(fuel, dtype=numpy.float64) / self.flows if len(flows) else numpy.zeros(0)
+        self.start = float(time)
+
+    def firing(self, size):
+        """:return: (size,) bool array, True for the NBody rows with engines firing"""
+        mask = numpy.zeros(size, dtype=bool)
+        mask[self.bodies] = True
+        return mask
+
+    def burnt(self, time):
+        """:return: (len(self),) array of the fuel each engine system has burnt by a time, in kg"""
+        return self.flows * numpy.clip(time - self.start, 0, self.burn_times)
+
+    def add_accelerations(self, step_start, time, masses, out, rows):
+        """Adds the thrust at a time to accelerations. Whether an engine is firing goes by when the
+        integrator's step started, not the time itself, so a step that ends right at a burnout gets
+        the thrust all the way to the end (the Scheduler makes sure no step goes past one)
+        :param step_start: simulation time the integrator's step started at, in s
+        :param time: simulation time, in s
+        :param masses: (n,) array of what the bodies weighed when the burns were gathered, in kg
+        :param out: (k, 2) array of accelerations to add to
+        :param rows: (n,) int array, which row of out is for each body, -1 for bodies that aren't in it
+        """
+        wanted = rows[self.bodies] >= 0
+        if not wanted.any():
+            return
+        elapsed = step_start - self.start
+        # a ship with more than one engine system firing gets lighter from all of them
+        lost = numpy.bincount(self.bodies, self.burnt(time), minlength=len(masses))
+        thrusting = (elapsed >= -BURNOUT_TOLERANCE) & (elapsed < self.burn_times - BURNOUT_TOLERANCE) & wanted
+        magnitudes = self.flows[thrusting] * self.exhaust_speeds[thrusting] / \
+            (masses[self.bodies[thrusting]] - lost[self.bodies[thrusting]])
+        numpy.add.at(out, rows[self.bodies[thrusting]], magnitudes[:, numpy.newaxis] * self.directions[thrusting])
+
+    def burnouts(self, start, end):
+        """:return: sorted list of the times between start and end (both in s, not included) when a tank runs dry"""
+        times = self.start + self.burn_times
+        return sorted(set(times[(times > start + BURNOUT_TOLERANCE) & (times < end - BURNOUT_TOLERANCE)].tolist()))
+
+    def scatter(self, time):
+        """Takes the fuel burnt up to a time out of the engine systems' tanks, shuts off the ones
+        that were only firing for this tick (see EngineSystem.pulse), and forgets all the burns
+        until the next gather()
+        :param time: simulation time, in s. Normally nbody.time after the tick
+        """
+        for system, fuel in zip(self.systems, self.burnt(time)):
+            system.fuel = units.internal(max(units.number(system.fuel, kg) - fuel, 0.0), kg)
+            if system.pulsing:
+                system.throttle = 0
+                system.pulsing = False
+        self.gather([], time)
@@ -0,0 +1,605 @@
+"""Collision detection and response for whole arrays of entities at once.
+
+The broad phase finds the few pairs of entities that could possibly collide
+during a tick, so that the exact test, the narrow phase, only has to run on those
+instead of on every pair.
+
+Sweep and prune: the path each entity takes over the tick, with its radius around it, fits in an
+axis-aligned box. Sort the boxes by their left edge, and the boxes that overlap box i in x are the
+ones after it in that order whose left edge is left of i's right edge, which a binary search finds.
+Then drop the pairs that don't overlap in y too. In a sparse scene like a solar system that's
+O(N log N) and leaves hardly any pairs. The boxes contain the straight line paths that
+the narrow phase checks, so this never drops a pair that would have collided. NeighborList keeps
+the pairs from one tick to the next, so most ticks don't even need the sort.
+
+The narrow phase (impacts) then solves for the times of impact of all the candidates at once,
+earliest picks the ones to act on, and respond works out the velocities after them.
+physics.resolve_collisions puts those together and moves the entities, once per tick. The server
+uses Scheduler instead, which stops the integrator at every impact, and also keeps bodies that are
+resting on each other, like a ship landed on a planet, from sinking into each other (see resting).
+"""
+import heapq
+
+import numpy
+
+RESTITUTION = 0.1  # coefficient of restitution of every collision
+# a pair counts as touching when the gap between them is less than this times the sum of their radii
+CONTACT_TOLERANCE = 1e-3
+SKIN_TICKS = 10  # how many ticks of movement NeighborList skins allow for by default, see benchmark.py neighbors
+# touching pairs closing in slower than this, in m/s, are resting on each other rather than colliding
+RESTING_SPEED = 1e-3
+FRICTION = 0.5  # coefficient of friction between bodies resting on each other
+
+
+def swept_boxes(positions, velocities, radii, dt):
+    """Bounding boxes of where each entity could be during the next dt
+    :param positions: (n, 2) array, in m
+    :param velocities: (n, 2) array, in m/s
+    :param radii: (n,) array, in m
+    :param dt: length of the tick, in s
+    :return: ((n, 2) array of the lower left corners, (n, 2) array of the upper right corners), in m
+    """
+    end = positions + velocities * dt
+    padding = radii[:, numpy.newaxis]
+    return numpy.minimum(positions, end) - padding, numpy.maximum(positions, end) + padding
+
+
+def candidate_pairs(positions, velocities, radii, dt):
+    """Pairs of entities whose swept boxes overlap, i.e. the ones that might collide in the next dt
+    :param positions: (n, 2) array, in m
+    :param velocities: (n, 2) array, in m/s
+    :param radii: (n,) array, in m
+    :param dt: length of the tick, in s
+    :return: (first, second) index arrays, with first < second, sorted in the same order
+    itertools.combinations(range(n), 2) would give them
+    """
+    return overlapping_pairs(*swept_boxes(positions, velocities, radii, dt))
+
+
+def overlapping_pairs(lower, upper):
+    """Sweep and prune: the pairs of boxes that overlap
+    :param lower: (n, 2) array of the lower left corners of the boxes
+    :param upper: (n, 2) array of the upper right corners
+    :return: (first, second) index arrays, with first < second, sorted in the same order
+    itertools.combinations(range(n), 2) would give them
+    """
+    n = len(lower)
+
+    # sweep along x
+    order = numpy.argsort(lower[:, 0], kind="mergesort")
+    left = lower[order, 0]
+    # sorted box k overlaps sorted boxes k + 1 up to (not including) stop[k] in x
+    stop = numpy.searchsorted(left, upper[order, 0], side="right")
+    counts = numpy.maximum(stop - numpy.arange(n) - 1, 0)
+    first = numpy.repeat(numpy.arange(n), counts)
+    second = first + 1 + numpy.arange(len(first)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    a = order[first]
+    b = order[second]
+
+    # prune on y
+    overlap = (lower[a, 1] <= upper[b, 1]) & (lower[b, 1] <= upper[a, 1])
+    a = a[overlap]
+    b = b[overlap]
+
+    first = numpy.minimum(a, b)
+    second = numpy.maximum(a, b)
+    combined = numpy.argsort(first * n + second, kind="mergesort")
+    return first[combined], second[combined]
+
+
+def pairs_with(bodies, positions, velocities, radii, dt):
+    """The broad phase for just a few bodies, against everything: O(len(bodies) * n) and no sorting
+    :param bodies: index array
+    :param positions: (n, 2) array, in m
+    :param velocities: (n, 2) array, in m/s
+    :param radii: (n,) array, in m
+    :param dt: length of the tick, in s
+    :return: (first, second) index arrays of the pairs that have one of the bodies in them and
+    whose swept boxes overlap, with first < second
+    """
+    lower, upper = swept_boxes(positions, velocities, radii, dt)
+    overlap = numpy.all((lower[bodies, numpy.newaxis] <= upper[numpy.newaxis]) &
+                        (lower[numpy.newaxis] <= upper[bodies, numpy.newaxis]), axis=2)
+    # not with themselves, and a pair of two of the bodies only once
+    overlap[:, bodies] &= ~numpy.tri(len(bodies), dtype=bool)
+    rows, others = numpy.nonzero(overlap)
+    return numpy.minimum(bodies[rows], others), numpy.maximum(bodies[rows], others)
+
+
+class NeighborList:
+    """Verlet neighbor lists for the broad phase: bodies only move a tiny fraction of the distance
+    between them each tick, so the candidate pairs hardly change from one tick to the next.
+
+    When the list is built, every body gets a skin: how far it would go in SKIN_TICKS ticks at its
+    current speed. The list is every pair whose boxes overlap when each body's box is its radius
+    plus its skin around where it was then. As long as every body's swept box for the tick stays
+    inside that, any pair whose swept boxes overlap is in the list, so a tick's candidates are just
+    the pairs in the list that pass the swept box test, no sorting needed. The list is built again
+    whenever a body's swept box leaves its skin, which also happens soon after the time
+    acceleration goes up, or the number of bodies or any of their radii change.
+    """
+
+    def __init__(self, skin_ticks=SKIN_TICKS):
+        """
+        :param skin_ticks: how many ticks of movement the skins allow for. Bigger means fewer
+        rebuilds, but more pairs in the list to check every tick
+        """
+        self.skin_ticks = skin_ticks
+        self.first = numpy.zeros(0, dtype=numpy.intp)
+        self.second = numpy.zeros(0, dtype=numpy.intp)
+        self.lower = numpy.zeros((0, 2))  # the boxes, skin included but not radius, when the list was built
+        self.upper = numpy.zeros((0, 2))
+        self.radii = numpy.zeros(0)  # the radii the list was built with
+        self.updates = 0
+        self.rebuilds = 0
+
+    def __len__(self):
+        return len(self.first)
+
+    def update(self, positions, velocities, radii, dt):
+        """The broad phase for this tick, rebuilding the list first if it has to be
+        :param positions: (n, 2) array, in m
+        :param velocities: (n, 2) array, in m/s
+        :param radii: (n,) array, in m
+        :param dt: length of the tick, in s
+        :return: (first, second) index arrays, the same pairs candidate_pairs would give
+        """
+        self.updates += 1
+        start, end = swept_boxes(positions, velocities, numpy.zeros(len(radii)), dt)
+        if len(start) != len(self.lower) or (start < self.lower).any() or (end > self.upper).any() or \
+                not numpy.array_equal(radii, self.radii):
+            skins = self.skin_ticks * dt * numpy.sqrt(numpy.einsum("ij,ij->i", velocities, velocities))
+            self.lower = numpy.minimum(start, positions - skins[:, numpy.newaxis])
+            self.upper = numpy.maximum(end, positions + skins[:, numpy.newaxis])
+            padding = radii[:, numpy.newaxis]
+            self.first, self.second = overlapping_pairs(self.lower - padding, self.upper + padding)
+            self.radii = radii.copy()
+            self.rebuilds += 1
+
+        first, second = self.first, self.second
+        padding = radii[:, numpy.newaxis]
+        lower = start - padding
+        upper = end + padding
+        overlap = numpy.all((lower[first] <= upper[second]) & (lower[second] <= upper[first]), axis=1)
+        return first[overlap], second[overlap]
+
+    def statistics(self):
+        """:return: dict of how the list is doing. "ticks per rebuild" is the number to watch, if it's
+        close to 1 the list is only costing time and skin_ticks should be smaller"""
+        return {"updates": self.updates, "rebuilds": self.rebuilds, "pairs": len(self),
+                "ticks per rebuild": self.updates / max(self.rebuilds, 1)}
+
+
+def impacts(positions, velocities, radii, first, second, dt):
+    """Narrow phase: the exact test, for a batch of pairs at once. Each pair collides if the gap
+    between them closes within dt, with both moving in straight lines at their current velocities.
+    That's solving |d + v t| = r_first + r_second for t, a quadratic, for every pair. Pairs that
+    never touch (no real root), don't move relative to each other (a = 0), are moving apart (t < 0),
+    or only touch after dt all get masked out. Pairs that already overlap and are still closing in
+    collide straight away, at t = 0: that happens when something curved into something else during
+    a tick, where the straight line didn't see it coming
+    :param positions: (n, 2) array, in m
+    :param velocities: (n, 2) array, in m/s
+    :param radii: (n,) array, in m
+    :param first: (k,) index array, e.g. from candidate_pairs
+    :param second: (k,) index array
+    :param dt: length of the tick, in s
+    :return: (hits, times, normals, tangents): indices into first and second of the pairs that
+    collide, their times to impact in s, unit vectors from second to first at the moment of impact,
+    and those turned 90 degrees anticlockwise
+    """
+    # see http://www.gvu.gatech.edu/people/official/jarek/graphics/material/collisionsDeshpandeKharsikarPrabhu.pdf
+    displacements = positions[first] - positions[second]
+    relative_velocities = velocities[first] - velocities[second]
+    a = numpy.einsum("ij,ij->i", relative_velocities, relative_velocities)
+    b = 2 * numpy.einsum("ij,ij->i", displacements, relative_velocities)
+    c = numpy.einsum("ij,ij->i", displacements, displacements) - (radii[first] + radii[second]) ** 2
+    with numpy.errstate(all="ignore"):  # the bad roots come out nan or inf, and get masked below
+        times = (-b - numpy.sqrt(b ** 2 - 4 * a * c)) / (2 * a)
+        times[(c < 0) & (b < 0)] = 0
+        hits = numpy.flatnonzero(numpy.isfinite(times) & (times >= 0) & (times <= dt))
+    times = times[hits]
+
+    normals = displacements[hits] + relative_velocities[hits] * times[:, numpy.newaxis]
+    normals /= numpy.sqrt(numpy.einsum("ij,ij->i", normals, normals))[:, numpy.newaxis]
+    tangents = numpy.column_stack((-normals[:, 1], normals[:, 0]))
+    return hits, times, normals, tangents
+
+
+def earliest(first, second, times):
+    """Picks which of a tick's collisions to act on: every body gets at most one, its earliest.
+    Whatever it would have hit next gets found next tick, from its new velocity
+    :param first: (k,) index array of the pairs that collide
+    :param second: (k,) index array
+    :param times: (k,) times to impact
+    :return: index array into first, second and times of the picked collisions, earliest first
+    """
+    picked = []
+    involved = set()
+    for k in numpy.argsort(times, kind="mergesort"):
+        if first[k] in involved or second[k] in involved:
+            continue
+        picked.append(k)
+        involved.update((first[k], second[k]))
+    return numpy.array(picked, dtype=numpy.intp)
+
+
+def respond(velocities, masses, first, second, normals, tangents, restitution=RESTITUTION):
+    """Velocities after a batch of collisions. Splitting each body's velocity into its components
+    along the normal and tangent of its collision, the tangential parts stay as they are, and the
+    normal parts go through a 1D collision that loses energy according to the coefficient of restitution
+    :param velocities: (n, 2) array, in m/s
+    :param masses: (n,) array, in kg
+    :param first: (k,) index array of the pairs that collide, no body in more than one pair
+    :param second: (k,) index array
+    :param normals: (k, 2) array, from impacts()
+    :param tangents: (k, 2) array, from impacts()
+    :param restitution: 1 for elastic collisions, 0 for the bodies to stick together
+    :return: ((k, 2) array of the first bodies' new velocities, (k, 2) array of the second bodies'), in m/s
+    """
+    normal_first = numpy.einsum("ij,ij->i", normals, velocities[first])
+    tangent_first = numpy.einsum("ij,ij->i", tangents, velocities[first])
+    normal_second = numpy.einsum("ij,ij->i", normals, velocities[second])
+    tangent_second = numpy.einsum("ij,ij->i", tangents, velocities[second])
+
+    mass_first = masses[first]
+    mass_second = masses[second]
+    momentum = mass_first * normal_first + mass_second * normal_second
+    total = mass_first + mass_second
+    normal_first, normal_second = \
+        (momentum + restitution * mass_second * (normal_second - normal_first)) / total, \
+        (momentum + restitution * mass_first * (normal_first - normal_second)) / total
+
+    return (normal_first[:, numpy.newaxis] * normals + tangent_first[:, numpy.newaxis] * tangents,
+            normal_second[:, numpy.newaxis] * normals + tangent_second[:, numpy.newaxis] * tangents)
+
+
+def resting(positions, velocities, accelerations, radii, first, second, dt):
+    """Which pairs are resting on each other for the next dt, like a ship landed on a planet. Those
+    are the pairs that are being pushed together: their acceleration towards each other is more than
+    the centripetal acceleration of how fast they're sliding past each other, so they aren't just
+    skimming past in orbit. And they're touching (within CONTACT_TOLERANCE) and will be touching
+    again when dt is up, if nothing held them apart, without closing in faster than RESTING_SPEED,
+    which would be a collision. So a ship bouncing a little after landing counts, if it would come
+    back down within the step. Nothing but the ground stops such a pair from sinking into each
+    other during a step, so Scheduler has the ground push them apart, and holds them in contact
+    :param positions: (n, 2) array, in m
+    :param velocities: (n, 2) array, in m/s
+    :param accelerations: (n, 2) array, in m/s/s. Only the rows in first and second are used
+    :param radii: (n,) array, in m
+    :param first: (k,) index array of the pairs to check, e.g. from candidate_pairs
+    :param second: (k,) index array
+    :param dt: length of the step, in s
+    :return: (rest, normals, pushes): indices into first and second of the pairs that are resting,
+    unit vectors from second to first for them, and how hard the ground has to push them apart
+    to stop them moving towards each other, as an acceleration of one relative to the other in m/s/s
+    """
+    displacements = positions[first] - positions[second]
+    distances = numpy.sqrt(numpy.einsum("ij,ij->i", displacements, displacements))
+    normals = displacements / distances[:, numpy.newaxis]
+    relative_velocities = velocities[first] - velocities[second]
+    normal_speeds = numpy.einsum("ij,ij->i", normals, relative_velocities)  # positive for moving apart
+    sliding = numpy.einsum("ij,ij->i", relative_velocities, relative_velocities) - normal_speeds ** 2
+    # what the ground has to push apart with to keep the distance between them the same
+    pressed = -numpy.einsum("ij,ij->i", normals, accelerations[first] - accelerations[second]) - sliding / distances
+    radius_sums = radii[first] + radii[second]
+    gaps = distances - radius_sums
+    rest = numpy.flatnonzero((pressed > 0) & (normal_speeds >= -RESTING_SPEED) &
+                             (gaps <= CONTACT_TOLERANCE * radius_sums) &
+                             (gaps <= pressed * dt ** 2 / 2 - normal_speeds * dt))
+    return rest, normals[rest], pressed[rest]
+
+
+def make_contact(positions, velocities, inverse_masses, first, second, normals, gaps, normal_speeds):
+    """Moves pairs along their normals until they just touch, and sets how fast they're moving apart
+    along them, in place. Momentum is kept, and the heavier body of each pair moves less
+    :param positions: (n, 2) array, in m
+    :param velocities: (n, 2) array, in m/s
+    :param inverse_masses: (n,) array of 1 / mass, in 1/kg, 0 for bodies that mustn't be moved (on
+    rails, say). No pair can have two of those
+    :param first: (k,) index array of the pairs
+    :param second: (k,) index array
+    :param normals: (k, 2) array of unit vectors from second to first
+    :param gaps: (k,) array of how far apart they are along the normals, minus the sum of their radii,
+    in m. Negative when they overlap
+    :param normal_speeds: (k,) array of the relative speeds along the normals they should end up with,
+    in m/s, positive for moving apart
+    """
+    totals = inverse_masses[first] + inverse_masses[second]
+    share_first = (inverse_masses[first] / totals)[:, numpy.newaxis]
+    share_second = (inverse_masses[second] / totals)[:, numpy.newaxis]
+    changes = (normal_speeds - numpy.einsum("ij,ij->i", normals, velocities[first] - velocities[second]))
+    corrections = normals * gaps[:, numpy.newaxis]
+    kicks = normals * changes[:, numpy.newaxis]
+    # add.at, so a body touching more than one thing gets all of its corrections
+    numpy.add.at(positions, first, -share_first * corrections)
+    numpy.add.at(positions, second, share_second * corrections)
+    numpy.add.at(velocities, first, share_first * kicks)
+    numpy.add.at(velocities, second, -share_second * kicks)
+
+
+def rub(velocities, inverse_masses, first, second, normals, limits):
+    """Friction between pairs resting on each other: takes up to limits off how fast they're sliding
+    past each other, in place. Momentum is kept, like make_contact
+    :param velocities: (n, 2) array, in m/s
+    :param inverse_masses: (n,) array, like make_contact's
+    :param first: (k,) index array of the pairs
+    :param second: (k,) index array
+    :param normals: (k, 2) array of unit vectors from second to first
+    :param limits: (k,) array of the most each pair's sliding speed can drop by, in m/s
+    """
+    relative_velocities = velocities[first] - velocities[second]
+    sliding = relative_velocities - normals * numpy.einsum("ij,ij->i", normals, relative_velocities)[:, numpy.newaxis]
+    speeds = numpy.sqrt(numpy.einsum("ij,ij->i", sliding, sliding))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        fractions = numpy.where(speeds > limits, limits / speeds, 1)
+    kicks = -sliding * fractions[:, numpy.newaxis]
+    totals = inverse_masses[first] + inverse_masses[second]
+    numpy.add.at(velocities, first, kicks * (inverse_masses[first] / totals)[:, numpy.newaxis])
+    numpy.add.at(velocities, second, -kicks * (inverse_masses[second] / totals)[:, numpy.newaxis])
+
+
+class Scheduler:
+    """Event-driven collisions: instead of moving colliding pairs to their impact and back inside a
+    tick, with gravity switched off for them, step the whole simulation to each impact in turn.
+
+    At the start of a tick every candidate pair gets its impact predicted, and the ones that land
+    inside the tick go in a priority queue keyed by time. The integrator advances everything to the
+    first one, the pair bounces, and only pairs involving those two bodies get predicted again,
+    since theirs are the only trajectories that changed. Events queued for either of them before
+    that are stale, and get thrown away when they come up: every body has a version number that
+    goes up when it collides, and an event only counts if both its bodies' versions still match.
+    So a body can hit several others in one tick, in the right order.
+
+    Predictions are straight lines, like everywhere else in this module, but the integrator moves
+    bodies on curves. So when an event comes up the pair is checked again from where the integrator
+    actually put them: touching (within CONTACT_TOLERANCE) means it's a collision, still closing in
+    means it gets predicted again from there, and moving apart means they missed.
+
+    Bodies resting on each other (see resting) aren't collisions. Before every integrator step the
+    tick's candidate pairs are checked for them, and the ground's push on them goes in
+    nbody.external for the step, so the integrator sees them sitting still. The step can still
+    wander off a little (or a lot, for integrators that move bodies around their primaries on Kepler
+    orbits), so after it those pairs are put back in contact, with no speed towards or away from
+    each other, and friction (FRICTION times the ground's push) slows down how fast they slide
+    over each other. Without it a ship sliding over a planet's surface would swing back and forth
+    faster every step at high time acceleration, the way an orbit does when the step is too long. After that any
+    candidate pairs that the integrator curved into each other are pushed apart, and they collide
+    if they were closing in faster than RESTING_SPEED.
+    """
+
+    def __init__(self):
+        self.queue = []  # heap of (time into the tick, first, second, version of first, version of second)
+        self.versions = numpy.zeros(0, dtype=numpy.int64)
+        self.predictions = 0  # how many pairs went through the narrow phase, for benchmarks
+        self.steps = 0  # how many integrator steps the last tick took, one more than the collisions in it, mostly
+        self.neighbors = NeighborList()  # the broad phase at the start of each tick
+        # (first, second) index arrays of this tick's candidate pairs, which get checked for touching
+        self.pairs = (numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0, dtype=numpy.intp))
+
+    def predict(self, positions, velocities, radii, now, end, first, second):
+        """Queues the impacts between pairs that happen between now and end if everything moves in straight lines
+        :param positions: (n, 2) array, in m, at now
+        :param velocities: (n, 2) array, in m/s
+        :param radii: (n,) array, in m
+        :param now: time into the tick, in s
+        :param end: length of the tick, in s
+        :param first: (k,) index array of the pairs to predict, from the broad phase
+        :param second: (k,) index array
+        """
+        self.predictions += len(first)
+        hits, times, normals, tangents = impacts(positions, velocities, radii, first, second, end - now)
+        for k, time in zip(hits, times):
+            i, j = first[k], second[k]
+            heapq.heappush(self.queue, (now + time, i, j, self.versions[i], self.versions[j]))
+
+    def pop(self, end):
+        """:return: (time, first, second) of the next event that isn't stale and happens by end, or None"""
+        while self.queue and self.queue[0][0] <= end:
+            time, i, j, version_i, version_j = heapq.heappop(self.queue)
+            if self.versions[i] == version_i and self.versions[j] == version_j:
+                return time, i, j
+        return None
+
+    def advance(self, nbody, integrator, dt, names, restitution=RESTITUTION):
+        """Steps the simulation forward, stopping to resolve each collision as it happens
+        :param nbody: corbit.gravity.NBody, with the entities gathered into it
+        :param integrator: a corbit.integrators.Integrator
+        :param dt: length of the tick, in s
+        :param names: names of the bodies, for taking the ones that collide off the rails or ephemeris
+        :return: list of (first, second, time into the tick in s) of the collisions, in order
+        """
+        if len(self.versions) != len(nbody):
+            self.versions = numpy.zeros(len(nbody), dtype=numpy.int64)
+        positions, velocities, radii = nbody.positions, nbody.velocities, nbody.radii
+        self.queue = []
+        self.steps = 0
+        # radii padded so pairs that are touching, but not quite, are candidates too
+        self.pairs = self.neighbors.update(positions, velocities, radii * (1 + CONTACT_TOLERANCE), dt)
+        self.predict(positions, velocities, radii, 0.0, dt, *self.pairs)
+
+        done = 0.0
+        collisions = []
+        while True:
+            event = self.pop(dt)
+            if event is None:
+                break
+            time, i, j = event
+            if time > done:
+                self._step(nbody, integrator, done, time, dt, names, collisions, restitution)
+                done = time
+
+            # where the integrator put them, rather than the straight lines
+            displacement = positions[i] - positions[j]
+            distance = numpy.sqrt(displacement.dot(displacement))
+            radius_sum = radii[i] + radii[j]
+            closing = -displacement.dot(velocities[i] - velocities[j]) / distance
+            if closing <= 0:
+                continue  # moving apart, they missed
+            if distance - radius_sum > CONTACT_TOLERANCE * radius_sum:
+                self.predict(positions, velocities, radii, done, dt, numpy.array([i]), numpy.array([j]))
+                continue
+            if closing < RESTING_SPEED:
+                continue  # resting on each other, the next step takes care of them
+
+            # they've hit
+            self._release(nbody, names, i, j)
+            normal = displacement[numpy.newaxis] / distance
+            tangent = numpy.column_stack((-normal[:, 1], normal[:, 0]))
+            pair_first, pair_second = numpy.array([i]), numpy.array([j])
+            velocity_first, velocity_second = respond(velocities, nbody.masses, pair_first, pair_second,
+                                                      normal, tangent, restitution)
+            velocities[i] = velocity_first[0]
+            velocities[j] = velocity_second[0]
+            collisions.append((i, j, time))
+            self._collided(nbody, numpy.array([i, j]), done, dt)
+
+        if done < dt:
+            self._step(nbody, integrator, done, dt, dt, names, collisions, restitution)
+        return collisions
+
+    def _step(self, nbody, integrator, done, until, tick, names, collisions, restitution):
+        """Steps the integrator from done to until, stopping at every burnout on the way so no
+        step has an engine cutting out in the middle of it (see corbit.burns). Then separates the
+        candidate pairs the integrator left overlapping, adding any that hit to collisions
+        :param done: how far into the tick nbody.time is, in s
+        :param until: how far into the tick to step to, in s
+        :param tick: length of the tick, in s
+        """
+        end = nbody.time + (until - done)
+        for stop in nbody.burns.burnouts(nbody.time, end) + [end]:
+            step = stop - nbody.time
+            rest, normals, pushes = self._resting(nbody, step)
+            external = nbody.external
+            if len(rest):
+                nbody.external = external.copy()
+                self._push(nbody, rest, normals, pushes)
+            try:
+                integrator.step(nbody, step)
+            finally:
+                nbody.external = external
+            nbody.advance_clock(step)
+            self._hold(nbody, rest, normals, pushes, step)
+            self.steps += 1
+        self._separate(nbody, until, tick, names, collisions, restitution)
+
+    def _resting(self, nbody, dt):
+        """The candidate pairs that are resting on each other for the next step, see resting()
+        :return: (rest, normals, pushes) like resting() gives
+        """
+        first, second = self.pairs
+        if not len(first):
+            return numpy.zeros(0, dtype=numpy.intp), numpy.zeros((0, 2)), numpy.zeros(0)
+        rows = numpy.unique(numpy.concatenate(self.pairs))
+        accelerations = numpy.zeros((len(nbody), 2))
+        accelerations[rows] = nbody.accelerations_at(nbody.positions, targets=rows)
+        # bodies on rails come out of accelerations_at with none, but they're still falling
+        pinned = rows[nbody.pinned()[rows]]
+        if len(pinned):
+            accelerations[pinned] = nbody.gravity_at(nbody.positions, targets=pinned)
+        return resting(nbody.positions, nbody.velocities, accelerations, nbody.radii, first, second, dt)
+
+    def _push(self, nbody, rest, normals, pushes):
+        """Adds the ground's push on pairs resting on each other to nbody.external, shared out so
+        the lighter body gets more of it and momentum is kept
+        :param rest: indices into self.pairs, from _resting()
+        :param normals: their normals
+        :param pushes: how hard the ground pushes them apart, in m/s/s
+        """
+        first, second = self.pairs[0][rest], self.pairs[1][rest]
+        inverse_masses = self._inverse_masses(nbody)
+        totals = inverse_masses[first] + inverse_masses[second]
+        movable = totals > 0
+        accelerations = normals[movable] * (pushes[movable] / totals[movable])[:, numpy.newaxis]
+        numpy.add.at(nbody.external, first[movable], accelerations * inverse_masses[first[movable], numpy.newaxis])
+        numpy.add.at(nbody.external, second[movable], -accelerations * inverse_masses[second[movable], numpy.newaxis])
+
+    def _hold(self, nbody, rest, normals, pushes, dt):
+        """Puts the pairs that were resting on each other at the start of a step back in contact,
+        with their relative speed along the normal taken out, wherever the integrator left them,
+        and applies friction
+        :param rest: indices into self.pairs, from _resting() before the step
+        :param normals: their normals from before the step
+        :param pushes: how hard the ground pushed them apart, in m/s/s
+        :param dt: length of the step, in s
+        """
+        first, second = self.pairs[0][rest], self.pairs[1][rest]
+        inverse_masses = self._inverse_masses(nbody)
+        movable = (inverse_masses[first] > 0) | (inverse_masses[second] > 0)
+        first, second, normals, pushes = first[movable], second[movable], normals[movable], pushes[movable]
+        if not len(first):
+            return
+        displacements = nbody.positions[first] - nbody.positions[second]
+        distances = numpy.sqrt(numpy.einsum("ij,ij->i", displacements, displacements))
+        after = displacements / distances[:, numpy.newaxis]
+        # a big enough step can take one right through the other, and out the far side
+        through = numpy.einsum("ij,ij->i", after, normals) <= 0
+        after[through] = normals[through]
+        gaps = numpy.einsum("ij,ij->i", displacements, after) - (nbody.radii[first] + nbody.radii[second])
+        make_contact(nbody.positions, nbody.velocities, inverse_masses, first, second, after, gaps,
+                     numpy.zeros(len(first)))
+        rub(nbody.velocities, inverse_masses, first, second, after, FRICTION * pushes * dt)
+
+    def _separate(self, nbody, now, tick, names, collisions, restitution):
+        """Pushes apart the candidate pairs that overlap, after a step. Those closing in faster than
+        RESTING_SPEED have collided, the rest just stop closing in
+        :param now: time into the tick, in s
+        :param tick: length of the tick, in s
+        """
+        first, second = self.pairs
+        if not len(first):
+            return
+        displacements = nbody.positions[first] - nbody.positions[second]
+        distances = numpy.sqrt(numpy.einsum("ij,ij->i", displacements, displacements))
+        gaps = distances - (nbody.radii[first] + nbody.radii[second])
+        inverse_masses = self._inverse_masses(nbody)
+        overlap = numpy.flatnonzero((gaps < 0) & (distances > 0) &
+                                    ((inverse_masses[first] > 0) | (inverse_masses[second] > 0)))
+        if not len(overlap):
+            return
+        first, second, gaps = first[overlap], second[overlap], gaps[overlap]
+        normals = displacements[overlap] / distances[overlap, numpy.newaxis]
+        normal_speeds = numpy.einsum("ij,ij->i", normals, nbody.velocities[first] - nbody.velocities[second])
+        hit = normal_speeds <= -RESTING_SPEED
+        # bounce the ones that hit, stop the rest closing in, and leave ones moving apart to it
+        new_speeds = numpy.where(hit, -restitution * normal_speeds, numpy.maximum(normal_speeds, 0))
+        for i, j in zip(first[hit], second[hit]):
+            self._release(nbody, names, i, j)
+        make_contact(nbody.positions, nbody.velocities, inverse_masses, first, second, normals, gaps, new_speeds)
+        for i, j in zip(first[hit], second[hit]):
+            collisions.append((i, j, now))
+        if hit.any():
+            self._collided(nbody, numpy.unique(numpy.concatenate((first[hit], second[hit]))), now, tick)
+
+    def _collided(self, nbody, bodies, now, tick):
+        """Makes the queued events of bodies whose velocities a collision changed stale, and
+        predicts theirs again for the rest of the tick"""
+        self.versions[bodies] += 1
+        if now >= tick:
+            return
+        positions, velocities, radii = nbody.positions, nbody.velocities, nbody.radii
+        new_first, new_second = pairs_with(bodies, positions, velocities, radii, tick - now)
+        self.predict(positions, velocities, radii, now, tick, new_first, new_second)
+        # and check them for touching too, from now on
+        n = len(nbody)
+        first = numpy.concatenate((self.pairs[0], new_first))
+        second = numpy.concatenate((self.pairs[1], new_second))
+        keep = numpy.unique(first * n + second, return_index=True)[1]
+        self.pairs = (first[keep], second[keep])
+
+    @staticmethod
+    def _inverse_masses(nbody):
+        """:return: (n,) array of 1 / mass, 0 for bodies on rails or the ephemeris, which collisions
+        mustn't move (until they're released)"""
+        with numpy.errstate(divide="ignore"):
+            inverse_masses = 1 / nbody.masses
+        inverse_masses[nbody.pinned() | ~numpy.isfinite(inverse_masses)] = 0
+        return inverse_masses
+
+    @staticmethod
+    def _release(nbody, names, i, j):
+        """Bodies that collide come off the rails or ephemeris, if they were on them"""
+        collided = [names[i], names[j]]
+        nbody.rails.release(collided)
+        if nbody.ephemeris is not None:
+            nbody.ephemeris.release(collided)
@@ -0,0 +1,142 @@
+"""Close encounters: pairs of bodies so close together that their pull on each other is too much for
+the integrator's step.
+
+When the habitat swings past the Moon, the Moon's pull on it shoots up, and an integrator that
+takes the same step for everything either goes wrong or has to take tiny steps for the whole
+system. Regularized wraps an integrator and takes such pairs out of its hands: the relative motion
+of each close pair is moved along its two-body orbit exactly, with corbit.kepler, and the wrapped
+integrator only sees what's left, the pair's center of mass moving through everything else's
+gravity, plus the (small) difference in how hard everything else pulls on the two. It's the same
+split the Wisdom-Holman integrator makes for every body and its primary, done just for the pairs
+that need it. See Chambers 1999, MNRAS 304 p793, for a symplectic integrator that switches like this.
+
+A pair is a close encounter for a step when the step is longer than ENCOUNTER_STEP times its
+dynamical time sqrt(r^3 / G(M + m)), and the lighter body is inside the heavier one's sphere of
+influence, so that the two really are mostly pulling on each other. That's checked every step, so
+encounters switch on and off by themselves. The heavier body is the center of the pair. A center
+can have any number of test particles around it, but a body in a pair with another massive body
+isn't in any other pair.
+"""
+import numpy
+
+import corbit.gravity
+from corbit import collision
+from corbit import kepler
+
+ENCOUNTER_STEP = 0.03
+
+
+class Regularized:
+    """Wraps an integrator (see corbit.integrators) so close encounters are solved analytically.
+    Anything it doesn't have, like name, adaptive or substeps, comes from the wrapped integrator.
+
+        integrator = corbit.encounters.Regularized(corbit.integrators.create("leapfrog"))
+        integrator.step(nbody, 3600)
+
+    After each call to step(), self.centers and self.satellites are the NBody rows of the pairs
+    that were close encounters in it, and self.encounters counts pairs over all the steps so far.
+    """
+
+    def __init__(self, integrator):
+        self.integrator = integrator
+        self.centers = numpy.zeros(0, dtype=numpy.intp)
+        self.satellites = numpy.zeros(0, dtype=numpy.intp)
+        self.encounters = 0
+
+    def __getattr__(self, name):
+        # only called for attributes we don't have ourselves
+        return getattr(self.integrator, name)
+
+    def step(self, nbody, dt):
+        """Advances nbody.positions and nbody.velocities in place, like Integrator.step"""
+        centers, satellites = self.centers, self.satellites = self.find(nbody, dt)
+        if not len(centers):
+            self.integrator.step(nbody, dt)
+            return
+        self.encounters += len(centers)
+        # test particles don't pull their center along, so it stays put in their pair's Kepler drift
+        satellite_masses = nbody.masses[satellites] * nbody.massive[satellites]
+        mu = corbit.gravity.G * (nbody.masses[centers] + satellite_masses)
+        weights = (satellite_masses / (nbody.masses[centers] + satellite_masses))[:, numpy.newaxis]
+
+        self._drift(nbody, centers, satellites, mu, weights, dt / 2)
+
+        # everything else, with both bodies of each pair moving at the pair's center of mass velocity
+        v = nbody.velocities
+        relative_velocities = v[satellites] - v[centers]
+        v[centers] = v[satellites] = v[centers] + weights * relative_velocities
+        nbody.excluded = (centers, satellites)
+        try:
+            self.integrator.step(nbody, dt)
+        finally:
+            nbody.excluded = None
+        # the rest of the system pulls on the two a little differently, which changes their relative velocity
+        relative_velocities += v[satellites] - v[centers]
+        center_of_mass = v[centers] + weights * (v[satellites] - v[centers])
+        v[centers] = center_of_mass - weights * relative_velocities
+        v[satellites] = center_of_mass + (1 - weights) * relative_velocities
+
+        self._drift(nbody, centers, satellites, mu, weights, dt / 2)
+
+    def find(self, nbody, dt):
+        """The close encounters for a step of length dt, with the bodies where they are now
+        :return: (centers, satellites) arrays of NBody rows, one entry per pair
+        """
+        none = numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0, dtype=numpy.intp)
+        if dt <= 0 or len(nbody) < 2:
+            return none
+        parent = nbody.primaries()
+        massive = nbody.massive
+        # how close something has to be to each massive body for the step to be too long
+        reach = numpy.zeros(len(nbody))
+        reach[massive] = numpy.minimum(
+            numpy.cbrt(corbit.gravity.G * nbody.masses[massive] * (dt / ENCOUNTER_STEP) ** 2),
+            nbody.hierarchy.soi[massive])
+        first, second = collision.overlapping_pairs(nbody.positions - reach[:, numpy.newaxis],
+                                                    nbody.positions + reach[:, numpy.newaxis])
+        if not len(first):
+            return none
+
+        # the heavier one of each pair is its center
+        swap = ((nbody.masses[second] > nbody.masses[first]) & massive[second]) | ~massive[first]
+        centers = numpy.where(swap, second, first)
+        satellites = numpy.where(swap, first, second)
+        separations = nbody.positions[satellites] - nbody.positions[centers]
+        distances = numpy.sqrt(numpy.einsum("ij,ij->i", separations, separations))
+        keep = massive[centers] & (distances < reach[centers]) & (distances > 0)
+        pinned = nbody.pinned()
+        keep &= ~pinned[centers] & ~pinned[satellites]
+        if self.integrator.hierarchical:
+            # the integrator already moves bodies around their primaries on Kepler orbits
+            keep &= parent[satellites] != centers
+        centers, satellites, distances = centers[keep], satellites[keep], distances[keep]
+
+        # strongest pull first, and each body goes in one pair at most, except test particles
+        # can share a center that isn't in a pair with anything massive
+        order = numpy.argsort(-nbody.masses[centers] / distances ** 2, kind="mergesort")
+        role = numpy.zeros(len(nbody), dtype=numpy.int8)  # 1 for centers, 2 satellites, 3 in a massive pair
+        chosen = []
+        for k in order:
+            c, s = centers[k], satellites[k]
+            if role[s] or role[c] > 1 or massive[s] and role[c]:
+                continue
+            role[c] = 3 if massive[s] else 1
+            role[s] = 3 if massive[s] else 2
+            chosen.append(k)
+        chosen = numpy.array(sorted(chosen), dtype=numpy.intp)
+        return centers[chosen], satellites[chosen]
+
+    @staticmethod
+    def _drift(nbody, centers, satellites, mu, weights, dt):
+        """Moves each pair along its two-body orbit for dt, keeping its center of mass where it is"""
+        x = nbody.positions
+        v = nbody.velocities
+        relative_positions = x[satellites] - x[centers]
+        relative_velocities = v[satellites] - v[centers]
+        position = x[centers] + weights * relative_positions
+        velocity = v[centers] + weights * relative_velocities
+        relative_positions, relative_velocities = kepler.propagate(relative_positions, relative_velocities, mu, dt)
+        x[centers] = position - weights * relative_positions
+        x[satellites] = position + (1 - weights) * relative_positions
+        v[centers] = velocity - weights * relative_velocities
+        v[satellites] = velocity + (1 - weights) * relative_velocities
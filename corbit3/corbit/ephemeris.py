@@ -0,0 +1,194 @@
+"""Precomputed ephemerides: where the natural bodies will be, worked out once and then looked up.
+
+build_ephemeris.py runs the simulation for a while and fits each body's position with piecewise
+Chebyshev polynomials, the way the JPL ephemerides do it. Looking a body up at any time is then
+one polynomial evaluation, whatever the time acceleration. The server can drive bodies from an
+ephemeris instead of integrating them (the "ephemeris" scenario setting), the same way it does for
+bodies on rails (see corbit.rails), except that the positions are the full N-body ones, with every
+perturbation that was in the simulation that made them.
+
+File format, all little-endian:
+
+    8 bytes   MAGIC
+    4 bytes   uint32 format version, VERSION
+    4 bytes   uint32 length of the JSON header, which is padded with spaces to a multiple of 8 bytes
+    the JSON header
+    float64 Chebyshev coefficients, shape (segments, 2, degree + 1)
+
+The header has "start" and "end", the times covered in s of simulation time since the scenario was
+loaded, "degree" of the polynomials, "scenario", the file it was made from, and "bodies", a list
+of {"name", "first segment", "segments", "segment length" (s), "max error" (m)}. A body's segments
+are consecutive, each one covers segment length seconds from start, and the coefficients are for
+x and y over the segment mapped onto [-1, 1]. The coefficients are memory-mapped, not read in.
+"""
+import json
+import struct
+
+import numpy
+import numpy.polynomial.chebyshev as chebyshev
+
+MAGIC = b"CORBEPH\0"
+VERSION = 1
+_PREFIX = struct.Struct("<8sII")
+
+
+def fit(positions, degree):
+    """Fits one segment
+    :param positions: (k, 2) array of positions at k equally spaced times over the segment, ends included
+    :param degree: of the polynomials, less than k
+    :return: ((2, degree + 1) array of coefficients, largest distance between a sample and the fit in m)
+    """
+    tau = numpy.linspace(-1, 1, len(positions))
+    coefficients = chebyshev.chebfit(tau, positions, degree)  # (degree + 1, 2)
+    residuals = chebyshev.chebval(tau, coefficients).T - positions
+    return coefficients.T, numpy.sqrt(numpy.einsum("ij,ij->i", residuals, residuals)).max()
+
+
+def write(filename, start, end, degree, bodies, coefficients, scenario=""):
+    """Writes an ephemeris file
+    :param start: first time covered, in s
+    :param end: last time covered, in s
+    :param degree: of the polynomials
+    :param bodies: list of dicts, see the module docstring
+    :param coefficients: (segments, 2, degree + 1) array, the bodies' segments one after the other
+    :param scenario: name of the scenario file the ephemeris was made from
+    """
+    header = json.dumps({"start": start, "end": end, "degree": degree, "scenario": scenario,
+                         "bodies": bodies}).encode("utf-8")
+    header += b" " * (-len(header) % 8)
+    with open(filename, "wb") as out:
+        out.write(_PREFIX.pack(MAGIC, VERSION, len(header)))
+        out.write(header)
+        out.write(numpy.ascontiguousarray(coefficients, dtype="<f8").tobytes())
+
+
+class Ephemeris:
+    """An ephemeris file, opened for lookups. Can also drive rows of a corbit.gravity.NBody, like
+    corbit.rails.Rails does"""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as ephemeris_file:
+            magic, version, header_length = _PREFIX.unpack(ephemeris_file.read(_PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError(filename + " is not a corbit ephemeris")
+            if version != VERSION:
+                raise ValueError(filename + " is ephemeris format version " + str(version) +
+                                 ", this version of corbit reads " + str(VERSION))
+            header = json.loads(ephemeris_file.read(header_length).decode("utf-8"))
+        self.filename = filename
+        self.start = header["start"]
+        self.end = header["end"]
+        self.degree = header["degree"]
+        self.scenario = header["scenario"]
+        self.bodies = header["bodies"]
+        self.names = [body["name"] for body in self.bodies]
+        self.first_segments = numpy.array([body["first segment"] for body in self.bodies], dtype=numpy.intp)
+        self.segment_counts = numpy.array([body["segments"] for body in self.bodies], dtype=numpy.intp)
+        self.segment_lengths = numpy.array([body["segment length"] for body in self.bodies], dtype=numpy.float64)
+        self.coefficients = numpy.memmap(filename, dtype="<f8", mode="r", offset=_PREFIX.size + header_length,
+                                         shape=(int(self.segment_counts.sum()), 2, self.degree + 1))
+        # which of our bodies drive which NBody rows, see attach()
+        self.bodies_used = numpy.zeros(0, dtype=numpy.intp)
+        self.indices = numpy.zeros(0, dtype=numpy.intp)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def covers(self, time):
+        return self.start <= time <= self.end
+
+    def at(self, time, bodies=None):
+        """Positions and velocities of bodies at a time. Times outside the ephemeris get extrapolated
+        from the first or last segment, which goes bad quickly
+        :param time: in s
+        :param bodies: optional array of body numbers (their order in the file), default all of them
+        :return: ((n, 2) array of positions in m, (n, 2) array of velocities in m/s)
+        """
+        if bodies is None:
+            bodies = numpy.arange(len(self.bodies))
+        lengths = self.segment_lengths[bodies]
+        segment = numpy.clip(numpy.floor((time - self.start) / lengths).astype(numpy.intp),
+                             0, self.segment_counts[bodies] - 1)
+        tau = 2 * (time - self.start - segment * lengths) / lengths - 1
+        coefficients = numpy.asarray(self.coefficients[self.first_segments[bodies] + segment])  # (n, 2, degree + 1)
+        positions = _clenshaw(coefficients, tau)
+        velocities = _clenshaw(chebyshev.chebder(coefficients, axis=2), tau) * (2 / lengths)[:, numpy.newaxis]
+        return positions, velocities
+
+    def attach(self, entities, nbody, tolerance=1.0):
+        """Drives the rows of the entities that are in the ephemeris from it from now on. An entity
+        that isn't where the ephemeris says it should be at nbody.time, give or take its max fit error
+        times 10 plus tolerance, is left alone: the ephemeris was probably made from another scenario
+        :param entities: list of entities that was gathered into nbody
+        :param nbody: the NBody, with the entities gathered
+        :param tolerance: in m
+        """
+        rows = {entity.name: i for i, entity in enumerate(entities)}
+        used = numpy.array([b for b, name in enumerate(self.names) if name in rows], dtype=numpy.intp)
+        indices = numpy.array([rows[self.names[b]] for b in used], dtype=numpy.intp)
+        if len(used):
+            positions, velocities = self.at(nbody.time, used)
+            errors = numpy.sqrt(numpy.einsum("ij,ij->i", positions - nbody.positions[indices],
+                                             positions - nbody.positions[indices]))
+            limits = numpy.array([10 * self.bodies[b]["max error"] for b in used]) + tolerance
+            for b in used[errors > limits]:
+                print(self.names[b], "isn't where", self.filename, "has it, so it's integrated instead")
+            used = used[errors <= limits]
+            indices = indices[errors <= limits]
+        self.bodies_used = used
+        self.indices = indices
+
+    def pinned(self, size):
+        """:return: (size,) bool array, True for the NBody rows the ephemeris drives"""
+        mask = numpy.zeros(size, dtype=bool)
+        mask[self.indices] = True
+        return mask
+
+    def place(self, time, positions, velocities=None):
+        """Moves the rows the ephemeris drives to where it has them at a time
+        :param time: simulation time, in s
+        :param positions: (n, 2) array of positions to change in place
+        :param velocities: optional (n, 2) array of velocities to change in place too
+        """
+        if not len(self):
+            return
+        ephemeris_positions, ephemeris_velocities = self.at(time, self.bodies_used)
+        positions[self.indices] = ephemeris_positions
+        if velocities is not None:
+            velocities[self.indices] = ephemeris_velocities
+
+    def release(self, names, reason="collision"):
+        """Stops driving bodies, they get integrated from now on
+        :param names: names of the bodies, ones we aren't driving are ignored
+        """
+        keep = numpy.array([self.names[b] not in names for b in self.bodies_used], dtype=bool)
+        for b in self.bodies_used[~keep]:
+            print(self.names[b], "is off the ephemeris:", reason)
+        self.bodies_used = self.bodies_used[keep]
+        self.indices = self.indices[keep]
+
+    def check(self, nbody, dt):
+        """Releases everything if the next step of length dt would run past the end of the ephemeris,
+        and anything with thrust. Call once a tick, after gathering"""
+        if not len(self):
+            return
+        if not self.covers(nbody.time + dt):
+            self.release([self.names[b] for b in self.bodies_used], "past the end of " + self.filename)
+            return
+        thrusting = nbody.thrusting()[self.indices]
+        if thrusting.any():
+            self.release([self.names[b] for b in self.bodies_used[thrusting]], "thrust")
+
+
+def _clenshaw(coefficients, tau):
+    """Sums Chebyshev series, one per row
+    :param coefficients: (n, 2, k) array
+    :param tau: (n,) array of where to evaluate each row's series, in [-1, 1]
+    :return: (n, 2) array
+    """
+    x = tau[:, numpy.newaxis]
+    b1 = numpy.zeros(coefficients.shape[:2])
+    b2 = numpy.zeros(coefficients.shape[:2])
+    for j in range(coefficients.shape[2] - 1, 0, -1):
+        b1, b2 = coefficients[:, :, j] + 2 * x * b1 - b2, b1
+    return coefficients[:, :, 0] + x * b1 - b2
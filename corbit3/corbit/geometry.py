@@ -0,0 +1,108 @@
+"""Pairwise geometry between entities, worked out once and shared.
+
+The functions in corbit.physics all start from the same few things about a pair of entities: the
+separation between them, its length and direction, and their relative velocity. The HUD asks for
+altitude, speed, orbital speed, periapsis and apoapsis of the same pair every frame, each of which
+used to work them out again, some several times over.
+
+Geometry works them out for a whole EntityStore at once: the first time something asks about an
+entity relative to B, it makes a Frame, which has the separations, distances, unit vectors and
+relative velocities of every row of B's store relative to B's row, as plain SI numpy arrays, and
+hands out Pairs that read from it. Frames are kept by (store, row), not by entity object.
+
+A Frame keeps a copy of the positions and velocities it was made from, and every time it's asked
+for a pair, the two rows are checked against the store's columns. So it's made again after either
+entity moves, however it moved: Entity.move, NBody.scatter and collisions, but also changing the
+arrays in place (entity.displacement[0] = ...), or a row being handed to a different entity (see
+EntityStore.release). Setting a displacement or velocity also bumps corbit.objects.moves, which
+empties the cache altogether, so frames of things that have moved don't pile up. In practice a
+frame lives for one tick on the server, and one frame on the client.
+"""
+import numpy
+
+from corbit import objects
+
+
+class Pair:
+    """The geometry of entity A relative to entity B, in SI units. Row A of a Frame"""
+
+    def __init__(self, frame, row):
+        self.separation = frame.separations[row]  # from B to A
+        self.distance = frame.distances[row]
+        # from B to A. Zero if they're in the same place, there's no direction then
+        self.unit = frame.units[row]
+        self.tangent = frame.tangents[row]  # unit turned 90 degrees anticlockwise
+        self.relative_velocity = frame.relative_velocities[row]  # of A relative to B
+        self.speed = frame.speeds[row]
+        self.orbit = None  # (masses, orbital elements) of A around B, filled in by physics.orbit
+
+
+class Frame:
+    """The geometry of every row of some positions and velocities relative to one of them, as arrays"""
+
+    def __init__(self, positions, velocities, row):
+        """
+        :param positions: (n, 2) array of positions, in m. Copied, so the frame can tell when they change
+        :param velocities: (n, 2) array of velocities, in m/s
+        :param row: the row everything is relative to
+        """
+        self.positions = positions.copy()
+        self.velocities = velocities.copy()
+        self.row = row
+        self.separations = self.positions - self.positions[row]
+        self.distances = numpy.sqrt(numpy.einsum("ij,ij->i", self.separations, self.separations))
+        self.units = numpy.zeros_like(self.separations)
+        apart = self.distances > 0
+        self.units[apart] = self.separations[apart] / self.distances[apart, numpy.newaxis]
+        self.tangents = numpy.column_stack((-self.units[:, 1], self.units[:, 0]))
+        self.relative_velocities = self.velocities - self.velocities[row]
+        self.speeds = numpy.sqrt(numpy.einsum("ij,ij->i", self.relative_velocities, self.relative_velocities))
+        self.pairs = {}  # row -> Pair, made when first asked for
+
+    def pair(self, row):
+        """:return: the Pair of that row relative to self.row"""
+        pair = self.pairs.get(row)
+        if pair is None:
+            pair = self.pairs[row] = Pair(self, row)
+        return pair
+
+    def current(self, positions, velocities, row):
+        """:return: True if that row and self.row are still where they were when the frame was made"""
+        return row < len(self.positions) and \
+            numpy.array_equal(self.positions[row], positions[row]) and \
+            numpy.array_equal(self.velocities[row], velocities[row]) and \
+            numpy.array_equal(self.positions[self.row], positions[self.row]) and \
+            numpy.array_equal(self.velocities[self.row], velocities[self.row])
+
+
+class Geometry:
+    """Cache of Frames, one per entity that other entities' geometry is asked for relative to"""
+
+    def __init__(self):
+        # (id(store), row) -> (store, Frame). Keeping the store means its id can't be reused while it's here
+        self.frames = {}
+        self.moves = objects.moves  # what objects.moves was when the cache was last emptied
+        self.hits = 0  # for benchmarks
+        self.misses = 0
+
+    def between(self, A, B):
+        """:return: the Pair of A relative to B"""
+        if self.moves != objects.moves:
+            self.frames = {}
+            self.moves = objects.moves
+        store = B.store
+        if A.store is not store:
+            # not worth a frame of either store, just the two of them
+            self.misses += 1
+            frame = Frame(numpy.array([A.store.positions[A.row], store.positions[B.row]]),
+                          numpy.array([A.store.velocities[A.row], store.velocities[B.row]]), 1)
+            return frame.pair(0)
+        key = (id(store), B.row)
+        cached = self.frames.get(key)
+        if cached is not None and cached[1].current(store.positions, store.velocities, A.row):
+            self.hits += 1
+            return cached[1].pair(A.row)
+        self.misses += 1
+        frame = Frame(store.positions[:len(store)], store.velocities[:len(store)], B.row)
+        self.frames[key] = store, frame
+        return frame.pair(A.row)
@@ -0,0 +1,353 @@
+"""Vectorized N-body gravity.
+
+Instead of calling physics.gravitational_force once per pair of entities, the state of every
+entity is copied into contiguous float64 arrays (positions, velocities, masses) and all the
+pairwise accelerations are worked out in one broadcasted numpy pass.
+
+Entities flagged as test particles (Entity.test_particle) are only targets, never sources: they
+feel the massive entities but nothing feels them, so gravity costs O(N * N_massive) instead of
+O(N^2). That's the restricted N-body problem, and it's how we afford thousands of spacecraft and
+bits of debris on top of the planets.
+
+Accuracy: for every body, the acceleration computed here agrees with the old per-pair loop
+(physics.gravitational_force + Entity.accelerate, see reference_accelerations) to within
+TOLERANCE times the sum of the magnitudes of the individual pair accelerations on that body.
+The only differences are floating point rounding (we divide by r^3 instead of going through
+atan2/cos/sin) and the order the pair terms are summed in.
+"""
+import numpy
+from unum.units import m, s, kg, N
+
+import corbit.physics
+import corbit.barneshut
+import corbit.rails
+import corbit.burns
+import corbit.hierarchy
+import corbit.objects
+import corbit.store
+from corbit import units
+
+G = units.number(corbit.physics.G, N * m ** 2 / kg ** 2)  # plain float, in SI units
+TOLERANCE = 1e-12
+
+# how many (target, source) pairs we broadcast over at once. This caps the size of the
+# temporary (rows, sources, 2) separation array so big scenarios don't eat all the memory
+BLOCK_PAIRS = 2 ** 20
+
+
+def direct_accelerations(targets, sources, masses, out=None):
+    """Finds the gravitational acceleration on every target from every source, by direct summation
+    :param targets: (n, 2) array of positions to find the acceleration at, in m
+    :param sources: (k, 2) array of positions of the attracting bodies, in m
+    :param masses: (k,) array of masses of the attracting bodies, in kg
+    :param out: optional (n, 2) array to write the result into
+    :return: (n, 2) array of accelerations, in m/s/s
+    A source sitting exactly on a target (i.e. a body and itself) doesn't contribute anything.
+    """
+    targets = numpy.asarray(targets, dtype=numpy.float64)
+    sources = numpy.asarray(sources, dtype=numpy.float64)
+    masses = numpy.asarray(masses, dtype=numpy.float64)
+    if out is None:
+        out = numpy.empty((len(targets), 2))
+
+    rows = max(1, BLOCK_PAIRS // max(len(sources), 1))
+    for start in range(0, len(targets), rows):
+        stop = min(start + rows, len(targets))
+        # separation[i, j] points from target i to source j
+        separation = sources[numpy.newaxis, :, :] - targets[start:stop, numpy.newaxis, :]
+        r_squared = numpy.einsum("ijk,ijk->ij", separation, separation)
+        # a = G * M / r^2 in the direction of r, i.e. G * M * r / |r|^3
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            weight = masses / (r_squared * numpy.sqrt(r_squared))
+        weight[r_squared == 0] = 0
+        numpy.einsum("ij,ijk->ik", weight, separation, out=out[start:stop])
+
+    out *= G
+    return out
+
+
+def dynamical_times(targets, sources, masses):
+    """How fast things change for each target: the shortest sqrt(r^3 / (G M)) over all the sources.
+    That's an orbit's period over 2 pi, around whichever source it would be orbiting fastest. Note
+    it's only the source's mass that counts, so a ship in low orbit gets a short time but the planet
+    it's orbiting doesn't
+    :param targets: (n, 2) array of positions, in m
+    :param sources: (k, 2) array of positions of the attracting bodies, in m
+    :param masses: (k,) array of masses of the attracting bodies, in kg
+    :return: (n,) array of times, in s. Infinite for a target nothing pulls on
+    """
+    targets = numpy.asarray(targets, dtype=numpy.float64)
+    sources = numpy.asarray(sources, dtype=numpy.float64)
+    masses = numpy.asarray(masses, dtype=numpy.float64)
+    shortest = numpy.full(len(targets), numpy.inf)
+
+    rows = max(1, BLOCK_PAIRS // max(len(sources), 1))
+    for start in range(0, len(targets), rows):
+        stop = min(start + rows, len(targets))
+        separation = sources[numpy.newaxis, :, :] - targets[start:stop, numpy.newaxis, :]
+        r_squared = numpy.einsum("ijk,ijk->ij", separation, separation)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            squared_times = r_squared * numpy.sqrt(r_squared) / (G * masses)
+        squared_times[(r_squared == 0) | ~numpy.isfinite(squared_times)] = numpy.inf
+        shortest[start:stop] = squared_times.min(axis=1, initial=numpy.inf)
+    return numpy.sqrt(shortest)
+
+
+def reference_accelerations(entities):
+    """The old way of doing things: accelerations from calling physics.gravitational_force on every
+    pair of entities. Only useful to check the vectorized kernel against, it's slow.
+    This is the full N-body problem, so it ignores Entity.test_particle.
+    :return: (n, 2) array of accelerations, in m/s/s
+    """
+    accelerations = numpy.zeros((len(entities), 2))
+    for i, A in enumerate(entities):
+        for j, B in enumerate(entities[i + 1:], i + 1):
+            gravity = units.number(corbit.physics.gravitational_force(A, B), N)
+            accelerations[i] += gravity / units.number(A.mass(), kg)
+            accelerations[j] -= gravity / units.number(B.mass(), kg)
+    return accelerations
+
+
+class NBody:
+    """Structure-of-arrays copy of the state of a list of entities, used for vectorized gravity and
+    by the integrators in corbit.integrators. Call gather() to copy the entities in, then either
+    apply_gravity() to accelerate them, or step an integrator and scatter() the result back."""
+
+    def __init__(self, solver="direct", opening_angle=0.5):
+        """
+        :param solver: "direct" for direct summation, or "barnes-hut" for big scenarios (see corbit.barneshut)
+        :param opening_angle: accuracy parameter of the Barnes-Hut solver
+        """
+        if solver not in ("direct", "barnes-hut"):
+            raise ValueError("unknown gravity solver " + str(solver))
+        self.solver = solver
+        self.opening_angle = opening_angle
+        self.positions = numpy.zeros((0, 2))
+        self.velocities = numpy.zeros((0, 2))
+        self.masses = numpy.zeros(0)
+        self.radii = numpy.zeros(0)  # for collision detection, see corbit.collision
+        self.massive = numpy.zeros(0, dtype=bool)  # False for test particles
+        self.accelerations = numpy.zeros((0, 2))
+        # non-gravitational accelerations (thrust etc.) the entities had when gathered, held constant over a tick
+        self.external = numpy.zeros((0, 2))
+        self.evaluations = 0  # how many single-body force evaluations have been done, for benchmarks
+        self.time = 0.0  # simulation clock, in s since the scenario was loaded
+        self.rails = corbit.rails.Rails()  # bodies pinned to Kepler orbits instead of being integrated
+        self.burns = corbit.burns.Burns()  # engines firing this tick, part of accelerations_at
+        self.ephemeris = None  # optional corbit.ephemeris.Ephemeris that drives some bodies instead
+        self.hierarchy = corbit.hierarchy.Hierarchy()  # what orbits what, see primaries()
+        # optional (first, second) index arrays of pairs whose pull on each other accelerations_at
+        # leaves out, because something else is taking care of it (see corbit.encounters)
+        self.excluded = None
+
+    def __len__(self):
+        return len(self.masses)
+
+    def resize(self, size):
+        """Reallocates the arrays if the number of bodies changed, otherwise they get reused"""
+        if size != len(self):
+            self.positions = numpy.zeros((size, 2))
+            self.velocities = numpy.zeros((size, 2))
+            self.masses = numpy.zeros(size)
+            self.radii = numpy.zeros(size)
+            self.massive = numpy.zeros(size, dtype=bool)
+            self.accelerations = numpy.zeros((size, 2))
+            self.external = numpy.zeros((size, 2))
+
+    def gather(self, entities):
+        """Copies the positions, velocities, masses, radii and accelerations of the entities into the arrays
+        :param entities: list of entities, row i of every array will be entities[i]
+        """
+        self.resize(len(entities))
+        store, rows = corbit.store.rows_of(entities)
+        if store is not None:
+            # mode="clip" saves take() from copying into a buffer first, but it would quietly gather
+            # the wrong row for a stale entity, so check the rows ourselves, once
+            assert not len(rows) or rows.max() < len(store), "gathering an entity that isn't in its store"
+            assert not store.free or not numpy.isin(rows, store.free).any(), \
+                "gathering an entity whose row was released"
+            # straight out of the store's columns into our arrays, a whole column at a time
+            numpy.take(store.positions, rows, axis=0, out=self.positions, mode="clip")
+            numpy.take(store.velocities, rows, axis=0, out=self.velocities, mode="clip")
+            store.refresh()
+            numpy.take(store.masses, rows, out=self.masses, mode="clip")
+            numpy.take(store.radii, rows, out=self.radii, mode="clip")
+            numpy.take(store.test_particles, rows, out=self.massive, mode="clip")
+            numpy.logical_not(self.massive, out=self.massive)
+            numpy.take(store.accelerations, rows, axis=0, out=self.external, mode="clip")
+        else:
+            for i, entity in enumerate(entities):
+                self.positions[i] = units.number(entity.displacement, m)
+                self.velocities[i] = units.number(entity.velocity, m / s)
+                self.masses[i] = units.number(entity.mass(), kg)
+                self.radii[i] = units.number(entity.radius, m)
+                self.massive[i] = not entity.test_particle
+                self.external[i] = units.number(entity.acceleration, m / s / s)
+        self.burns.gather(entities, self.time)
+
+    def scatter(self, entities, skip=()):
+        """Copies the positions and velocities back into the entities, and clears their accelerations
+        for the next tick like Entity.move does
+        :param entities: the same list of entities that was passed to gather()
+        :param skip: names of entities to leave alone, e.g. because a collision already moved them
+        """
+        store, rows = corbit.store.rows_of(entities)
+        if store is not None:
+            keep = slice(None)
+            if skip:
+                keep = numpy.array([entity.name not in skip for entity in entities], dtype=bool)
+            store.positions[rows[keep]] = self.positions[keep]
+            store.velocities[rows[keep]] = self.velocities[keep]
+            store.accelerations[rows[keep]] = 0
+            corbit.objects.moves += 1  # like setting every entity's displacement would
+        else:
+            for i, entity in enumerate(entities):
+                if entity.name in skip:
+                    continue
+                entity.displacement = units.internal(self.positions[i].copy(), m)
+                entity.velocity = units.internal(self.velocities[i].copy(), m / s)
+                entity.acceleration = units.internal(numpy.zeros(2), m / s / s)
+        self.burns.scatter(self.time)
+
+    def gravity_at(self, positions, out=None, targets=None):
+        """Gravitational acceleration on every body, if the bodies were at the given positions
+        :param positions: (n, 2) array, in m
+        :param out: optional array to write the result into
+        :param targets: optional array of indices of the bodies we want the acceleration of. All the
+        bodies still pull on them, this just saves working out the rest
+        :return: (n, 2) array of accelerations, in m/s/s, or (len(targets), 2) if targets was given
+        """
+        # test particles don't pull on anything, so they're left out of the sources
+        sources, masses = positions, self.masses
+        if not self.massive.all():
+            sources, masses = positions[self.massive], self.masses[self.massive]
+        if targets is not None:
+            positions = positions[targets]
+        self.evaluations += len(positions)
+        if self.solver == "barnes-hut":
+            return corbit.barneshut.accelerations(positions, sources, masses, self.opening_angle, out=out)
+        return direct_accelerations(positions, sources, masses, out=out)
+
+    def accelerations_at(self, positions, out=None, targets=None, offset=0.0):
+        """Total acceleration on every body if they were at the given positions: gravity, plus the
+        non-gravitational accelerations they had when gathered, plus the thrust of the engines
+        that are firing (see corbit.burns). This is what integrators call
+        :param positions: (n, 2) array, in m
+        :param targets: optional array of indices of the only bodies we want the acceleration of
+        :param offset: how far into the step these positions are, in s. Bodies on rails get moved
+        (in place, in positions) to where they are at that time, and get no acceleration since
+        they don't need any. Engine thrust is worked out for that time too, since ships get
+        lighter as they burn
+        :return: (n, 2) array of accelerations, in m/s/s, or (len(targets), 2) if targets was given
+        """
+        if not self.rails and not self.ephemeris:
+            out = self.gravity_at(positions, out=out, targets=targets)
+            out += self.external if targets is None else self.external[targets]
+        else:
+            self.place(self.time + offset, positions)
+            if targets is None:
+                targets = numpy.arange(len(self))
+            if out is None:
+                out = numpy.empty((len(targets), 2))
+            free = ~self.pinned()[targets]
+            out[~free] = 0
+            out[free] = self.gravity_at(positions, targets=targets[free]) + self.external[targets[free]]
+        if self.excluded is not None or len(self.burns):
+            # rows of out that are for each body, -1 for bodies that aren't targets
+            if targets is not None:
+                rows = numpy.full(len(self), -1, dtype=numpy.intp)
+                rows[targets] = numpy.arange(len(targets))
+            else:
+                rows = numpy.arange(len(self))
+            if self.excluded is not None:
+                self._exclude(positions, out, rows)
+            if len(self.burns):
+                self.burns.add_accelerations(self.time, self.time + offset, self.masses, out, rows)
+        return out
+
+    def _exclude(self, positions, out, rows):
+        """Takes the pull of the excluded pairs on each other back out of accelerations"""
+        first, second = self.excluded
+        separations = positions[second] - positions[first]
+        r_squared = numpy.einsum("ij,ij->i", separations, separations)
+        pull = separations * (G / (r_squared * numpy.sqrt(r_squared)))[:, numpy.newaxis]
+        for bodies, others, sign in ((first, second, 1), (second, first, -1)):
+            wanted = rows[bodies] >= 0
+            # test particles don't pull on anything
+            masses = (self.masses[others] * self.massive[others])[wanted, numpy.newaxis]
+            numpy.subtract.at(out, rows[bodies[wanted]], sign * masses * pull[wanted])
+
+    def advance_clock(self, dt):
+        """Moves the clock on after an integrator step, and puts the bodies on rails exactly where
+        they should be at the new time
+        :param dt: length of the step, in s
+        """
+        self.time += dt
+        self.place(self.time, self.positions, self.velocities)
+
+    def primaries(self):
+        """:return: (n,) int array of each body's primary, -1 for the root, brought up to date with
+        the current positions. Cheap to call every step, see corbit.hierarchy.Hierarchy"""
+        return self.hierarchy.update(self.positions, self.masses, self.massive)
+
+    def thrusting(self):
+        """:return: (n,) bool array, True for the bodies with engines firing or any other
+        non-gravitational acceleration this tick"""
+        return numpy.any(self.external != 0, axis=1) | self.burns.firing(len(self))
+
+    def pinned(self):
+        """:return: (n,) bool array, True for the bodies that aren't integrated: on rails or driven
+        by the ephemeris"""
+        mask = self.rails.pinned(len(self))
+        if self.ephemeris is not None:
+            mask |= self.ephemeris.pinned(len(self))
+        return mask
+
+    def place(self, time, positions, velocities=None):
+        """Moves the bodies that aren't integrated to where they are at a time, in place
+        :param time: simulation time, in s
+        :param positions: (n, 2) array of positions
+        :param velocities: optional (n, 2) array of velocities
+        """
+        # the ephemeris first, it usually has the planets the bodies on rails are orbiting
+        if self.ephemeris is not None:
+            self.ephemeris.place(time, positions, velocities)
+        self.rails.place(time, positions, velocities)
+
+    def compute_gravity(self):
+        """Fills self.accelerations with the gravitational acceleration on every body
+        :return: the (n, 2) array of accelerations, in m/s/s
+        """
+        return self.gravity_at(self.positions, out=self.accelerations)
+
+    def energy(self):
+        """Total kinetic plus potential energy of the massive bodies (test particles have no mass
+        as far as gravity is concerned), in J. Integrators should keep this constant
+        """
+        masses = self.masses[self.massive]
+        positions = self.positions[self.massive]
+        kinetic = 0.5 * numpy.sum(masses * numpy.einsum("ij,ij->i", self.velocities[self.massive],
+                                                        self.velocities[self.massive]))
+        potential = 0.0
+        for i in range(len(masses) - 1):
+            distances = numpy.linalg.norm(positions[i + 1:] - positions[i], axis=1)
+            potential -= G * masses[i] * numpy.sum(masses[i + 1:] / distances)
+        return kinetic + potential
+
+    def solver_error(self):
+        """How far off the solver is from direct summation, see corbit.barneshut.error_report
+        :return: dict of error statistics, or None if we are using direct summation anyway, or there
+        aren't two massive bodies to pull on each other
+        """
+        if self.solver == "direct":
+            return None
+        return corbit.barneshut.error_report(self.positions[self.massive], self.masses[self.massive],
+                                             self.opening_angle)
+
+    def apply_gravity(self, entities):
+        """Computes gravity and adds it onto the acceleration of each entity
+        :param entities: the same list of entities that was passed to gather()
+        """
+        self.compute_gravity()
+        for entity, acceleration in zip(entities, self.accelerations):
+            entity.acceleration += units.internal(acceleration, m / s / s)
@@ -0,0 +1,232 @@
+"""Who orbits whom: finds each body's primary from the sphere of influence (SOI) of the massive bodies.
+
+A body's primary is the massive body with the smallest SOI that it sits in. The heaviest body has
+no primary, and its SOI is taken to be infinite, so everything else orbits something. Planets end up
+orbiting the Sun, moons their planet, and ships whatever they happen to be closest to.
+
+primaries() works it out from scratch. Hierarchy keeps it up to date from one tick to the next,
+and is what NBody.hierarchy, the integrators, rails and the client's HUD use.
+"""
+import numpy
+
+SOI_EXPONENT = 0.4  # Laplace's sphere of influence: r_soi = a * (m / M) ** 0.4
+BLOCK_PAIRS = 2 ** 20  # most (body, candidate) pairs Hierarchy looks at in one go, like corbit.gravity.BLOCK_PAIRS
+
+
+def primaries(positions, masses, massive=None):
+    """Finds the primary of every body
+    :param positions: (n, 2) array of positions, in m
+    :param masses: (n,) array of masses, in kg
+    :param massive: optional (n,) bool array of which bodies can be primaries. Test particles can't
+    :return: (n,) int array of the index of each body's primary, -1 for the one at the top
+    """
+    positions = numpy.asarray(positions, dtype=numpy.float64)
+    masses = numpy.asarray(masses, dtype=numpy.float64)
+    n = len(masses)
+    parent = numpy.full(n, -1, dtype=numpy.intp)
+    if massive is None:
+        massive = numpy.ones(n, dtype=bool)
+    candidates = numpy.flatnonzero(massive)
+    if len(candidates) == 0:
+        return parent
+
+    # heaviest first, so a body's own primary is settled by the time we get to its SOI
+    candidates = candidates[numpy.argsort(-masses[candidates], kind="mergesort")]
+    rank = numpy.full(n, len(candidates), dtype=numpy.intp)  # non-candidates come after everything
+    rank[candidates] = numpy.arange(len(candidates))
+
+    root = candidates[0]
+    parent[:] = root
+    parent[root] = -1
+    parent_soi = numpy.full(n, numpy.inf)  # SOI radius of each body's current primary
+    soi = numpy.zeros(n)
+
+    for j in candidates[1:]:
+        p = parent[j]
+        separation = positions[j] - positions[p]
+        soi[j] = numpy.sqrt(separation.dot(separation)) * (masses[j] / masses[p]) ** SOI_EXPONENT
+        offsets = positions - positions[j]
+        inside = numpy.einsum("ij,ij->i", offsets, offsets) < soi[j] ** 2
+        adopt = inside & (soi[j] < parent_soi) & (rank > rank[j])
+        parent[adopt] = j
+        parent_soi[adopt] = soi[j]
+    return parent
+
+
+def levels(parent):
+    """Groups bodies by how deep they are in the tree from primaries()
+    :param parent: (n,) array from primaries()
+    :return: list of index arrays. levels[0] is the bodies with no primary, levels[1] the bodies
+    orbiting those, and so on. Going through them in order always visits a primary before its satellites
+    """
+    parent = numpy.asarray(parent)
+    depth = numpy.zeros(len(parent), dtype=numpy.intp)
+    has_parent = parent >= 0
+    # a tree of n bodies is at most n deep, but in practice this is a handful of passes
+    for i in range(len(parent)):
+        new_depth = numpy.where(has_parent, depth[parent] + 1, 0)
+        if numpy.array_equal(new_depth, depth):
+            break
+        depth = new_depth
+    return [numpy.flatnonzero(depth == d) for d in range(depth.max() + 1 if len(depth) else 0)]
+
+
+class Hierarchy:
+    """primaries(), kept up to date as things move instead of worked out from scratch each time.
+
+    When a body's primary is worked out, we also note its slack: how far it is from the nearest SOI
+    boundary it could cross. That's the edge of its primary's SOI (crossing it means leaving), or
+    the edge of the SOI of one of its primary's other satellites that's heavier than it (crossing
+    means being captured). SOIs nest, a moon's inside its planet's, so those are the only ones that
+    matter. Then every update, for each body, add up how far it has moved relative to its primary
+    and how far any of those boundaries might have moved (travel, kept per primary: the most any
+    of its satellites' SOIs moved or changed size, plus the change in its own SOI). Only bodies
+    whose slack that could have used up get looked at again, so most updates only cost O(n).
+
+    If a massive body changes primary, or the masses change order, everything is worked out again.
+    The statistics are kept in updates, evaluations (bodies looked at again) and rebuilds.
+    """
+
+    def __init__(self):
+        self.parent = numpy.zeros(0, dtype=numpy.intp)
+        self.massive = numpy.zeros(0, dtype=bool)
+        self.candidates = numpy.zeros(0, dtype=numpy.intp)  # bodies that can be primaries, heaviest first
+        self.rank = numpy.zeros(0, dtype=numpy.intp)  # place in candidates, len(candidates) for the rest
+        self.soi = numpy.zeros(0)  # SOI radius of each body, inf for the root and 0 for non-candidates
+        self.relative = numpy.zeros((0, 2))  # position relative to the primary, at the last update
+        self.anchors = numpy.zeros((0, 2))  # position relative to the primary, when last looked at
+        self.slack = numpy.zeros(0)  # distance to the nearest SOI boundary, when last looked at
+        self.travel = numpy.zeros(0)  # per primary, how far the boundaries around its satellites may have moved
+        self.travel_anchors = numpy.zeros(0)  # travel of the primary, when last looked at
+        self._levels = None
+        self.updates = 0
+        self.evaluations = 0
+        self.rebuilds = 0
+
+    def __len__(self):
+        return len(self.parent)
+
+    def primary(self, i):
+        """:return: index of body i's primary, -1 for the root. As of the last update"""
+        return self.parent[i]
+
+    def levels(self):
+        """:return: levels(self.parent), only worked out again when a body changes primary"""
+        if self._levels is None:
+            self._levels = levels(self.parent)
+        return self._levels
+
+    def update(self, positions, masses, massive=None):
+        """Brings the hierarchy up to date with where everything is now
+        :param positions: (n, 2) array of positions, in m
+        :param masses: (n,) array of masses, in kg
+        :param massive: optional (n,) bool array of which bodies can be primaries
+        :return: (n,) int array of each body's primary, like primaries() returns
+        """
+        positions = numpy.asarray(positions, dtype=numpy.float64)
+        masses = numpy.asarray(masses, dtype=numpy.float64)
+        if massive is None:
+            massive = numpy.ones(len(masses), dtype=bool)
+        self.updates += 1
+        candidates = numpy.flatnonzero(massive)
+        candidates = candidates[numpy.argsort(-masses[candidates], kind="mergesort")]
+        if len(masses) != len(self) or not numpy.array_equal(massive, self.massive) or \
+                not numpy.array_equal(candidates, self.candidates):
+            self.rebuild(positions, masses, massive)
+            return self.parent
+
+        # how far the boundaries have moved since the last update
+        parent = self.parent
+        orbiting = parent >= 0
+        primary = numpy.where(orbiting, parent, numpy.arange(len(parent)))
+        relative = positions - positions[primary]
+        soi = self._soi(relative, masses, primary)
+        moved = candidates[orbiting[candidates]]
+        offsets = relative[moved] - self.relative[moved]
+        resized = numpy.abs(soi[moved] - self.soi[moved])
+        bump = numpy.zeros(len(parent))
+        numpy.maximum.at(bump, parent[moved], numpy.sqrt(numpy.einsum("ij,ij->i", offsets, offsets)) + resized)
+        bump[moved] += resized
+        self.travel += bump
+        self.relative = relative
+        self.soi = soi
+
+        # and so which bodies might have crossed one
+        offsets = relative - self.anchors
+        used = numpy.sqrt(numpy.einsum("ij,ij->i", offsets, offsets)) + self.travel[primary] - self.travel_anchors
+        suspects = numpy.flatnonzero(orbiting & (used > self.slack))
+        if len(suspects):
+            old = parent[suspects]
+            self._evaluate(suspects, positions)
+            changed = parent[suspects] != old
+            if changed.any():
+                if massive[suspects[changed]].any():
+                    self.rebuild(positions, masses, massive)
+                else:
+                    self._levels = None
+        return self.parent
+
+    def rebuild(self, positions, masses, massive):
+        """Works the whole hierarchy out from scratch. update() does this when it has to"""
+        self.rebuilds += 1
+        self.parent = primaries(positions, masses, massive)
+        self.massive = massive.copy()
+        self.candidates = numpy.flatnonzero(massive)
+        self.candidates = self.candidates[numpy.argsort(-masses[self.candidates], kind="mergesort")]
+        self.rank = numpy.full(len(masses), len(self.candidates), dtype=numpy.intp)
+        self.rank[self.candidates] = numpy.arange(len(self.candidates))
+        orbiting = self.parent >= 0
+        primary = numpy.where(orbiting, self.parent, numpy.arange(len(masses)))
+        self.relative = positions - positions[primary]
+        self.soi = self._soi(self.relative, masses, primary)
+        self.anchors = self.relative.copy()
+        self.slack = numpy.full(len(masses), numpy.inf)
+        self.travel = numpy.zeros(len(masses))
+        self.travel_anchors = numpy.zeros(len(masses))
+        self._levels = None
+        self._evaluate(numpy.flatnonzero(orbiting), positions)
+
+    def _soi(self, relative, masses, primary):
+        """SOI radius of every candidate, from its position relative to its primary"""
+        soi = numpy.zeros(len(masses))
+        candidates = self.candidates
+        soi[candidates] = numpy.sqrt(numpy.einsum("ij,ij->i", relative[candidates], relative[candidates])) * \
+            (masses[candidates] / masses[primary[candidates]]) ** SOI_EXPONENT
+        if len(candidates):
+            soi[candidates[0]] = numpy.inf
+        return soi
+
+    def _evaluate(self, bodies, positions):
+        """Finds the primaries of some bodies again, and how much slack they have
+        :param bodies: index array, none of them the root
+        """
+        if not len(bodies):
+            return
+        self.evaluations += len(bodies)
+        candidates = self.candidates
+        root = candidates[0]
+        # a block of bodies at a time, so a big scenario doesn't make a huge (bodies, candidates) array
+        block = max(1, BLOCK_PAIRS // max(len(candidates), 1))
+        for start in range(0, len(bodies), block):
+            rows = bodies[start:start + block]
+            offsets = positions[rows, numpy.newaxis] - positions[numpy.newaxis, candidates]
+            distances = numpy.sqrt(numpy.einsum("ijk,ijk->ij", offsets, offsets))
+            heavier = self.rank[candidates][numpy.newaxis] < self.rank[rows, numpy.newaxis]
+            # the smallest SOI the body is in, out of the ones that can be its primary
+            containing = numpy.where(heavier & (distances < self.soi[candidates]), self.soi[candidates], numpy.inf)
+            best = numpy.argmin(containing, axis=1)
+            parent = numpy.where(numpy.isfinite(containing[numpy.arange(len(rows)), best]), candidates[best], root)
+            parent[rows == root] = -1
+            self.parent[rows] = parent
+
+            # the edge of its primary's SOI, or of its primary's other heavier satellites'
+            siblings = heavier & (self.parent[candidates][numpy.newaxis] == parent[:, numpy.newaxis]) & \
+                (candidates[numpy.newaxis] != rows[:, numpy.newaxis])
+            edges = numpy.where(siblings, numpy.abs(distances - self.soi[candidates]), numpy.inf).min(axis=1)
+            primary_offsets = positions[rows] - positions[parent]
+            primary_distances = numpy.sqrt(numpy.einsum("ij,ij->i", primary_offsets, primary_offsets))
+            with numpy.errstate(invalid="ignore"):  # inf - x for bodies orbiting the root
+                self.slack[rows] = numpy.minimum(edges, self.soi[parent] - primary_distances)
+            self.relative[rows] = primary_offsets
+            self.anchors[rows] = primary_offsets
+            self.travel_anchors[rows] = self.travel[parent]
@@ -0,0 +1,511 @@
+"""Integrators, which advance the positions and velocities of every body over one server tick.
+
+An integrator works on the arrays of a corbit.gravity.NBody, and moves nbody.positions and
+nbody.velocities in place. Whenever it needs forces it calls nbody.accelerations_at(positions,
+offset=t), which is gravity at those positions plus whatever non-gravitational acceleration the
+entities had when they were gathered, plus engine thrust (see corbit.burns). t is how far into the
+step the positions are, which is where bodies on rails (see corbit.rails) or driven by an
+ephemeris get put, and how far into their burns the ships are.
+
+Integrators are registered by name, so scenarios and the command line can pick one:
+
+    integrator = corbit.integrators.create("yoshida4")
+    integrator.step(nbody, 3600)
+
+"euler" is what Entity.move has always done. "leapfrog", "verlet" and "yoshida4" are symplectic:
+their energy error stays bounded instead of drifting, so orbits stay put at much bigger time
+steps, which is what the high time acceleration levels need. "wisdom-holman" goes further and
+moves every body along its Kepler orbit around its primary exactly, so only the (small)
+perturbations limit the step. "encke" integrates only how far each body has strayed from a
+reference Kepler orbit, and starts a new reference orbit when that gets too far, which suits long
+cruises at high time acceleration. "dopri5" isn't symplectic, but it controls its error instead,
+taking as many substeps per tick as it has to.
+Run `python3 benchmark.py integrators` to compare them.
+"""
+import numpy
+
+import corbit.gravity
+from corbit import kepler
+
+integrators = {}  # name -> Integrator subclass, filled in by @register
+
+
+def register(name):
+    """Class decorator that makes an Integrator available under a name"""
+    def add(cls):
+        cls.name = name
+        integrators[name] = cls
+        return cls
+    return add
+
+
+def create(name, **options):
+    """Makes a new integrator
+    :param name: the name it was registered under, e.g. "leapfrog"
+    :param options: passed on to the integrator's constructor
+    """
+    if name not in integrators:
+        raise ValueError("unknown integrator " + str(name) + ", pick one of " + ", ".join(sorted(integrators)))
+    return integrators[name](**options)
+
+
+class Integrator:
+    """Base class for integrators"""
+    name = None
+    adaptive = False  # True for integrators that split a step up into as many substeps as they need
+    hierarchical = False  # True for integrators that move every body around its primary on a Kepler orbit
+
+    def step(self, nbody, dt):
+        """Advances nbody.positions and nbody.velocities in place
+        :param nbody: a corbit.gravity.NBody with the entities gathered into it
+        :param dt: length of the step, in s
+        """
+        raise NotImplementedError
+
+
+@register("euler")
+class Euler(Integrator):
+    """Semi-implicit Euler: kick, then drift. First order, and what Entity.move does"""
+
+    def step(self, nbody, dt):
+        nbody.velocities += nbody.accelerations_at(nbody.positions) * dt
+        nbody.positions += nbody.velocities * dt
+
+
+class Composition(Integrator):
+    """Symplectic schemes that alternate drifts (x += c v dt) and kicks (v += d a(x) dt).
+    Subclasses just list the coefficients; drifts has one more entry than kicks"""
+    drifts = ()
+    kicks = ()
+
+    def step(self, nbody, dt):
+        elapsed = 0
+        for drift, kick in zip(self.drifts, self.kicks + (None,)):
+            if drift:
+                nbody.positions += nbody.velocities * (drift * dt)
+                elapsed += drift * dt
+            if kick:
+                nbody.velocities += nbody.accelerations_at(nbody.positions, offset=elapsed) * (kick * dt)
+
+
+@register("leapfrog")
+class Leapfrog(Composition):
+    """Drift-kick-drift leapfrog. Second order, one force evaluation per step"""
+    drifts = (0.5, 0.5)
+    kicks = (1.0,)
+
+
+@register("verlet")
+class VelocityVerlet(Composition):
+    """Kick-drift-kick, a.k.a. velocity Verlet. Second order, two force evaluations per step, but
+    positions and velocities come out at the same time, which is nicer for collisions"""
+    drifts = (0.0, 1.0, 0.0)
+    kicks = (0.5, 0.5)
+
+
+_CUBE_ROOT_2 = 2 ** (1 / 3)
+_W1 = 1 / (2 - _CUBE_ROOT_2)
+_W0 = -_CUBE_ROOT_2 / (2 - _CUBE_ROOT_2)
+
+
+@register("yoshida4")
+class Yoshida4(Composition):
+    """Yoshida's 4th order scheme: three leapfrog steps of length w1, w0, w1 in a row.
+    Three force evaluations per step. See Yoshida 1990, Physics Letters A 150 p262"""
+    drifts = (_W1 / 2, (_W0 + _W1) / 2, (_W0 + _W1) / 2, _W1 / 2)
+    kicks = (_W1, _W0, _W1)
+
+
+@register("wisdom-holman")
+class WisdomHolman(Integrator):
+    """Hierarchical Wisdom-Holman mapping, for systems where everything mostly orbits something.
+
+    Every body is described relative to its primary (see corbit.hierarchy), the Sun for planets,
+    the planet for its moons, and so on. The motion then splits into a Kepler part, each body on a
+    two-body orbit around its primary, which corbit.kepler solves exactly, and a perturbation part,
+    everything else, which is small. A step is half a kick of the perturbations, a Kepler drift, and
+    another half kick. Second order like leapfrog, but the error scales with the size of the
+    perturbations instead of the central force, so moons stay on their orbits at time steps
+    of hours. See Wisdom & Holman 1991, AJ 102 p1528, and Hernandez & Bertschinger 2015 for
+    the hierarchical version.
+
+    The hierarchy is brought up to date at the start of every step (see NBody.primaries), so ships
+    can move from one sphere of influence to another.
+    """
+    hierarchical = True
+
+    def step(self, nbody, dt):
+        parent = nbody.primaries()
+        order = nbody.hierarchy.levels()
+        satellites = numpy.flatnonzero(parent >= 0)
+        primary = parent[satellites]
+        # the primary feels the satellite too, except when the satellite is a test particle
+        mu = corbit.gravity.G * (nbody.masses[primary] + nbody.masses[satellites] * nbody.massive[satellites])
+
+        relative_positions = self._relative(nbody.positions, parent, satellites)
+        relative_velocities = self._relative(nbody.velocities, parent, satellites)
+
+        self._kick(nbody, relative_positions, relative_velocities, parent, satellites, mu, order, dt / 2, 0)
+
+        # top level bodies just coast, everything else goes around its primary
+        roots = order[0]
+        relative_positions[roots] += relative_velocities[roots] * dt
+        if len(satellites):
+            relative_positions[satellites], relative_velocities[satellites] = kepler.propagate(
+                relative_positions[satellites], relative_velocities[satellites], mu, dt)
+        self._absolute(relative_positions, parent, order, nbody.positions)
+
+        self._kick(nbody, relative_positions, relative_velocities, parent, satellites, mu, order, dt / 2, dt)
+        self._absolute(relative_velocities, parent, order, nbody.velocities)
+
+    def _kick(self, nbody, relative_positions, relative_velocities, parent, satellites, mu, order, dt, offset):
+        """Applies everything except the Kepler force, using the absolute positions in nbody.positions"""
+        accelerations = nbody.accelerations_at(nbody.positions, offset=offset)
+        roots = order[0]
+        relative_velocities[roots] += accelerations[roots] * dt
+        if len(satellites):
+            r = relative_positions[satellites]
+            r_cubed = numpy.einsum("ij,ij->i", r, r) ** 1.5
+            # total acceleration relative to the primary, minus the Kepler part (which is -mu r / r^3)
+            perturbation = accelerations[satellites] - accelerations[parent[satellites]] + \
+                (mu / r_cubed)[:, numpy.newaxis] * r
+            # bodies on rails just follow their Kepler orbit
+            perturbation[nbody.pinned()[satellites]] = 0
+            relative_velocities[satellites] += perturbation * dt
+
+    @staticmethod
+    def _relative(vectors, parent, satellites):
+        """Each satellite's vector relative to its primary's. Top level bodies are left alone"""
+        relative = vectors.copy()
+        relative[satellites] -= vectors[parent[satellites]]
+        return relative
+
+    @staticmethod
+    def _absolute(relative, parent, order, out):
+        """The inverse of _relative, working down the tree so primaries are done before their satellites"""
+        out[order[0]] = relative[order[0]]
+        for level in order[1:]:
+            out[level] = out[parent[level]] + relative[level]
+
+
+@register("encke")
+class Encke(Integrator):
+    """Encke's method, for long cruises where the orbits hardly change from one tick to the next.
+
+    Every body is described relative to its primary, like in the Wisdom-Holman mapping, and each
+    satellite gets a reference conic: the Kepler orbit it was on at some epoch, which corbit.kepler
+    gives exactly at any time. What gets integrated is only the deviation from that conic, driven
+    by the difference between the real acceleration and the reference one. The deviation starts out
+    at zero and grows slowly, so a leapfrog step of it stays accurate at time steps that would wreck
+    a plain leapfrog of the whole orbit. When a body's deviation gets to more than rectify times
+    its distance from (or speed relative to) its primary, its conic is rectified: a new one is
+    started from where the body really is, and its deviation goes back to zero. The same happens
+    when it moves to another primary's sphere of influence. See Battin, An Introduction to the
+    Mathematics and Methods of Astrodynamics, 9.3.
+
+    The deviation swings around at the body's orbital frequency, though, so a leapfrog step can
+    only follow it if the step is a small part of an orbit. A body whose step goes further than
+    resolve radians around its orbit (the ship in low orbit at high time acceleration, say) gets a
+    new conic every step, with the first half kick going into the conic instead of into a deviation.
+    That's a Wisdom-Holman step, so those bodies are exactly as accurate as with "wisdom-holman".
+
+    The reference conics are kept from one step to the next. The deviation is worked out again from
+    nbody's arrays at the start of every step, so thrust, collisions and the like just show up as a
+    deviation (and a rectification, if they're big). self.rectifications counts the conics that
+    have been started over.
+    """
+    hierarchical = True
+
+    def __init__(self, rectify=1e-2, resolve=0.1):
+        """
+        :param rectify: biggest deviation from the reference conic, as a fraction of the distance
+        to the primary and of the speed relative to it, before the conic is started over. Battin
+        suggests about 1e-2. Smaller is a little more accurate, but rectifies more often
+        :param resolve: longest step, in radians of a body's orbit (its mean motion times dt),
+        that its deviation gets integrated over. Bodies with longer steps than that are rectified
+        every step
+        """
+        self.rectify = rectify
+        self.resolve = resolve
+        self.satellites = None  # rows the reference conics are for
+        self.primary = None  # and the rows of the primaries they're around
+        self.mu = numpy.zeros(0)
+        # state relative to the primary at each conic's epoch
+        self.epoch_positions = numpy.zeros((0, 2))
+        self.epoch_velocities = numpy.zeros((0, 2))
+        self.epochs = numpy.zeros(0)
+        self.propagator = None  # a kepler.Propagator for the conics, made when first needed
+        self.rectifications = 0
+
+    def step(self, nbody, dt):
+        parent = nbody.primaries()
+        order = nbody.hierarchy.levels()
+        satellites = numpy.flatnonzero(parent >= 0)
+        primary = parent[satellites]
+        roots = order[0]
+        mu = corbit.gravity.G * (nbody.masses[primary] + nbody.masses[satellites] * nbody.massive[satellites])
+
+        relative_positions = WisdomHolman._relative(nbody.positions, parent, satellites)
+        relative_velocities = WisdomHolman._relative(nbody.velocities, parent, satellites)
+        r = relative_positions[satellites]
+        v = relative_velocities[satellites]
+
+        if self.satellites is None or not numpy.array_equal(satellites, self.satellites):
+            # bodies were added or removed, or went in or out of orbit, start everything over
+            self.satellites = satellites
+            self.primary = primary
+            self.mu = mu
+            self.epoch_positions = r.copy()
+            self.epoch_velocities = v.copy()
+            self.epochs = numpy.full(len(satellites), nbody.time)
+            self.propagator = None
+            self.rectifications += len(satellites)
+        reference, reference_velocities = self._reference(nbody.time)
+        deviation = r - reference
+        deviation_velocities = v - reference_velocities
+        unresolved = numpy.sqrt(mu / _norms(r) ** 3) * dt > self.resolve
+        rectify = (primary != self.primary) | unresolved | \
+            (_norms(deviation) > self.rectify * _norms(reference)) | \
+            (_norms(deviation_velocities) > self.rectify * _norms(reference_velocities))
+        if rectify.any():
+            self._rectify(rectify, r, v, mu, nbody.time)
+            self.primary = primary
+            reference[rectify] = r[rectify]
+            reference_velocities[rectify] = v[rectify]
+            deviation[rectify] = 0
+            deviation_velocities[rectify] = 0
+
+        # kick-drift-kick of the top level bodies and the satellites' deviations
+        pinned = nbody.pinned()[satellites]
+        self._kick(nbody, relative_velocities, deviation_velocities, reference, roots, pinned, dt / 2, 0)
+        if unresolved.any():
+            # their conics were just started over, and the kick goes into them too, instead of into
+            # a deviation that the step is too long to follow. Which makes theirs a Wisdom-Holman step
+            self.epoch_velocities[unresolved] += deviation_velocities[unresolved]
+            deviation_velocities[unresolved] = 0
+            self.propagator = None
+        relative_positions[roots] += relative_velocities[roots] * dt
+        deviation += deviation_velocities * dt
+        reference, reference_velocities = self._reference(nbody.time + dt)
+        relative_positions[satellites] = reference + deviation
+        WisdomHolman._absolute(relative_positions, parent, order, nbody.positions)
+
+        self._kick(nbody, relative_velocities, deviation_velocities, reference, roots, pinned, dt / 2, dt)
+        relative_velocities[satellites] = reference_velocities + deviation_velocities
+        WisdomHolman._absolute(relative_velocities, parent, order, nbody.velocities)
+
+    def _reference(self, time):
+        """Positions and velocities on the reference conics at a time, relative to the primaries"""
+        if not len(self.satellites):
+            return numpy.zeros((0, 2)), numpy.zeros((0, 2))
+        if self.propagator is None:
+            self.propagator = kepler.Propagator(self.epoch_positions, self.epoch_velocities, self.mu)
+        return self.propagator.at(time - self.epochs)
+
+    def _rectify(self, rows, positions, velocities, mu, time):
+        """Starts new reference conics, osculating the given relative states at time"""
+        self.epoch_positions[rows] = positions[rows]
+        self.epoch_velocities[rows] = velocities[rows]
+        self.mu[rows] = mu[rows]
+        self.epochs[rows] = time
+        self.propagator = None
+        self.rectifications += int(numpy.count_nonzero(rows))
+
+    def _kick(self, nbody, relative_velocities, deviation_velocities, reference, roots, pinned, dt, offset):
+        """Applies the accelerations at the absolute positions in nbody.positions: all of it to the
+        top level bodies, and to each satellite's deviation, the difference between its acceleration
+        relative to its primary and the Kepler acceleration of the reference conic"""
+        accelerations = nbody.accelerations_at(nbody.positions, offset=offset)
+        relative_velocities[roots] += accelerations[roots] * dt
+        if len(self.satellites):
+            reference_cubed = numpy.einsum("ij,ij->i", reference, reference) ** 1.5
+            difference = accelerations[self.satellites] - accelerations[self.primary] + \
+                (self.mu / reference_cubed)[:, numpy.newaxis] * reference
+            # bodies on rails get put back on their own orbits after the step anyway
+            difference[pinned] = 0
+            deviation_velocities += difference * dt
+
+
+@register("dopri5")
+class DormandPrince(Integrator):
+    """Adaptive Dormand-Prince 5(4) Runge-Kutta, what MATLAB calls ode45.
+
+    Each step also gives a 4th order answer for free, and the difference between the two is an
+    estimate of the error. Steps whose error is over the tolerance are thrown away and retried
+    smaller, and the step size is grown again while things are quiet. So a tick at high time
+    acceleration gets chopped up into however many steps it needs: a few in cruise, lots when
+    something is skimming past a planet. One step size is shared by all the bodies, and the worst
+    one decides it. See Hairer, Norsett & Wanner, Solving Ordinary Differential Equations I, II.4-5.
+
+    After each call to step(), self.substeps and self.rejected say how many internal steps it took
+    and how many it threw away.
+    """
+    adaptive = True
+
+    # Butcher tableau
+    c = (0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1)
+    a = ((),
+         (1 / 5,),
+         (3 / 40, 9 / 40),
+         (44 / 45, -56 / 15, 32 / 9),
+         (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+         (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+         (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84))
+    # 5th order weights are the last row of a, which makes the last stage the first of the next step
+    # (FSAL). These are the 5th order minus the 4th order weights, for the error estimate
+    e = (71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40)
+
+    SAFETY = 0.9
+    MIN_FACTOR = 0.2
+    MAX_FACTOR = 5.0
+
+    def __init__(self, tolerance=1e-10, max_substeps=100000):
+        """
+        :param tolerance: allowed error per step, relative to each body's distance from the origin and speed
+        :param max_substeps: give up on a tick after this many steps, rather than hang the server
+        """
+        self.tolerance = tolerance
+        self.max_substeps = max_substeps
+        self.h = None  # step size that worked last time, in s
+        self.substeps = 0
+        self.rejected = 0
+
+    def step(self, nbody, dt):
+        self.substeps = 0
+        self.rejected = 0
+        if dt == 0:
+            return
+        if self.h is None:
+            self.h = dt
+        x = nbody.positions
+        v = nbody.velocities
+        a = nbody.accelerations_at(x)
+        done = 0
+        while done < dt:
+            if self.substeps >= self.max_substeps:
+                print("dopri5: gave up after", self.substeps, "steps,", dt - done, "s of this tick not simulated")
+                break
+            h = min(self.h, dt - done)
+            new_x, new_v, new_a, error = self._attempt(nbody, x, v, a, done, h)
+            if error <= 1:
+                x[:] = new_x
+                v[:] = new_v
+                a = new_a
+                done += h
+                self.substeps += 1
+            else:
+                self.rejected += 1
+            if error <= 1 and h < self.h:
+                # that was a short step to land exactly on the end of the tick. It says nothing about
+                # how long the next one can be, so keep the step size that worked before it
+                continue
+            # the usual step size controller, for a 4th order error estimate
+            if error == 0:
+                factor = self.MAX_FACTOR
+            else:
+                factor = min(self.MAX_FACTOR, max(self.MIN_FACTOR, self.SAFETY * error ** -0.2))
+            self.h = h * factor
+
+    def _attempt(self, nbody, x, v, a, start, h):
+        """One trial step of length h from (x, v), start seconds into the tick, where the acceleration is a
+        :return: (positions, velocities, accelerations, error) where error <= 1 means it's good enough
+        """
+        kx = [v]  # derivatives of the positions at each stage
+        kv = [a]  # and of the velocities
+        for c, weights in zip(self.c[1:], self.a[1:]):
+            stage_x = x.copy()
+            stage_v = v.copy()
+            for weight, dx, dv in zip(weights, kx, kv):
+                if weight:
+                    stage_x += (h * weight) * dx
+                    stage_v += (h * weight) * dv
+            kx.append(stage_v)
+            kv.append(nbody.accelerations_at(stage_x, offset=start + c * h))
+        # the last stage was evaluated at the 5th order solution
+        new_x = stage_x
+        new_v = stage_v
+        error_x = numpy.zeros_like(x)
+        error_v = numpy.zeros_like(v)
+        for weight, dx, dv in zip(self.e, kx, kv):
+            if weight:
+                error_x += (h * weight) * dx
+                error_v += (h * weight) * dv
+        scale_x = self.tolerance * numpy.maximum(_norms(x), _norms(new_x))
+        scale_v = self.tolerance * numpy.maximum(_norms(v), _norms(new_v))
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            error = max(numpy.nan_to_num(_norms(error_x) / scale_x).max(initial=0),
+                        numpy.nan_to_num(_norms(error_v) / scale_v).max(initial=0))
+        return new_x, new_v, kv[-1], error
+
+
+def _norms(vectors):
+    """Length of each row of an (n, 2) array"""
+    return numpy.sqrt(numpy.einsum("ij,ij->i", vectors, vectors))
+
+
+@register("block")
+class BlockTimesteps(Integrator):
+    """Kick-drift-kick leapfrog where every body gets its own time step.
+
+    Each body's step is the tick divided by a power of two (its level), picked so the step is a
+    small fraction of its dynamical time (see corbit.gravity.dynamical_times). The tick is cut into
+    substeps of the smallest of those steps. Every substep all the bodies drift, but only the ones
+    whose own step ends there (the active block) get their forces worked out and a kick. So Phobos
+    gets kicked every few minutes while Sedna gets kicked once a tick, and the force evaluations go
+    where they're needed. Levels are picked again at the start of every tick.
+    See Makino 1991, PASJ 43 p859, and Springel 2005, MNRAS 364 p1105 for the KDK version.
+
+    After each call to step(), self.substeps says how many substeps the tick was cut into, and
+    self.levels has the level of every body.
+    """
+    adaptive = True
+
+    def __init__(self, accuracy=0.01, max_level=16):
+        """
+        :param accuracy: each body's step is at most this times its dynamical time. 0.01 is about
+        600 steps per orbit
+        :param max_level: no step is shorter than the tick over 2 ** max_level
+        """
+        self.accuracy = accuracy
+        self.max_level = max_level
+        self.substeps = 0
+        self.levels = None
+
+    def assign_levels(self, nbody, dt):
+        """Picks the level of every body, the smallest one that makes its step short enough
+        :return: (n,) int array, a body at level k steps dt / 2 ** k at a time
+        """
+        times = corbit.gravity.dynamical_times(nbody.positions, nbody.positions[nbody.massive],
+                                               nbody.masses[nbody.massive])
+        with numpy.errstate(divide="ignore"):
+            levels = numpy.ceil(numpy.log2(dt / (self.accuracy * times)))
+        levels = numpy.clip(levels, 0, self.max_level).astype(numpy.intp)
+        levels[nbody.pinned()] = 0  # they're not integrated anyway
+        # a satellite's orbit is only as good as its primary's steps: if Mars only got kicked once a
+        # tick, the Sun's pull would yank it away from Phobos a tick at a time. So primaries go at
+        # least as fast as their fastest satellite. Going up the tree from the deepest bodies, so a
+        # ship around the Moon speeds up Earth as well as the Moon, and then the Sun
+        parent = nbody.primaries()
+        for depth in reversed(nbody.hierarchy.levels()[1:]):
+            numpy.maximum.at(levels, parent[depth], levels[depth])
+        return levels
+
+    def step(self, nbody, dt):
+        if len(nbody) == 0:
+            return
+        levels = self.levels = self.assign_levels(nbody, dt)
+        finest = levels.max()
+        self.substeps = 2 ** finest
+        substep = dt / self.substeps
+        stride = 2 ** (finest - levels)  # how many substeps long each body's step is
+        h = (dt / 2.0 ** levels)[:, numpy.newaxis]  # and how long that is in seconds
+
+        x = nbody.positions
+        v = nbody.velocities
+        v += nbody.accelerations_at(x) * (h / 2)
+        for i in range(1, self.substeps + 1):
+            x += v * substep
+            active = numpy.flatnonzero(i % stride == 0)
+            # closing half kick of this step, plus opening half kick of the next one, unless we're done
+            kick = h[active] if i < self.substeps else h[active] / 2
+            v[active] += nbody.accelerations_at(x, targets=active, offset=i * substep) * kick
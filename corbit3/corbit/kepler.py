@@ -0,0 +1,225 @@
+"""Analytic two-body (Kepler) propagation, for many bodies at once.
+
+Uses the universal variable formulation, so the same code handles circles, ellipses, parabolas
+and hyperbolas without special cases. See Curtis, Orbital Mechanics for Engineering Students,
+chapter 3, or Vallado, Fundamentals of Astrodynamics, algorithm 8.
+Everything is plain numpy in SI units, vectorized over the first axis.
+
+elements() goes the other way, from state vectors to the size and shape of the orbits.
+"""
+import numpy
+
+LAGUERRE_ORDER = 5  # Laguerre-Conway iteration, which converges from pretty much anywhere unlike Newton
+MAX_ITERATIONS = 50
+TOLERANCE = 1e-12  # relative, on the universal anomaly
+
+
+def stumpff(z):
+    """The Stumpff functions C(z) and S(z), for an array of z
+    :return: (C, S)
+    """
+    z = numpy.asarray(z, dtype=numpy.float64)
+    if z.size and z.min() >= 1e-3:
+        # all ellipses, far enough along: the usual case, and quicker without the masks
+        root = numpy.sqrt(z)
+        return (1 - numpy.cos(root)) / z, (root - numpy.sin(root)) / (root * z)
+    C = numpy.empty_like(z)
+    S = numpy.empty_like(z)
+    small = numpy.abs(z) < 1e-3
+    elliptic = (z > 0) & ~small
+    hyperbolic = (z < 0) & ~small
+
+    # the closed forms lose all their precision near z = 0, so use the series there
+    zs = z[small]
+    C[small] = 1 / 2 - zs / 24 + zs ** 2 / 720 - zs ** 3 / 40320
+    S[small] = 1 / 6 - zs / 120 + zs ** 2 / 5040 - zs ** 3 / 362880
+
+    root = numpy.sqrt(z[elliptic])
+    C[elliptic] = (1 - numpy.cos(root)) / z[elliptic]
+    S[elliptic] = (root - numpy.sin(root)) / root ** 3
+
+    root = numpy.sqrt(-z[hyperbolic])
+    C[hyperbolic] = (numpy.cosh(root) - 1) / -z[hyperbolic]
+    S[hyperbolic] = (numpy.sinh(root) - root) / root ** 3
+    return C, S
+
+
+def elements(positions, velocities, parents, mu):
+    """Orbital elements of every body around its primary, all in one pass
+    :param positions: (n, 2) array of positions, in m
+    :param velocities: (n, 2) array of velocities, in m/s
+    :param parents: (n,) int array of the index of each body's primary, -1 for none, see
+    corbit.hierarchy.primaries
+    :param mu: gravitational parameter G * (M + m) of each body's orbit, scalar or (n,) array, in m^3/s^2
+    :return: dict of (n,) arrays: "semimajor axis" (m, negative for hyperbolas), "eccentricity",
+    "periapsis" and "apoapsis" (distances from the primary, m, apoapsis is inf for escape orbits),
+    "period" (s, inf for escape orbits) and "true anomaly" (rad, from periapsis in the direction
+    of motion). All nan for bodies with no primary
+    """
+    parents = numpy.asarray(parents)
+    orbiting = parents >= 0
+    primary = numpy.where(orbiting, parents, numpy.arange(len(parents)))
+    r = positions - positions[primary]
+    v = velocities - velocities[primary]
+    mu = numpy.broadcast_to(mu, parents.shape)
+
+    with numpy.errstate(all="ignore"):  # bodies with no primary come out nan, and get overwritten below
+        distance = numpy.sqrt(numpy.einsum("ij,ij->i", r, r))
+        radial = numpy.einsum("ij,ij->i", r, v)  # r . v
+        h = r[:, 0] * v[:, 1] - r[:, 1] * v[:, 0]  # specific angular momentum
+        energy = numpy.einsum("ij,ij->i", v, v) / 2 - mu / distance  # specific orbital energy
+        a = -mu / (2 * energy)
+        e = numpy.sqrt(numpy.maximum(1 + 2 * energy * h ** 2 / mu ** 2, 0))
+        bound = energy < 0
+        period = numpy.where(bound, 2 * numpy.pi * numpy.sqrt(numpy.abs(a) ** 3 / mu), numpy.inf)
+        # e cos(true anomaly) and e sin(true anomaly), straight from the orbit equation and the
+        # radial velocity, which works for any eccentricity and either direction of motion
+        anomaly = numpy.arctan2(radial * numpy.abs(h) / (mu * distance), h ** 2 / (mu * distance) - 1)
+        orbit = {"semimajor axis": a,
+                 "eccentricity": e,
+                 "periapsis": h ** 2 / (mu * (1 + e)),  # a (1 - e), but fine for parabolas too
+                 "apoapsis": numpy.where(bound, a * (1 + e), numpy.inf),
+                 "period": period,
+                 "true anomaly": anomaly}
+    for values in orbit.values():
+        values[~orbiting] = numpy.nan
+    return orbit
+
+
+def propagate(positions, velocities, mu, dt):
+    """Where bodies on two-body orbits will be after some time
+    :param positions: (n, 2) array of positions relative to the central body, in m
+    :param velocities: (n, 2) array of velocities relative to the central body, in m/s
+    :param mu: gravitational parameter G * (M + m) of each orbit, scalar or (n,) array, in m^3/s^2
+    :param dt: time to propagate by, scalar or (n,) array, in s. Can be negative, or many orbits long
+    :return: (positions, velocities) after dt, new (n, 2) arrays
+    """
+    return Propagator(positions, velocities, mu).at(dt)
+
+
+class Propagator:
+    """Propagates the same set of orbits to lots of different times. Everything about the orbits
+    that doesn't depend on the time is worked out once, and each call starts solving Kepler's
+    equation from the answer to the previous call, so calls at nearby times only take an iteration
+    or two. Use this over propagate() when following orbits tick after tick"""
+
+    def __init__(self, positions, velocities, mu):
+        """
+        :param positions: (n, 2) array of positions relative to the central body at the epoch, in m
+        :param velocities: (n, 2) array of velocities relative to the central body at the epoch, in m/s
+        :param mu: gravitational parameter G * (M + m) of each orbit, scalar or (n,) array, in m^3/s^2
+        """
+        self.r0 = numpy.array(positions, dtype=numpy.float64).reshape(-1, 2)
+        self.v0 = numpy.array(velocities, dtype=numpy.float64).reshape(-1, 2)
+        n = len(self.r0)
+        self.mu = numpy.broadcast_to(numpy.asarray(mu, dtype=numpy.float64), (n,)).copy()
+
+        self.r0_norm = numpy.sqrt(numpy.einsum("ij,ij->i", self.r0, self.r0))
+        self.r0_dot_v0 = numpy.einsum("ij,ij->i", self.r0, self.v0)
+        self.sqrt_mu = numpy.sqrt(self.mu)
+        # 1 / semi-major axis, negative for hyperbolas
+        self.alpha = 2 / self.r0_norm - numpy.einsum("ij,ij->i", self.v0, self.v0) / self.mu
+        self.bound = self.alpha > 1e-300
+        self.period = numpy.full(n, numpy.inf)
+        self.period[self.bound] = 2 * numpy.pi / numpy.sqrt(self.mu[self.bound] * self.alpha[self.bound] ** 3)
+        # coefficients of the universal Kepler equation
+        self.a = self.r0_dot_v0 / self.sqrt_mu
+        self.b = 1 - self.alpha * self.r0_norm
+
+        # the last solution, to start the next one from
+        self.last_dt = None
+        self.last_chi = None
+        self.last_r = None
+
+    def __len__(self):
+        return len(self.r0)
+
+    def at(self, dt):
+        """Where the bodies are dt after the epoch
+        :param dt: scalar or (n,) array, in s. Can be negative, or many orbits long
+        :return: (positions, velocities), new (n, 2) arrays
+        """
+        n = len(self)
+        mu = self.mu
+        sqrt_mu = self.sqrt_mu
+        alpha = self.alpha
+        r0_norm = self.r0_norm
+        dt = numpy.broadcast_to(numpy.asarray(dt, dtype=numpy.float64), (n,)).copy()
+
+        # whole orbits don't change anything, so take them off. That keeps the cost and the
+        # accuracy the same no matter how far ahead we propagate
+        bound = self.bound
+        period = self.period[bound]
+        dt[bound] -= period * numpy.round(dt[bound] / period)
+
+        chi = self._first_guess(dt)
+        if self.last_chi is not None:
+            # d chi / dt = sqrt(mu) / r, so step on from the last solution if it's close enough
+            change = dt - self.last_dt
+            close = numpy.abs(change) < self.period / 8
+            chi[close] = self.last_chi[close] + change[close] * sqrt_mu[close] / self.last_r[close]
+
+        a = self.a
+        b = self.b
+        converged = dt == 0
+        chi[converged] = 0
+        for iteration in range(MAX_ITERATIONS):
+            active = numpy.flatnonzero(~converged)
+            if not len(active):
+                break
+            x = chi[active]
+            z = alpha[active] * x ** 2
+            C, S = stumpff(z)
+            # F is the universal Kepler equation, and F' happens to be the distance r
+            F = a[active] * x ** 2 * C + b[active] * x ** 3 * S + r0_norm[active] * x - sqrt_mu[active] * dt[active]
+            dF = a[active] * x * (1 - z * S) + b[active] * x ** 2 * C + r0_norm[active]
+            ddF = a[active] * (1 - z * C) + b[active] * x * (1 - z * S)
+            k = LAGUERRE_ORDER
+            # written in terms of F / F' so nothing overflows for big hyperbolic anomalies
+            ratio = F / dF
+            root = numpy.abs(dF) * numpy.sqrt(numpy.abs((k - 1) ** 2 - k * (k - 1) * ratio * ddF / dF))
+            step = k * F / (dF + numpy.copysign(root, dF))
+            chi[active] = x - step
+            done = numpy.abs(step) <= TOLERANCE * numpy.maximum(numpy.abs(x), 1e-300)
+            converged[active[done]] = True
+
+        z = alpha * chi ** 2
+        C, S = stumpff(z)
+        # Lagrange coefficients
+        f = 1 - chi ** 2 / r0_norm * C
+        g = dt - chi ** 3 / sqrt_mu * S
+        r = f[:, numpy.newaxis] * self.r0 + g[:, numpy.newaxis] * self.v0
+        r_norm = numpy.sqrt(numpy.einsum("ij,ij->i", r, r))
+        f_dot = sqrt_mu / (r_norm * r0_norm) * (alpha * chi ** 3 * S - chi)
+        g_dot = 1 - chi ** 2 / r_norm * C
+        v = f_dot[:, numpy.newaxis] * self.r0 + g_dot[:, numpy.newaxis] * self.v0
+
+        self.last_dt = dt
+        self.last_chi = chi
+        self.last_r = r_norm
+        return r, v
+
+    def _first_guess(self, dt):
+        """A first guess of the universal anomaly chi. Any reasonable guess converges with Laguerre-Conway"""
+        alpha = self.alpha
+        chi = self.sqrt_mu * numpy.abs(alpha) * dt
+        unbound = ~self.bound
+        chi[unbound] = self.sqrt_mu[unbound] * dt[unbound] / self.r0_norm[unbound]
+        # but far out on a hyperbola that guess is way too big, and cosh overflows. Vallado eq 2-59 is better
+        hyperbolic = numpy.flatnonzero(alpha < -1e-300)
+        if len(hyperbolic):
+            h_alpha = alpha[hyperbolic]
+            h_dt = dt[hyperbolic]
+            sign = numpy.sign(h_dt)
+            semi_major = 1 / h_alpha
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                guess = sign * numpy.sqrt(-semi_major) * numpy.log(
+                    -2 * self.mu[hyperbolic] * h_alpha * h_dt /
+                    (self.r0_dot_v0[hyperbolic] + sign * numpy.sqrt(-self.mu[hyperbolic] * semi_major) *
+                     (1 - self.r0_norm[hyperbolic] * h_alpha)))
+            # it can overshoot wildly too though, when the body is already a long way out along a
+            # hyperbola that's nearly a straight line. Laguerre-Conway copes with a guess that's too
+            # small much better than one that's too big, so take whichever is smaller
+            usable = numpy.isfinite(guess) & (numpy.abs(guess) < numpy.abs(chi[hyperbolic]))
+            chi[hyperbolic[usable]] = guess[usable]
+        return chi
@@ -3,6 +3,8 @@ import MySQLdb as msd # msd -> My Sql Db
 import json
 import scipy
 from corbit.objects import Entity, EngineSystem, Habitat
+from corbit.store import EntityStore
+from corbit import units
 from unum.units import kg, m, s, rad
 
 __author__ = 'vac'
@@ -36,15 +38,59 @@ def load_entities(json_object):
     return (color, mass, radius, displacement, velocity, acceleration,
             angular_position, angular_speed, angular_acceleration)
 
+# settings a scenario file can override in its "settings" object, e.g.
+# "settings": {"gravity solver": "barnes-hut", "opening angle": 0.7}
+default_settings = {
+    "gravity solver": "direct",     # "direct" or "barnes-hut", see corbit.gravity.NBody
+    "opening angle": 0.5,           # only used by barnes-hut, smaller is more accurate and slower
+    "integrator": "euler",          # see corbit.integrators.integrators for the choices
+    "on rails": [],                 # names of bodies to pin to Kepler orbits (see corbit.rails), or "auto"
+    "close encounters": True,       # solve close pairs analytically, see corbit.encounters
+    "ephemeris": None               # ephemeris file from build_ephemeris.py to drive bodies from, if any
+}
+
+
 def load_json(input_stream):
     """Given a JSON string or a JSON stream of entities, parses into binary and returns
     :param input_stream: string or stream of Corbit format to parse
     :return: a list of entities
     """
-    entity_guid = 0
+    return load_scenario(input_stream)[0]
+
+
+def load_scenario(input_stream):
+    """Same as load_json, but also returns the scenario's settings
+    :param input_stream: string or stream of Corbit format to parse
+    :return: (list of entities, dict of settings) where the settings are default_settings plus
+    anything the file overrides
+    """
     if isinstance(input_stream, str):  # Converts strings to streams just like that
         input_stream = io.StringIO(input_stream)
     json_root = json.load(input_stream)
+
+    return load_entity_list(json_root), scenario_settings(json_root.get("settings", {}))
+
+
+def scenario_settings(overrides):
+    """:param overrides: dict of the settings a scenario file has
+    :return: dict of settings, default_settings plus the overrides
+    """
+    settings = dict(default_settings)
+    for key, value in overrides.items():
+        if key in default_settings:
+            settings[key] = value
+        else:
+            print("unknown setting", key, "ignored")
+    return settings
+
+
+def load_entity_list(json_root):
+    """Builds entities out of the "entities" and "habitats" lists of a parsed JSON file
+    :param json_root: the parsed JSON, as a dict
+    :return: a list of entities, all in a new EntityStore of their own (see corbit.store)
+    """
+    entity_guid = 0
+    store = EntityStore()
     json_entities = []
 
     try:
@@ -60,7 +106,7 @@ def load_json(input_stream):
                 angular_position, angular_speed, angular_acceleration = load_entities(entity)
                 json_entities.append(
                     Entity(name, mass, radius, color, displacement, velocity, acceleration, angular_position,
-                           angular_speed, angular_acceleration))
+                           angular_speed, angular_acceleration, entity.get("test particle", False), store))
                 entity_guid += 1
             except KeyError:
                 print("entity " + name + " has undefined elements, skipping...")
@@ -83,7 +129,8 @@ def load_json(input_stream):
                 rcs_fuel = habitat["rcs fuel"]
                 json_entities.append(
                     Habitat(name, mass, radius, color, displacement, velocity, acceleration, angular_position,
-                            angular_speed, angular_acceleration, main_fuel, rcs_fuel))
+                            angular_speed, angular_acceleration, main_fuel, rcs_fuel,
+                            habitat.get("test particle", False), store))
                 entity_guid += 1
             except KeyError:
                 print("habitat " + name + " has undefined elements, skipping...")
@@ -117,7 +164,7 @@ def flush_db(entities, db_info):
         POSX DOUBLE NOT NULL, POSY DOUBLE NOT NULL, VX DOUBLE NOT NULL, VY DOUBLE NOT NULL,
         ACCX DOUBLE NOT NULL, ACCY DOUBLE NOT NULL,
         ANGPOS DOUBLE NOT NULL, ANGV DOUBLE NOT NULL, ANGACC DOUBLE NOT NULL,
-        FUEL DOUBLE, RCSFUEL DOUBLE)""")
+        FUEL DOUBLE, RCSFUEL DOUBLE, ID INT NOT NULL)""")
     db_cursor.execute("DROP TABLE IF EXISTS flightcommands")
     db_cursor.execute("""CREATE TABLE flightcommands ( COMMAND CHAR(64) NOT NULL, TARGET CHAR(64), AMOUNT DOUBLE)""")
     db.commit()
@@ -132,33 +179,38 @@ def connect_to_db(db_info):
 def push_entities(entities):
     list_of_values = []
     sql_code = """INSERT INTO flight(
-            TYPE, NAME, MASS, RADIUS, COLORR, COLORG, COLORB, POSX, POSY, VX, VY, ACCX, ACCY, ANGPOS, ANGV, ANGACC, FUEL, RCSFUEL)
+            TYPE, NAME, MASS, RADIUS, COLORR, COLORG, COLORB, POSX, POSY, VX, VY, ACCX, ACCY, ANGPOS, ANGV, ANGACC, FUEL, RCSFUEL, ID)
             VALUES"""
     for entity in entities:
         fields = """ (
-            '%s', '%s', %f,   %f,     %d,     %d,     %d,     %f,   %f,   %f, %f, %f,   %f,   %f,     %f,   %f,     %f,   %f),"""
+            '%s', '%s', %f,   %f,     %d,     %d,     %d,     %f,   %f,   %f, %f, %f,   %f,   %f,     %f,   %f,     %f,   %f,      %d),"""
 
+        displacement = units.number(entity.displacement, m)
+        velocity = units.number(entity.velocity, m/s)
+        acceleration = units.number(entity.acceleration, m/s/s)
         values = (entity.name,
-                  entity.mass().asNumber(kg),
-                  entity.radius.asNumber(m),
+                  units.number(entity.dry_mass, kg),
+                  units.number(entity.radius, m),
                   entity.color[0],
                   entity.color[1],
                   entity.color[2],
-                  entity.displacement[0].asNumber(m),
-                  entity.displacement[1].asNumber(m),
-                  entity.velocity[0].asNumber(m/s),
-                  entity.velocity[1].asNumber(m/s),
-                  entity.acceleration[0].asNumber(m/s/s),
-                  entity.acceleration[1].asNumber(m/s/s),
-                  entity.angular_position.asNumber(rad),
-                  entity.angular_speed.asNumber(rad/s),
-                  entity.angular_acceleration.asNumber(rad/s/s))
+                  displacement[0],
+                  displacement[1],
+                  velocity[0],
+                  velocity[1],
+                  acceleration[0],
+                  acceleration[1],
+                  units.number(entity.angular_position, rad),
+                  units.number(entity.angular_speed, rad/s),
+                  units.number(entity.angular_acceleration, rad/s/s))
         if type(entity) is Entity:
             values = ("entity",) + values
             values += (0,0,)
         else:
             values = ("habitat",) + values
-            values += (entity.engine_system.fuel.asNumber(kg), entity.rcs_system.fuel.asNumber(kg),)
+            values += (units.number(entity.engine_system.fuel, kg), units.number(entity.rcs_system.fuel, kg),)
+        # the id from the server's EntityRegistry, which is how the client says which entity it means
+        values += (entity.id,)
         sql_code += fields % values
     try:
         sql_code = sql_code[:-1] # removes the last ","
@@ -175,20 +227,24 @@ def get_entities():
     sql_object = db_cursor.fetchall()
     db.commit()
     retrieved_entities = []
+    store = EntityStore()
     for entity in sql_object:
         # sorry for not being able to access fields in a clearer manner, but here's a conversion list
         # that is true, but everything just comes in the order that the columns are in:
         # TYPE, NAME, MASS, RADIUS, COLORR, COLORG, COLORB, POSX, POSY, VX, VY, ACCX, ACCY, ANGPOS, ANGV, ANGACC,
-        # (FUEL, RCSFUEL)
+        # (FUEL, RCSFUEL), ID
         if entity[0] == "entity":
-            retrieved_entities.append(
-                Entity(entity[1], entity[2], entity[3], (entity[4], entity[5], entity[6]), [entity[7], entity[8]],
-                       [entity[9], entity[10]], [entity[11], entity[12]], entity[13], entity[14], entity[15]))
+            retrieved = Entity(entity[1], entity[2], entity[3], (entity[4], entity[5], entity[6]), [entity[7], entity[8]],
+                               [entity[9], entity[10]], [entity[11], entity[12]], entity[13], entity[14], entity[15],
+                               store=store)
         elif entity[0] == "habitat":
-            retrieved_entities.append(
-                Habitat(entity[1], entity[2], entity[3], (entity[4], entity[5], entity[6]), [entity[7], entity[8]],
-                        [entity[9], entity[10]], [entity[11], entity[12]], entity[13], entity[14], entity[15],
-                        entity[16], entity[17]))
+            retrieved = Habitat(entity[1], entity[2], entity[3], (entity[4], entity[5], entity[6]), [entity[7], entity[8]],
+                                [entity[9], entity[10]], [entity[11], entity[12]], entity[13], entity[14], entity[15],
+                                entity[16], entity[17], store=store)
+        else:
+            continue
+        retrieved.id = entity[18]  # so an EntityRegistry keeps the server's ids
+        retrieved_entities.append(retrieved)
     return retrieved_entities
 
 def push_commands(list_of_commands):
@@ -1,15 +1,27 @@
 import math
 import json
 
-import scipy
-from scipy import linalg as LA
+import numpy
+from numpy import linalg as LA
 
 from unum.units import rad, m, s, kg, N
 
+import corbit.store
+from corbit import units
+
 
 center = "Habitat"
 control = "Habitat"
-reference = "Earth"
+reference = "Earth"  # what the HUD shows the controlled entity's orbit around. The client changes it, see client.py
+# goes up whenever any entity's displacement or velocity is set, so cached geometry (see
+# corbit.geometry) knows when it's out of date
+moves = 0
+# goes up whenever any entity's test_particle flag is set, so EntityRegistry.massive knows when it's out of date
+kinds = 0
+# Entity.move and Entity.accelerate work out their vectors in here instead of making new arrays every call
+_scratch = numpy.empty(2)
+# unit of moments of inertia, made once since doing arithmetic on unum units isn't cheap
+_kg_m2 = kg * m ** 2
 
 class Camera:
     """Used to store the zoom level and position of the display's camera. Change this to change the viewpoint"""
@@ -21,9 +33,9 @@ class Camera:
         else:
             self.locked = True
 
-        self.displacement = m * scipy.array([0, 0])
-        self.velocity = m / s * scipy.array([0, 0])
-        self.acceleration = m / s / s * scipy.array([0, 0])
+        self.displacement = units.internal(numpy.zeros(2), m)
+        self.velocity = units.internal(numpy.zeros(2), m / s)
+        self.acceleration = units.internal(numpy.zeros(2), m / s / s)
 
         self.zoom_level = zoom_level
 
@@ -35,9 +47,10 @@ class Camera:
     def update(self, entity):
         """Updates the camera's position to match that of the center"""
         if self.locked:
-            self.displacement = entity.displacement
-            self.velocity = entity.velocity
-            self.acceleration = entity.acceleration
+            # copies, since the camera moves its own vectors in place
+            self.displacement = entity.displacement.copy()
+            self.velocity = entity.velocity.copy()
+            self.acceleration = entity.acceleration.copy()
 
     def pan(self, amount):
         """Pan the camera by a vector amount"""
@@ -46,7 +59,7 @@ class Camera:
     def move(self, time):
         """Called every tick, keeps the camera moving"""
         self.velocity += self.acceleration * time
-        self.acceleration = 0 * m / s / s
+        self.acceleration = units.internal(numpy.zeros(2), m / s / s)
         self.displacement += self.velocity * time
 
     def zoom(self, amount):
@@ -57,53 +70,150 @@ class Camera:
             self.zoom_level *= 1 + amount
 
 
+def _column(column, unit, changes_mass=False):
+    """A property that reads and writes an entity's row of a column of its EntityStore
+    :param column: name of the column, see corbit.store.EntityStore.columns
+    :param unit: the SI unit the column is in
+    :param changes_mass: True if setting it changes the entity's mass or moment of inertia, so
+    the cached ones need working out again
+    """
+    def get(self):
+        return units.internal(getattr(self.store, column)[self.row], unit)
+
+    def set(self, value):
+        getattr(self.store, column)[self.row] = units.number(value, unit)
+        if changes_mass:
+            self.store.stale[self.row] = True
+
+    return property(get, set)
+
+
 class Entity:
-    """Base class for all physical objects"""
+    """Base class for all physical objects. The constructor takes plain numbers in SI units,
+    which are stored however corbit.units says the simulation core should store them.
+
+    An Entity is a view of a row of an EntityStore (see corbit.store), which is where all its
+    numbers actually live. Vectors like displacement come out as views into the store's columns,
+    so changing them in place changes the entity"""
+    __slots__ = ("store", "row", "name", "color", "id")
 
     def __init__(self, name, mass, radius, color, displacement, velocity, acceleration, angular_position, angular_speed,
-                 angular_acceleration):
+                 angular_acceleration, test_particle=False, store=None):
+        """:param store: the EntityStore to keep the entity in, by default corbit.store.default"""
+        self.store = corbit.store.default if store is None else store
+        self.row = self.store.add()
+        self.id = None  # given out by the EntityRegistry the entity gets added to
         assert isinstance(name, str), name + " is not a str"
         self.name = name
+        # test particles (spacecraft, debris, small asteroids) feel the gravity of the massive entities,
+        # but are too light to pull on anything themselves, so gravity skips them as a source
+        assert isinstance(test_particle, bool), test_particle.__str__() + " is not a bool"
+        self.test_particle = test_particle
         assert isinstance(color, (tuple, list)), color.__str__() + " is not a tuple"
         assert color.__len__() == 3, color.__str__() + " is not a 3-tuple"
         self.color = color
         assert isinstance(mass, (int, float)), mass.__str__() + " is not a float"
         assert mass > 0, mass.__str__() + " is nonpositive"
-        self.dry_mass = mass * kg
+        self.dry_mass = units.internal(float(mass), kg)
         assert isinstance(radius, (int, float)), radius.__str__() + " is not a float"
         assert radius > 0, radius.__str__() + " is nonpositive"
-        self.radius = radius * m
+        self.radius = units.internal(float(radius), m)
 
         assert isinstance(displacement, list), displacement.__str__() + " is not a vector"
         assert displacement.__len__() == 2, displacement.__str__() + " is not 2D"
         assert isinstance(displacement[0], (int, float)), displacement.__str__() + "'s x is not a float"
         assert isinstance(displacement[1], (int, float)), displacement.__str__() + "'s y is not a float"
-        self.displacement = m * scipy.array(displacement)
+        self.displacement = units.internal(numpy.array(displacement, dtype=numpy.float64), m)
         assert isinstance(velocity, list), velocity.__str__() + " is not a vector"
         assert velocity.__len__() == 2, velocity.__str__() + " is not 2D"
         assert isinstance(velocity[0], (int, float)), velocity.__str__() + "'s x is not a float"
         assert isinstance(velocity[1], (int, float)), velocity.__str__() + "'s y is not a float"
-        self.velocity = m/s * scipy.array(velocity)
+        self.velocity = units.internal(numpy.array(velocity, dtype=numpy.float64), m / s)
         assert isinstance(acceleration, list), acceleration.__str__() + " is not a vector"
         assert acceleration.__len__() == 2, acceleration.__str__() + " is not 2D"
         assert isinstance(acceleration[0], (int, float)), acceleration.__str__() + "'s x is not a float"
         assert isinstance(acceleration[1], (int, float)), acceleration.__str__() + "'s y is not a float"
-        self.acceleration = m/s/s * scipy.array(acceleration)
+        self.acceleration = units.internal(numpy.array(acceleration, dtype=numpy.float64), m / s / s)
 
         assert isinstance(angular_position, (int, float)), angular_position.__str__() + " is not a float"
-        self.angular_position = angular_position * rad
+        self.angular_position = units.internal(float(angular_position), rad)
         assert isinstance(angular_speed, (int, float)), angular_speed.__str__() + " is not a float"
-        self.angular_speed = angular_speed * rad/s
+        self.angular_speed = units.internal(float(angular_speed), rad / s)
         assert isinstance(angular_acceleration, (int, float)), angular_acceleration.__str__() + " is not a float"
-        self.angular_acceleration = angular_acceleration * rad/s/s
+        self.angular_acceleration = units.internal(float(angular_acceleration), rad / s / s)
+
+    @classmethod
+    def view(cls, store, row, name, color):
+        """Makes an entity out of a row of a store that's already filled in, e.g. one loaded from a
+        snapshot (see corbit.snapshot), without any of the checks the constructor does
+        :param store: the EntityStore
+        :param row: the entity's row in it
+        """
+        # the constructor's displacement setter would have done this. The new entity can have the
+        # id() of one that's gone, so cached geometry for that one mustn't carry over to it
+        global moves
+        moves += 1
+        entity = cls.__new__(cls)
+        entity.store = store
+        entity.row = row
+        entity.name = name
+        entity.color = color
+        entity.id = None
+        return entity
+
+    @property
+    def displacement(self):
+        return units.internal(self.store.positions[self.row], m)
+
+    @displacement.setter
+    def displacement(self, displacement):
+        global moves
+        moves += 1
+        self.store.positions[self.row] = units.number(displacement, m)
+
+    @property
+    def velocity(self):
+        return units.internal(self.store.velocities[self.row], m / s)
+
+    @velocity.setter
+    def velocity(self, velocity):
+        global moves
+        moves += 1
+        self.store.velocities[self.row] = units.number(velocity, m / s)
+
+    acceleration = _column("accelerations", m / s / s)  # non-gravitational, e.g. from a collision
+    angular_position = _column("angular_positions", rad)  # which way the entity is pointing
+    angular_speed = _column("angular_speeds", rad / s)
+    angular_acceleration = _column("angular_accelerations", rad / s / s)
+    dry_mass = _column("dry_masses", kg, changes_mass=True)  # mass without any fuel
+    radius = _column("radii", m, changes_mass=True)
+
+    @property
+    def test_particle(self):
+        return bool(self.store.test_particles[self.row])
+
+    @test_particle.setter
+    def test_particle(self, test_particle):
+        global kinds
+        self.store.test_particles[self.row] = test_particle
+        kinds += 1
 
     def mass(self):
-        """Getter function for mass, will be overriden in Entity-derived classes"""
-        return self.dry_mass
+        """Getter function for mass: the dry mass plus any fuel. It's cached in the store, and only
+        added up again after the dry mass or fuel changes"""
+        if self.store.stale[self.row]:
+            self.store.refresh(self.row)
+        return units.internal(self.store.masses[self.row], kg)
+
+    def engine_systems(self):
+        """The entity's EngineSystems, which the server burns as part of integrating it (see corbit.burns)"""
+        return []
 
     def moment_of_inertia(self):
-        """Returns the entity's moment of inertia, which is that of a sphere"""
-        return (2 * self.mass() * self.radius ** 2) / 5
+        """Returns the entity's moment of inertia, which is that of a sphere. Cached like mass()"""
+        if self.store.stale[self.row]:
+            self.store.refresh(self.row)
+        return units.internal(self.store.moments[self.row], _kg_m2)
 
     def accelerate(self, force, angle):
         """
@@ -123,16 +233,17 @@ class Entity:
         # # angle = 0
         # # and the engines firing from the bottom of the hab will have
         # # angle = 3pi/2
-        F_theta = math.atan2(force[1].asNumber(), force[0].asNumber())
+        F = units.number(force, N)
+        F_theta = math.atan2(F[1], F[0])
 
         # a = F / m
         # # where
         # a is linear acceleration, m is mass of entity
         # F is the force that is used in making linear acceleration
-        F_cen = force * abs(math.cos(angle - F_theta))
-        self.acceleration += F_cen / self.mass()
-        # if LA.norm(F_cen.asNumber()) != 0:
-        # print(F_cen)
+        # (worked out into _scratch and added on in place, so there's no new arrays)
+        acceleration = self.store.accelerations[self.row]
+        numpy.multiply(F, abs(math.cos(angle - F_theta)) / units.number(self.mass(), kg), out=_scratch)
+        acceleration += _scratch
 
         # w = T / I
         # # where
@@ -140,24 +251,40 @@ class Entity:
         # T is torque in J/rad
         # I is moment of inertia in kg*m^2
         # angle -= self.angular_position
-        T = N * scipy.linalg.norm(force.asNumber()) \
-            * self.radius * math.sin(angle - F_theta)
-        self.angular_acceleration += T / self.moment_of_inertia()
-        #if T != N*m * 0:
-        #print(T)
+        T = math.hypot(F[0], F[1]) * units.number(self.radius, m) * math.sin(angle - F_theta)
+        self.store.angular_accelerations[self.row] += T / units.number(self.moment_of_inertia(), _kg_m2)
 
     def move(self, time):
-        """Updates velocities, positions, and rotations for entity
+        """Updates velocities, positions, and rotations for entity. Everything is changed in place in
+        the entity's row of its store, so moving doesn't make any new arrays
         :param time: the dt for the frame
         """
-
-        self.velocity += self.acceleration * time
-        self.acceleration = m / s / s * scipy.array((0, 0))
-        self.displacement += self.velocity * time
-
-        self.angular_speed += self.angular_acceleration * time
-        self.angular_acceleration = 0 * rad / s / s
-        self.angular_position += self.angular_speed * time
+        global moves
+        dt = units.number(time, s)
+        position = self.store.positions[self.row]
+        velocity = self.store.velocities[self.row]
+        acceleration = self.store.accelerations[self.row]
+
+        numpy.multiply(acceleration, dt, out=_scratch)
+        velocity += _scratch
+        acceleration.fill(0)
+        numpy.multiply(velocity, dt, out=_scratch)
+        position += _scratch
+        moves += 1
+
+        self.rotate(time)
+
+    def rotate(self, time):
+        """Updates just the rotation of the entity. The server uses this directly, since positions
+        and velocities are done by an integrator (see corbit.integrators). For lots of entities at
+        once, rotate(entities, time) does them all in one go
+        :param time: the dt for the frame
+        """
+        dt = units.number(time, s)
+        store, row = self.store, self.row
+        store.angular_speeds[row] += store.angular_accelerations[row] * dt
+        store.angular_accelerations[row] = 0
+        store.angular_positions[row] += store.angular_speeds[row] * dt
 
     def __repr__(self):
         """Returns a dictionary representation of the Entity, with all the data needed to
@@ -165,25 +292,36 @@ class Entity:
         return {
             "name": self.name,
             "color": self.color,
-            "mass": self.mass().asNumber(),
-            "radius": self.radius.asNumber(),
-            "displacement": self.displacement.asNumber().tolist(),
-            "velocity": self.velocity.asNumber().tolist(),
-            "acceleration": self.acceleration.asNumber().tolist(),
-            "angular position": self.angular_position.asNumber(),
-            "angular speed": self.angular_speed.asNumber(),
-            "angular acceleration": self.angular_acceleration.asNumber()}
+            # the dry mass, which is what the constructor takes. Habitats save their fuel separately
+            "mass": units.number(self.dry_mass, kg),
+            "radius": units.number(self.radius, m),
+            "displacement": units.number(self.displacement, m).tolist(),
+            "velocity": units.number(self.velocity, m / s).tolist(),
+            "acceleration": units.number(self.acceleration, m / s / s).tolist(),
+            "angular position": units.number(self.angular_position, rad),
+            "angular speed": units.number(self.angular_speed, rad / s),
+            "angular acceleration": units.number(self.angular_acceleration, rad / s / s),
+            "test particle": self.test_particle}
 
 
 class EngineSystem:
-    """EngineSystem class, represents things like main habitat engines, habitat RCS systems, etc."""
+    """EngineSystem class, represents things like main habitat engines, habitat RCS systems, etc.
+    Its fuel is kept in a column of an EntityStore (see corbit.store), along with the rest of its entity"""
 
-    def __init__(self, fuel, rated_fuel_flow, I_sp, engine_placements):
-        # when I do something like fuel.asNumber(kg) * kg, I'm forcing the units to kg and checking that they
-        # are indeed kg in the first place
-        self.fuel = fuel.asNumber(kg) * kg    # how much fuel left in the tank
-        self.rated_fuel_flow = rated_fuel_flow.asNumber(kg/s) * kg/s  # how fast fuel goes out at 100% engines
-        self.I_sp = I_sp.asNumber(m/s) * m/s    # specific impulse i.e. how much thrust you get per kg of fuel
+    def __init__(self, fuel, rated_fuel_flow, I_sp, engine_placements, store, row, tank=0):
+        """:param store: EntityStore of the entity the engines are on, and row is the entity's row.
+        The engines don't have a row of their own, their fuel is part of the entity's mass
+        :param tank: which fuel column of the store is ours, 0 for main engines and 1 for RCS
+        """
+        self.store = store
+        self.row = row
+        self.tank = tank
+        # these take unum quantities, and units.number checks that they are indeed in kg, kg/s, etc.
+        self.fuel = units.internal(units.number(fuel, kg), kg)    # how much fuel left in the tank
+        # how fast fuel goes out at 100% engines
+        self.rated_fuel_flow = units.internal(units.number(rated_fuel_flow, kg / s), kg / s)
+        # specific impulse i.e. how much thrust you get per kg of fuel
+        self.I_sp = units.internal(units.number(I_sp, m / s), m / s)
 
         # a list of pairs of form (angle, vector)
         for angle, vector in engine_placements:
@@ -193,7 +331,7 @@ class EngineSystem:
         self.engine_placements = engine_placements
         # where 'angle' is where on the entity's surface the engine is placed and
         # 'vector' is in which the engine has its thrust vector
-        # for example, [(3.1415, scipy.array((1, 0))] is a single engine, on the bottom, that fires away
+        # for example, [(3.1415, numpy.array((1, 0))] is a single engine, on the bottom, that fires away
         #           __
         #         /    \
         #    <<<<|      |     pchooo the rocket is going off to the right -> -> -> ->
@@ -204,6 +342,27 @@ class EngineSystem:
         # when thrusting, we divide the thrust over ALL engines in an EngineSystem
 
         self.throttle = 0   # self-explanatory, 0: 0%, 0.5: 50%, and 1: 100%
+        # which way the thrust points, as an angle from where the entity is pointing. 0 is straight ahead
+        self.direction = 0.0
+        self.pulsing = False  # True if the engines shut off again after this tick, see pulse()
+
+    @property
+    def fuel(self):
+        return units.internal(self.store.fuel[self.row, self.tank], kg)
+
+    @fuel.setter
+    def fuel(self, fuel):
+        self.store.fuel[self.row, self.tank] = units.number(fuel, kg)
+        self.store.stale[self.row] = True  # the entity's mass changed
+
+    def pulse(self, direction, throttle=1):
+        """Fires the engines for one server tick, e.g. a tap of the RCS
+        :param direction: angle from where the entity is pointing to push it towards, in rad
+        :param throttle: 0 to 1
+        """
+        self.direction = float(direction)
+        self.throttle = throttle
+        self.pulsing = True
 
     def thrust(self, time):
         """Determines the thrust a single engine gives out over a time interval
@@ -217,7 +376,7 @@ class EngineSystem:
             self.fuel -= abs(fuel_usage) * time
         else:
             fuel_usage = self.fuel / time
-            self.fuel = 0 * kg
+            self.fuel = units.internal(0.0, kg)
 
         return self.I_sp * fuel_usage / len(self.engine_placements)
 
@@ -234,47 +393,44 @@ class EngineSystem:
 
 class Habitat(Entity):
     """A special class for the habitat"""
+    __slots__ = ("engine_system", "rcs_system")
 
     def __init__(self, name, mass, radius, color, displacement, velocity, acceleration, angular_position,
-                 angular_speed, angular_acceleration, main_fuel, rcs_fuel):
+                 angular_speed, angular_acceleration, main_fuel, rcs_fuel, test_particle=False, store=None):
         Entity.__init__(self, name, mass, radius, color, displacement, velocity, acceleration, angular_position,
-                        angular_speed, angular_acceleration)
+                        angular_speed, angular_acceleration, test_particle, store)
+        self._add_engine_systems(main_fuel, rcs_fuel)
+
+    @classmethod
+    def view(cls, store, row, name, color):
+        habitat = super().view(store, row, name, color)
+        habitat._add_engine_systems(float(store.fuel[row, 0]), float(store.fuel[row, 1]))
+        return habitat
+
+    def _add_engine_systems(self, main_fuel, rcs_fuel):
+        """Fits the habitat's engines, with this much fuel in their tanks, in kg"""
         self.engine_system = EngineSystem(main_fuel * kg,
                                           5 * kg/s,
                                           3000 * m/s,
                                           [[3.28, [1,0]],
-                                           [3.0, [1, 0]]])
+                                           [3.0, [1, 0]]],
+                                          self.store, self.row, 0)
         self.rcs_system = EngineSystem(rcs_fuel * kg,
                                        5 * kg/s,
                                        3000 * m/s,
                                        [[0.0, [-1,0]],
                                         [1.57, [0,-1]],
                                         [3.14, [1,0]],
-                                        [4.71, [0,1]]])
+                                        [4.71, [0,1]]],
+                                       self.store, self.row, 1)
 
-    def mass(self):
-        fuel_mass = self.engine_system.fuel + self.rcs_system.fuel
-        return self.dry_mass + fuel_mass
-
-    def move(self, time):
-        """Accelerates habitat from main engine thrust, then moves the habitat normally"""
-        #todo: move this code into a server loop
-
-        #         thrust = self.main_engines.thrust(time)
-        #         thrust_vector = \
-        #             N * scipy.array((math.cos(self.angular_position) * thrust.asNumber(N),
-        #                              math.sin(self.angular_position) * thrust.asNumber(N)))
-        #         for angle in self.main_engines.engine_positions:
-        #             self.accelerate(
-        #                 thrust_vector / len(self.main_engines.engine_positions),
-        #                angle + self.angular_position)
-
-        Entity.move(self, time)
+    def engine_systems(self):
+        return [self.engine_system, self.rcs_system]
 
     def __repr__(self):
         blob = Entity.__repr__(self)
-        blob["main fuel"] = self.engine_system.fuel
-        blob["rcs fuel"] = self.rcs_system.fuel
+        blob["main fuel"] = units.number(self.engine_system.fuel, kg)
+        blob["rcs fuel"] = units.number(self.rcs_system.fuel, kg)
         return blob
 
 
@@ -284,29 +440,161 @@ def oneshot_vernier_thrusters(entity, amount, time):
     :param amount: ratio of vernier thruster rated thrust to thrust by
     :param time: time over which to thrust
     """
-    for angle in entity.rcs.engine_positions:
-        print(amount * entity.rcs.thrust(time) * scipy.array(
-            (-math.sin(entity.angular_position + angle), math.cos(entity.angular_position + angle)))
-              / len(entity.rcs.engine_positions), angle + entity.angular_position)
-        entity.accelerate(amount * entity.rcs.thrust(time) * scipy.array(
-            (-math.sin(entity.angular_position + angle), math.cos(entity.angular_position + angle)))
-                          / len(entity.rcs.engine_positions), angle + entity.angular_position)
+    thrust = entity.rcs_system.thrust(time)
+    for angle, vector in entity.rcs_system.engine_placements:
+        theta = units.number(entity.angular_position, rad) + angle
+        entity.accelerate(amount * thrust * numpy.array((-math.sin(theta), math.cos(theta))), theta)
 
 
 def find_entity(name, entities):
     """Accesses the first entity specified by name
     :param name: string of the target object's name
-    :param entities: the list of entites in which to search in
+    :param entities: the list of entites in which to search in. If it's an EntityRegistry, this
+    is a dict lookup instead of going through the whole list
     :return: an Entity asked for
     """
+    if isinstance(entities, EntityRegistry):
+        return entities.find(name)
     for entity in entities:
         if entity.name == name:
             return entity
 
 
-def json_serialize(entities, output_stream=None, pretty=False, json_sort_keys=False):
+def rotate(entities, time):
+    """Entity.rotate for a list of entities, all at once when they're all in the same store
+    :param time: the dt for the frame
+    """
+    store, rows = corbit.store.rows_of(entities)
+    if store is None:
+        for entity in entities:
+            entity.rotate(time)
+    else:
+        store.rotate(units.number(time, s), rows)
+
+
+class EntityRegistry:
+    """Gives each entity a stable integer id, and keeps indexes so finding entities doesn't mean
+    going through the whole list. The server and client keep one each, with the same ids, and use
+    the ids to say which entity they mean to each other (see mysqlio.push_entities).
+
+        registry = EntityRegistry()
+        registry.load(entities)
+        habitat = registry.find("Habitat")  # or registry.find(habitat_id)
+
+    self.entities is the entities in the order they were added, which is the order to gather them
+    into an NBody in. Ids never get reused, not even after the entity with one is removed.
+    """
+
+    def __init__(self):
+        self.entities = []
+        self.by_id = {}  # id -> entity
+        self.ids = {}  # name -> id
+        self.positions = {}  # id -> index in self.entities
+        # type indexes, sets of ids
+        self.habitats = set()
+        self._massive = set()  # see the massive property
+        self._kinds = kinds  # objects.kinds when _massive was last right
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __iter__(self):
+        return iter(self.entities)
+
+    def __contains__(self, key):
+        return self.id_of(key) is not None
+
+    def add(self, entity):
+        """Registers an entity, giving it the next id unless it has one already (e.g. it came from
+        the server with one, see mysqlio.get_entities)
+        :return: the entity's id
+        """
+        assert entity.name not in self.ids, entity.name + " is already registered"
+        if entity.id is None:
+            entity.id = self.next_id
+        assert entity.id not in self.by_id, str(entity.id) + " is already registered"
+        self.next_id = max(self.next_id, entity.id + 1)
+        self.by_id[entity.id] = entity
+        self.ids[entity.name] = entity.id
+        self.positions[entity.id] = len(self.entities)
+        self.entities.append(entity)
+        if isinstance(entity, Habitat):
+            self.habitats.add(entity.id)
+        if not entity.test_particle:
+            self.massive.add(entity.id)
+        return entity.id
+
+    def remove(self, key):
+        """Unregisters an entity, and gives its row back to its EntityStore (see EntityStore.release),
+        so it mustn't be used after this
+        :param key: the entity's id or name
+        """
+        entity = self.find(key)
+        if entity is None:
+            return
+        del self.by_id[entity.id]
+        del self.ids[entity.name]
+        self.habitats.discard(entity.id)
+        self.massive.discard(entity.id)
+        del self.entities[self.positions[entity.id]]
+        # everything after it moves up one
+        self.positions = {other.id: i for i, other in enumerate(self.entities)}
+        entity.store.release(entity.row)
+
+    def load(self, entities):
+        """Forgets every entity registered so far and registers these instead, e.g. after loading a scenario.
+        Ids carry on counting up from where they were, unless the entities come with their own"""
+        self.entities = []
+        self.by_id = {}
+        self.ids = {}
+        self.positions = {}
+        self.habitats = set()
+        self._massive = set()
+        self._kinds = kinds
+        for entity in entities:
+            self.add(entity)
+
+    @property
+    def massive(self):
+        """Ids of everything but test particles. An entity's test_particle flag can be changed without
+        the registry hearing about it, so this is worked out again after any flag has been set"""
+        if self._kinds != kinds:
+            self._massive = {entity.id for entity in self.entities if not entity.test_particle}
+            self._kinds = kinds
+        return self._massive
+
+    def massive_mask(self):
+        """:return: (len(self),) bool array, True for the massive entities, in the order of self.entities"""
+        mask = numpy.zeros(len(self.entities), dtype=bool)
+        massive = self.massive
+        mask[numpy.fromiter((self.positions[i] for i in massive), dtype=numpy.intp, count=len(massive))] = True
+        return mask
+
+    def id_of(self, key):
+        """:param key: an entity's id, its id as a str (which is how they come out of the database), or its name
+        :return: the id, or None if there's no such entity"""
+        if isinstance(key, str) and key.isdigit():
+            key = int(key)
+        if isinstance(key, int):
+            return key if key in self.by_id else None
+        return self.ids.get(key)
+
+    def find(self, key):
+        """:param key: an entity's id or name, see id_of
+        :return: the entity, or None if there's no such entity"""
+        return self.by_id.get(self.id_of(key))
+
+    def position(self, key):
+        """:return: where an entity (by id or name) is in self.entities, and so which row of an
+        NBody it gets gathered into. None if there's no such entity"""
+        return self.positions.get(self.id_of(key))
+
+
+def json_serialize(entities, output_stream=None, pretty=False, json_sort_keys=False, settings=None):
     """Serializes a list of entities into a JSON string
     :param entities: the list of entities to serialize
+    :param settings: optional dict of scenario settings to save along with them (see mysqlio.load_scenario)
     :return: the JSON string representation of the entities
     """
     json_separators = (",", ":")
@@ -330,6 +618,8 @@ def json_serialize(entities, output_stream=None, pretty=False, json_sort_keys=Fa
         del json_data["habitats"]
     if not json_data["entities"]:
         del json_data["entities"]
+    if settings:
+        json_data["settings"] = settings
 
     if output_stream is None:
         return json.dumps(json_data, indent=json_indent, sort_keys=json_sort_keys, separators=json_separators)
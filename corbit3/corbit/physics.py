@@ -1,30 +1,36 @@
 from unum.units import m, s, N, kg
-import copy
-import scipy
-import scipy.linalg
-import scipy.spatial
+import numpy
+import numpy.linalg
 import math
 
+from corbit import units
+from corbit import collision
+from corbit import kepler
+from corbit.geometry import Geometry
 
-scipy.seterr(divide="raise", invalid="raise")
-G = 6.673 * 10 ** -11 * N * (m / kg) ** 2
+
+numpy.seterr(divide="raise", invalid="raise")
+G = units.internal(6.673 * 10 ** -11, N * (m / kg) ** 2)
+
+
+# separations, distances etc. between pairs of entities, shared by everything that calls the functions below
+geometry = Geometry()
 
 
 def magnitude(vect, unit):
-    # shorthand to work around scipy not working with units
-    return unit * scipy.linalg.norm(vect.asNumber(unit))
+    # shorthand to work around numpy not working with units
+    return units.internal(numpy.linalg.norm(units.number(vect, unit)), unit)
 
 
 def distance(A, B):
-    return m * scipy.spatial.distance.cdist([A.displacement.asNumber(m)],
-                                            [B.displacement.asNumber(m)])[0][0]
+    return units.internal(geometry.between(A, B).distance, m)
 
 
 def speed(A, B):
-    return magnitude(A.velocity - B.velocity, m / s)
+    return units.internal(geometry.between(A, B).speed, m / s)
 
 def velocity(A, B):
-    return A.velocity - B.velocity
+    return units.internal(geometry.between(A, B).relative_velocity.copy(), m / s)
 
 
 def altitude(A, B):
@@ -32,66 +38,76 @@ def altitude(A, B):
 
 
 def angle(A, B):
-    return math.atan2((B.displacement[1] - A.displacement[1]).asNumber(),
-                      (B.displacement[0] - A.displacement[0]).asNumber())
+    separation = geometry.between(A, B).separation  # from B to A, the other way round to what we want
+    return math.atan2(-separation[1], -separation[0])
 
 
 def gravitational_force(A, B):
-    unit_distance = scipy.array([math.cos(angle(A, B)), math.sin(angle(A, B))])
-    return G * A.mass() * B.mass() / distance(A, B) ** 2 * unit_distance
+    pair = geometry.between(A, B)
+    return G * A.mass() * B.mass() / units.internal(pair.distance, m) ** 2 * -pair.unit
 
 
 def Vcen(A, B):
-    dist = A.displacement - B.displacement
     # the math here: (unit normal vector) * (velocity)
-    return scipy.dot(dist / magnitude(dist, m), velocity(A, B))
+    pair = geometry.between(A, B)
+    return units.internal(numpy.dot(pair.unit, pair.relative_velocity), m / s)
 
 
 def Vtan(A, B):
-    dist = A.displacement - B.displacement
     # the math here is similar to Vcen
-    dist = dist.asNumber(m)
-    dist_tan = scipy.array((-dist[1], dist[0]))
-    return m / s * scipy.dot(dist_tan / scipy.linalg.norm(dist_tan), velocity(A, B).asNumber(m / s))
+    pair = geometry.between(A, B)
+    return units.internal(numpy.dot(pair.tangent, pair.relative_velocity), m / s)
 
 
 def Vorbit(A, B):
-    return m / s * math.sqrt(
-        ((B.mass() ** 2 * G) / ((A.mass() + B.mass()) * distance(A, B))).asNumber(m ** 2 / s / s))
+    return units.internal(math.sqrt(
+        units.number((B.mass() ** 2 * G) / ((A.mass() + B.mass()) * distance(A, B)), m ** 2 / s / s)), m / s)
+
+
+def orbit(A, B):
+    """The orbital elements of A around B, see kepler.elements. The HUD wants several of them every
+    frame, so they're worked out once per pair and kept until something moves
+    :return: dict of floats, in SI units
+    """
+    pair = geometry.between(A, B)
+    masses = (units.number(A.mass(), kg), units.number(B.mass(), kg))
+    if pair.orbit is None or pair.orbit[0] != masses:
+        mu = units.number(G, N * (m / kg) ** 2) * (masses[0] + masses[1])  # G(m + M)
+        elements = kepler.elements(numpy.array([pair.separation, numpy.zeros(2)]),
+                                   numpy.array([pair.relative_velocity, numpy.zeros(2)]), numpy.array([1, -1]), mu)
+        pair.orbit = masses, {name: values[0] for name, values in elements.items()}
+    return pair.orbit[1]
 
 
 def semimajor_axis(A, B):
-    mu = G * (A.mass() + B.mass())  # G(m + M)
-    E = (speed(A, B) ** 2 / 2) - mu / magnitude(A.displacement - B.displacement, m)
-    return -mu / 2 / E  # -mu/2E
+    return units.internal(orbit(A, B)["semimajor axis"], m)
 
 
 def ecc(A, B):
-    # this is all from the wikipedia orbital eccentricity page, btw: http://en.wikipedia.org/wiki/Orbital_eccentricity
-    mu = G * (A.mass() + B.mass())  # G(m + M)
-    E = -mu / 2 / semimajor_axis(A, B)  # -mu/2a
-    h = (distance(A, B) * Vtan(A, B))  # r * Vtan
-    return math.sqrt(1 + (2 * E * h ** 2) / (mu ** 2))  # sqrt(1 + (2Eh^2)/(mu^2))
+    return orbit(A, B)["eccentricity"]
 
 
 def periapsis(A, B):
-    peri = (1 - ecc(A, B)) * semimajor_axis(A, B)
-    if peri <= A.radius + B.radius:
-        return 0 * m
+    peri = orbit(A, B)["periapsis"]
+    if peri <= units.number(A.radius + B.radius, m):
+        return units.internal(0.0, m)
     else:
-        return peri
+        return units.internal(peri, m)
 
 
 def apoapsis(A, B):
-    apo = (1 + ecc(A, B)) * semimajor_axis(A, B)
-    if apo <= A.radius + B.radius:
-        return 0 * m
+    apo = orbit(A, B)["apoapsis"]
+    # escape orbits don't have one
+    if apo <= units.number(A.radius + B.radius, m) or apo == numpy.inf:
+        return units.internal(0.0, m)
     else:
-        return apo
+        return units.internal(apo, m)
 
 
 def stopping_acc(A, B):
-    return (G * B.mass() /(distance(A, B)**2) + speed(A, B)**2/(2*distance(A, B))).asUnit(m/s/s)
+    return units.internal(
+        units.number(G * B.mass() / (distance(A, B) ** 2) + speed(A, B) ** 2 / (2 * distance(A, B)), m / s / s),
+        m / s / s)
 
 
 def resolve_collision(A, B, time):
@@ -101,93 +117,56 @@ def resolve_collision(A, B, time):
     :param time: time interval over which to check if any collisions occur
     :return: None if no collision will occur in the timeframe, the two collided entities if there is a collision
     """
+    # everything in here is done with plain numbers in SI units, see corbit.units
+    positions = numpy.array([units.number(A.displacement, m), units.number(B.displacement, m)])
+    velocities = numpy.array([units.number(A.velocity, m / s), units.number(B.velocity, m / s)])
+    masses = numpy.array([units.number(A.mass(), kg), units.number(B.mass(), kg)])
+    radii = numpy.array([units.number(A.radius, m), units.number(B.radius, m)])
+    collided = resolve_collisions([A, B], positions, velocities, masses, radii,
+                                  numpy.array([0]), numpy.array([1]), time)
+    if collided:
+        return collided
+
+
+def resolve_collisions(entities, positions, velocities, masses, radii, first, second, time):
+    """Detects and acts upon the collisions between pairs of entities in the specified time interval.
+    Each entity collides at most once per call, see collision.earliest
+    :param entities: list of entities, the arrays are of their state at the start of the interval
+    :param positions: (n, 2) array of their positions, in m
+    :param velocities: (n, 2) array of their velocities, in m/s
+    :param masses: (n,) array of their masses, in kg
+    :param radii: (n,) array of their radii, in m
+    :param first: (k,) index array of the pairs to check, e.g. from collision.candidate_pairs
+    :param second: (k,) index array
+    :param time: time interval over which to check if any collisions occur
+    :return: list of the names of the entities that collided
+    """
     # general overview of this function:
-    # 1. find if the objects will collide in the given time
-    # 2. if yes, calculate collision:
+    # 1. find which pairs will collide in the given time, and when (collision.impacts)
+    # 2. for those, calculate the collision (collision.respond):
     # 2.1 represent velocities as normal velocity and tangential velocity
-    # 2.2 do a 1D collision using the normal veloctiy
+    # 2.2 do a 1D collision using the normal velocity
     # 2.3 add the normal and tangential velocities to get the new velocity
-
-    # for this function I make one of the objects the frame of reference
-    # which means my calculations are much simplified
-    displacement = A.displacement - B.displacement
-    velocity = A.velocity - B.velocity
-    acceleration = A.acceleration - B.acceleration
-    radius_sum = A.radius + B.radius
-
-    # this code finds when the the two entities will collide. See
-    # http://www.gvu.gatech.edu/people/official/jarek/graphics/material/collisionsDeshpandeKharsikarPrabhu.pdf
-    # for how I got the algorithm
-    a = magnitude(velocity, m / s) ** 2
-    b = m ** 2 / s * 2 * scipy.dot(displacement.asNumber(m), velocity.asNumber(m / s))
-    c = magnitude(displacement, m) ** 2 - radius_sum ** 2
-
-    try:
-        t_to_impact = \
-            (-b - m ** 2 / s * math.sqrt((b ** 2 - 4 * a * c).asNumber(m ** 4 / s ** 2))) / (2 * a)
-    except:
-        return
-
-    if not scipy.isfinite(t_to_impact.asNumber(s)):
-        return
-
-    if t_to_impact > time or t_to_impact < 0 * s:
-        return
-
-    # at this point, we know there is a collision
-    print("Collision:", A.name, "and", B.name, "in", t_to_impact)
-
-    # for this section, basically turn the vectors into normal velocity and tangential velocity,
-    # then do a 1D collision calculation, using the normal velocities
-    # since a ' (prime symbol) wouldn't work, I've replaced it with a _ in variable names
-
-    n = displacement  # normal vector
-    un = n / magnitude(n, m)  # normal unit vector
-    unt = copy.deepcopy(un)  # normal tangent vector
-    unt[0], unt[1] = -unt[1], unt[0]  # ofc the tangent is orthogonal to the normal
-
-    # A's centripetal velocity
-    vAn = m / s * scipy.dot(un.asNumber(), A.velocity.asNumber(m / s))
-    # A's tangential velocity
-    vAt = m / s * scipy.dot(unt.asNumber(), A.velocity.asNumber(m / s))
-
-    # B's centripetal velocity
-    vBn = m / s * scipy.dot(un.asNumber(), B.velocity.asNumber(m / s))
-    # B's tangential velocity
-    vBt = m / s * scipy.dot(unt.asNumber(), B.velocity.asNumber(m / s))
-
-    # tangent velocities are unchanged, nothing happens to them
-    vAt_ = vAt
-    vBt_ = vBt
-
-    # centripetal velocities are calculated with a simple 1D collision formula
-    R = 0.1
-
-    vAn_ = \
-        (A.mass() * vAn + B.mass() * vBn + R * B.mass() * (B.velocity - A.velocity)) / \
-        (A.mass() + B.mass())
-
-    vBn_ = \
-        (A.mass() * vAn + B.mass() * vBn + R * A.mass() * (A.velocity - B.velocity)) / \
-        (A.mass() + B.mass())
-
-    # convert scalar normal and tangent velocities to vector quantities
-    VAn = vAn_ * un
-    VAt = vAt_ * unt
-
-    VBn = vBn_ * un
-    VBt = vBt_ * unt
-
-    # move until the point of impact
-    A.move(t_to_impact)
-    B.move(t_to_impact)
-
-    # add em up to get v'
-    A.velocity = VAn + VAt
-    B.velocity = VBn + VBt
-
-    # move for the rest of the frame
-    A.move(time - t_to_impact)
-    B.move(time - t_to_impact)
-
-    return [A.name, B.name]
+    # 3. move the entities to the point of impact, change their velocities, and move them for the rest of the frame
+    dt = units.number(time, s)
+    hits, times, normals, tangents = collision.impacts(positions, velocities, radii, first, second, dt)
+    picked = collision.earliest(first[hits], second[hits], times)
+    first = first[hits][picked]
+    second = second[hits][picked]
+    times = times[picked]
+    velocities_first, velocities_second = collision.respond(velocities, masses, first, second,
+                                                            normals[picked], tangents[picked])
+
+    collided = []
+    for k in range(len(picked)):
+        A = entities[first[k]]
+        B = entities[second[k]]
+        print("Collision:", A.name, "and", B.name, "in", times[k], "s")
+        A.move(units.internal(times[k], s))
+        B.move(units.internal(times[k], s))
+        A.velocity = units.internal(velocities_first[k], m / s)
+        B.velocity = units.internal(velocities_second[k], m / s)
+        A.move(units.internal(dt - times[k], s))
+        B.move(units.internal(dt - times[k], s))
+        collided += [A.name, B.name]
+    return collided
@@ -0,0 +1,155 @@
+"""Bodies "on rails": pinned to a fixed conic orbit around their primary instead of being integrated.
+
+A pinned body's position at any time comes straight out of corbit.kepler, so it costs the same
+whether a tick is a thirtieth of a second or an hour, and its orbit never drifts. The price is that
+it only feels its primary: the Moon on rails ignores the Sun. Pinned bodies still pull on
+everything else as usual, from wherever their orbit puts them at the time.
+
+A body comes off the rails, and goes back to being integrated, when
+ - it has any thrust or other non-gravitational acceleration
+ - it's in a collision (the server calls release() for those)
+ - everything but its primary pulls on it more than PERTURBATION_LIMIT times as hard as the primary
+   does. That's checked every CHECK_INTERVAL ticks, since it costs a force evaluation
+"""
+import numpy
+
+import corbit.gravity
+from corbit import kepler
+
+PERTURBATION_LIMIT = 0.05
+CHECK_INTERVAL = 30  # ticks, so once a second at 30 Hz
+
+
+class Rails:
+    """The bodies of an NBody that are on rails, and the orbits they're pinned to.
+    Everything is kept sorted by depth in the hierarchy, so primaries get placed before their satellites"""
+
+    def __init__(self):
+        self.names = []
+        self.indices = numpy.zeros(0, dtype=numpy.intp)  # rows in the NBody arrays
+        self.parents = numpy.zeros(0, dtype=numpy.intp)  # rows of their primaries
+        self.depths = numpy.zeros(0, dtype=numpy.intp)
+        self.mu = numpy.zeros(0)  # G (M + m) of each orbit
+        # state relative to the primary at the epoch, which is when the body was pinned
+        self.epoch_positions = numpy.zeros((0, 2))
+        self.epoch_velocities = numpy.zeros((0, 2))
+        self.epochs = numpy.zeros(0)
+        self.propagator = None  # a kepler.Propagator for the orbits, made when first needed
+        self.groups = []  # index arrays of the pinned bodies at each depth, top down
+        self.ticks = 0
+
+    def __len__(self):
+        return len(self.indices)
+
+    def pinned(self, size):
+        """:return: (size,) bool array, True for the rows that are on rails"""
+        mask = numpy.zeros(size, dtype=bool)
+        mask[self.indices] = True
+        return mask
+
+    def pin(self, nbody, entities, names, time):
+        """Puts bodies on rails, on the orbit around their primary they're on right now
+        :param nbody: NBody with the entities gathered into it
+        :param entities: the list of entities that was gathered
+        :param names: names of the entities to pin
+        :param time: simulation time their orbits start at, in s. Normally nbody.time
+        """
+        parent = nbody.primaries()
+        depth = numpy.zeros(len(parent), dtype=numpy.intp)
+        for level, members in enumerate(nbody.hierarchy.levels()):
+            depth[members] = level
+        pinned = nbody.pinned()  # ours, or the ephemeris's
+
+        new = []
+        for i, entity in enumerate(entities):
+            if entity.name not in names or pinned[i]:
+                continue
+            if parent[i] < 0:
+                print(entity.name, "doesn't orbit anything, so it can't go on rails")
+                continue
+            new.append(i)
+        new = numpy.array(new, dtype=numpy.intp)
+        primaries = parent[new]
+
+        self.names += [entities[i].name for i in new]
+        self.indices = numpy.concatenate((self.indices, new))
+        self.parents = numpy.concatenate((self.parents, primaries))
+        self.depths = numpy.concatenate((self.depths, depth[new]))
+        # same mu as the Wisdom-Holman integrator uses, so the two agree on what the Kepler orbit is
+        self.mu = numpy.concatenate((self.mu, corbit.gravity.G * (nbody.masses[primaries] +
+                                                                   nbody.masses[new] * nbody.massive[new])))
+        self.epoch_positions = numpy.concatenate((self.epoch_positions,
+                                                  nbody.positions[new] - nbody.positions[primaries]))
+        self.epoch_velocities = numpy.concatenate((self.epoch_velocities,
+                                                   nbody.velocities[new] - nbody.velocities[primaries]))
+        self.epochs = numpy.concatenate((self.epochs, numpy.full(len(new), float(time))))
+        self._keep(numpy.argsort(self.depths, kind="mergesort"))
+
+    def release(self, names, reason="collision"):
+        """Takes bodies off the rails, they get integrated like everything else from now on
+        :param names: names of the bodies, ones that aren't on rails are ignored
+        :param reason: printed along with the names
+        """
+        keep = numpy.array([name not in names for name in self.names], dtype=bool)
+        for name in numpy.array(self.names, dtype=object)[~keep]:
+            print(name, "is off the rails:", reason)
+        if not keep.all():
+            self._keep(numpy.flatnonzero(keep))
+
+    def check(self, nbody):
+        """Releases the bodies that have thrust, or (every CHECK_INTERVAL calls) are being pulled too
+        hard by something other than their primary. Call once a tick, after gathering
+        :param nbody: NBody with the entities gathered into it
+        """
+        if not len(self):
+            return
+        thrusting = nbody.thrusting()[self.indices]
+        if thrusting.any():
+            self.release([name for name, thrust in zip(self.names, thrusting) if thrust], "thrust")
+
+        self.ticks += 1
+        if self.ticks % CHECK_INTERVAL or not len(self):
+            return
+        # everything but the Kepler force from the primary, relative to the Kepler force
+        r = nbody.positions[self.indices] - nbody.positions[self.parents]
+        r_squared = numpy.einsum("ij,ij->i", r, r)
+        kepler_acceleration = -(self.mu / (r_squared * numpy.sqrt(r_squared)))[:, numpy.newaxis] * r
+        perturbation = nbody.gravity_at(nbody.positions, targets=self.indices) - \
+            nbody.gravity_at(nbody.positions, targets=self.parents) - kepler_acceleration
+        ratio = numpy.sqrt(numpy.einsum("ij,ij->i", perturbation, perturbation)) / (self.mu / r_squared)
+        perturbed = ratio > PERTURBATION_LIMIT
+        if perturbed.any():
+            self.release([name for name, bad in zip(self.names, perturbed) if bad], "perturbed")
+
+    def place(self, time, positions, velocities=None):
+        """Moves the pinned rows of the arrays to where their orbits put them. Rows of bodies that
+        aren't pinned are left alone, and pinned bodies are placed relative to wherever their primary is
+        :param time: simulation time, in s
+        :param positions: (n, 2) array of positions to change in place
+        :param velocities: optional (n, 2) array of velocities to change in place too
+        """
+        if not len(self):
+            return
+        if self.propagator is None:
+            self.propagator = kepler.Propagator(self.epoch_positions, self.epoch_velocities, self.mu)
+        r, v = self.propagator.at(time - self.epochs)
+        # primaries before satellites, since a satellite's primary can be on rails too
+        for group, rows, parents in self.groups:
+            positions[rows] = positions[parents] + r[group]
+            if velocities is not None:
+                velocities[rows] = velocities[parents] + v[group]
+
+    def _keep(self, order):
+        """Keeps only the pinned bodies at the given positions in our arrays, in that order"""
+        self.names = [self.names[i] for i in order]
+        self.indices = self.indices[order]
+        self.parents = self.parents[order]
+        self.depths = self.depths[order]
+        self.mu = self.mu[order]
+        self.epoch_positions = self.epoch_positions[order]
+        self.epoch_velocities = self.epoch_velocities[order]
+        self.epochs = self.epochs[order]
+        self.propagator = None
+        boundaries = numpy.flatnonzero(numpy.diff(self.depths)) + 1
+        self.groups = [(group, self.indices[group], self.parents[group])
+                       for group in numpy.split(numpy.arange(len(self)), boundaries)]
@@ -0,0 +1,148 @@
+"""Binary snapshots of a scenario, for scenarios too big to save and load as JSON.
+
+A JSON scenario goes through a dict per entity on the way out and Entity's constructor, asserts and
+all, on the way in, which takes seconds for a hundred thousand asteroids. A snapshot is the columns
+of the EntityStore (see corbit.store) written out as they are. Loading one memory-maps the file and
+uses the columns straight from it as a new store's, copy on write, so only the entity objects
+themselves get made. convert_save.py converts between snapshots and JSON scenario files, and
+load_scenario() loads either.
+
+File format, all little-endian:
+
+    8 bytes   MAGIC
+    4 bytes   uint32 format version, VERSION
+    4 bytes   uint32 length of the JSON header, which is padded with spaces to a multiple of 8 bytes
+    the JSON header
+    the data: each column, then the string table of names, each starting on a multiple of 8 bytes
+
+The header has "count", the number of entities, "settings", the scenario settings (see
+mysqlio.default_settings), "colors", the list of different [r, g, b] colors the entities have,
+"columns", a list of {"name", "dtype" (numpy's dtype string), "shape", "offset"}, and "names",
+{"offset", "length"}. Offsets are in bytes from the start of the data. The columns are the ones in
+EntityStore.columns that aren't cached, plus "habitats", True for the rows that are Habitats, and
+"colors", which color in the header's list each entity is. The string table is the entities'
+names in UTF-8, separated by null characters.
+"""
+import json
+import struct
+
+import numpy
+
+import corbit.mysqlio
+import corbit.store
+from corbit.objects import Entity, Habitat
+
+MAGIC = b"CORBSNP\0"
+VERSION = 1
+_PREFIX = struct.Struct("<8sII")
+ALIGNMENT = 8  # bytes
+
+# the store's columns that get saved, the rest get worked out again after loading
+SAVED = [(name, shape, dtype) for name, shape, dtype in corbit.store.EntityStore.columns
+         if name not in corbit.store.EntityStore.cached]
+
+
+def save(filename, entities, settings=None):
+    """Writes entities to a snapshot file
+    :param entities: list of entities, in the order they'll be loaded in
+    :param settings: optional dict of scenario settings to save along with them
+    """
+    arrays = _columns(entities)
+    arrays.append(("habitats", numpy.array([isinstance(entity, Habitat) for entity in entities], dtype=numpy.bool_)))
+    palette = {}
+    arrays.append(("colors", numpy.fromiter((palette.setdefault(tuple(entity.color), len(palette))
+                                             for entity in entities), dtype=numpy.uint32, count=len(entities))))
+    names = []
+    for entity in entities:
+        assert "\0" not in entity.name, entity.name + " has a null character in it"
+        names.append(entity.name)
+    names = "\0".join(names).encode("utf-8")
+
+    columns = []
+    data = []
+    offset = 0
+    for name, array in arrays:
+        array = numpy.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+        columns.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+        data.append(array)
+        offset += _padded(array.nbytes)
+    header = json.dumps({"count": len(entities), "settings": settings or {},
+                         "colors": [list(color) for color in sorted(palette, key=palette.get)],
+                         "columns": columns, "names": {"offset": offset, "length": len(names)}}).encode("utf-8")
+    header += b" " * (-len(header) % ALIGNMENT)
+
+    with open(filename, "wb") as out:
+        out.write(_PREFIX.pack(MAGIC, VERSION, len(header)))
+        out.write(header)
+        for array in data:
+            out.write(array.data)
+            out.write(b"\0" * (_padded(array.nbytes) - array.nbytes))
+        out.write(names)
+
+
+def load(filename):
+    """Loads a snapshot file. The entities are all in a new EntityStore, whose columns are
+    memory-mapped from the file: changing them doesn't change the file
+    :return: (list of entities, dict of settings) like mysqlio.load_scenario
+    """
+    with open(filename, "rb") as snapshot:
+        magic, version, header_length = _PREFIX.unpack(snapshot.read(_PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(filename + " is not a corbit snapshot")
+        if version != VERSION:
+            raise ValueError(filename + " is snapshot format version " + str(version) +
+                             ", this version of corbit reads " + str(VERSION))
+        header = json.loads(snapshot.read(header_length).decode("utf-8"))
+    settings = corbit.mysqlio.scenario_settings(header["settings"])
+    count = header["count"]
+    if not count:
+        return [], settings
+
+    data = numpy.memmap(filename, dtype=numpy.uint8, mode="c", offset=_PREFIX.size + header_length)
+    columns = {}
+    for column in header["columns"]:
+        dtype = numpy.dtype(column["dtype"])
+        shape = tuple(column["shape"])
+        nbytes = dtype.itemsize * int(numpy.prod(shape))
+        columns[column["name"]] = data[column["offset"]:column["offset"] + nbytes].view(dtype).reshape(shape)
+    names = bytes(data[header["names"]["offset"]:header["names"]["offset"] + header["names"]["length"]])
+    names = names.decode("utf-8").split("\0")
+    palette = [tuple(color) for color in header["colors"]]
+
+    store = corbit.store.EntityStore.from_columns(columns, count)
+    entities = [(Habitat if habitat else Entity).view(store, row, name, palette[color])
+                for row, (name, color, habitat) in enumerate(zip(names, columns["colors"].tolist(),
+                                                                 columns["habitats"].tolist()))]
+    return entities, settings
+
+
+def is_snapshot(filename):
+    """:return: True if the file is a snapshot, rather than e.g. a JSON scenario"""
+    with open(filename, "rb") as candidate:
+        return candidate.read(len(MAGIC)) == MAGIC
+
+
+def load_scenario(filename):
+    """Loads a scenario file, snapshot or JSON
+    :return: (list of entities, dict of settings) like mysqlio.load_scenario
+    """
+    if is_snapshot(filename):
+        return load(filename)
+    with open(filename, "r") as scenario:
+        return corbit.mysqlio.load_scenario(scenario)
+
+
+def _columns(entities):
+    """:return: list of (name, array) of the saved store columns, with a row per entity"""
+    store, rows = corbit.store.rows_of(entities)
+    if store is not None:
+        return [(name, getattr(store, name)[rows]) for name, shape, dtype in SAVED]
+    # spread over more than one store, so one row at a time
+    return [(name, numpy.array([getattr(entity.store, name)[entity.row] for entity in entities],
+                               dtype=dtype).reshape((len(entities),) + shape))
+            for name, shape, dtype in SAVED]
+
+
+def _padded(nbytes):
+    """:return: nbytes rounded up to a multiple of ALIGNMENT"""
+    return nbytes + (-nbytes % ALIGNMENT)
@@ -0,0 +1,170 @@
+"""Entity state kept in columns, one row per entity.
+
+An EntityStore holds the state of every entity in a scenario in preallocated numpy arrays:
+all the positions in one (capacity, 2) array, all the radii in another, and so on. Entity objects
+(see corbit.objects) don't hold any numbers themselves, they're just a store and a row in it, and
+entity.displacement reads and writes the store's positions[row]. So code that works with one
+entity at a time carries on as before, and code that works with all of them at once, like
+NBody.gather and NBody.scatter, copies whole columns with no loop over the entities.
+
+Masses and moments of inertia are cached in columns too, since they're wanted far more often
+than fuel or dry mass change. Changing those marks the row stale, and it's worked out again the
+next time it's wanted (see EntityStore.refresh).
+
+The columns are plain SI numbers, whatever corbit.units says; Entity converts at the edge.
+
+Rows are given back with release(), e.g. when an entity is removed from the scenario (see
+EntityRegistry.remove), and the next entity added takes one of those before a new row.
+
+When a store is full, adding an entity doubles its capacity and copies the columns over to the
+new arrays. Entities only keep their row, so they carry on working, but an array you got out of
+an entity (entity.displacement) before that is a view into the old columns, and won't see any
+changes after it. Get it again instead of holding on to it.
+"""
+import numpy
+
+INITIAL_CAPACITY = 16
+
+
+class EntityStore:
+    """Preallocated columns of entity state. Rows 0 to len(store) - 1 are in use, except the ones in self.free"""
+    # name, shape of one row, dtype of every column
+    columns = (("positions", (2,), numpy.float64),  # m
+               ("velocities", (2,), numpy.float64),  # m/s
+               ("accelerations", (2,), numpy.float64),  # non-gravitational, m/s/s
+               ("angular_positions", (), numpy.float64),  # rad
+               ("angular_speeds", (), numpy.float64),  # rad/s
+               ("angular_accelerations", (), numpy.float64),  # rad/s/s
+               ("dry_masses", (), numpy.float64),  # kg
+               ("radii", (), numpy.float64),  # m
+               ("fuel", (2,), numpy.float64),  # main engine and RCS tanks, in kg. Zero for non-habitats
+               ("test_particles", (), numpy.bool_),
+               # cached from the columns above, see refresh()
+               ("masses", (), numpy.float64),  # dry mass plus fuel, in kg
+               ("moments", (), numpy.float64),  # moments of inertia, in kg m^2
+               ("stale", (), numpy.bool_))  # True when masses and moments need working out again
+    cached = ("masses", "moments", "stale")  # the columns that can always be worked out from the others
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.size = 0
+        self.free = []  # rows below size that were released, and can be taken again
+        self.capacity = max(int(capacity), 1)
+        for name, shape, dtype in self.columns:
+            setattr(self, name, numpy.zeros((self.capacity,) + shape, dtype=dtype))
+        self._scratch = numpy.empty(self.capacity)  # for working things out in place, see rotate()
+
+    @classmethod
+    def from_columns(cls, columns, size):
+        """Makes a store that uses existing arrays as its columns, without copying them, e.g. ones
+        memory-mapped from a file (see corbit.snapshot). It's full, so adding to it copies them
+        :param columns: dict of column name -> array with size rows. Cached columns can be left out
+        :param size: number of rows
+        """
+        store = cls.__new__(cls)
+        store.size = store.capacity = size
+        store.free = []
+        for name, shape, dtype in cls.columns:
+            column = columns.get(name)
+            if column is None or name in cls.cached:
+                column = numpy.zeros((size,) + shape, dtype=dtype)
+            assert column.shape == (size,) + shape, name + " is the wrong shape"
+            setattr(store, name, column)
+        store.stale[:] = True
+        store._scratch = numpy.empty(size)
+        return store
+
+    def __len__(self):
+        return self.size
+
+    def add(self):
+        """Takes a released row if there is one, otherwise the next free row, doubling the capacity
+        first if there isn't one
+        :return: the row, with every column zeroed
+        """
+        if self.free:
+            row = self.free.pop()
+            self.stale[row] = True
+            return row
+        if self.size == self.capacity:
+            self.reserve(max(2 * self.capacity, 1))
+        row = self.size
+        self.size += 1
+        self.stale[row] = True
+        return row
+
+    def release(self, row):
+        """Gives a row back, for add() to hand out again. Its columns are zeroed, so it doesn't push,
+        spin or weigh anything in the meantime, and whatever entity had it mustn't be used any more
+        """
+        assert 0 <= row < self.size and row not in self.free, str(row) + " isn't in use"
+        for name, shape, dtype in self.columns:
+            getattr(self, name)[row] = 0
+        self.free.append(row)
+
+    def reserve(self, capacity):
+        """Makes room for at least capacity rows, so that many can be added without copying the columns"""
+        if capacity <= self.capacity:
+            return
+        for name, shape, dtype in self.columns:
+            column = numpy.zeros((capacity,) + shape, dtype=dtype)
+            column[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, column)
+        self._scratch = numpy.empty(capacity)
+        self.capacity = capacity
+
+    def rotate(self, dt, rows=None):
+        """Entity.rotate for a lot of entities at once, in place
+        :param dt: time step, in s
+        :param rows: int array of the (distinct) rows to rotate, default all of them
+        """
+        if rows is not None and len(rows) < self.size:
+            # only some of them, so the columns can't be done in place
+            self.angular_speeds[rows] += self.angular_accelerations[rows] * dt
+            self.angular_accelerations[rows] = 0
+            self.angular_positions[rows] += self.angular_speeds[rows] * dt
+            return
+        # every row, in which order doesn't matter, since each row only changes itself
+        speeds = self.angular_speeds[:self.size]
+        accelerations = self.angular_accelerations[:self.size]
+        scratch = self._scratch[:self.size]
+        numpy.multiply(accelerations, dt, out=scratch)
+        speeds += scratch
+        accelerations.fill(0)
+        numpy.multiply(speeds, dt, out=scratch)
+        self.angular_positions[:self.size] += scratch
+
+    def refresh(self, row=None):
+        """Works out the masses and moments columns again for the rows that are stale, and marks them
+        as not stale. Anything that changes a row's dry mass, radius or fuel has to mark it stale,
+        which Entity's and EngineSystem's setters do; writing to the columns directly doesn't
+        :param row: just this row, if it's stale. Default every row that's stale
+        """
+        if row is not None:
+            if self.stale[row]:
+                mass = self.dry_masses[row] + (self.fuel[row, 0] + self.fuel[row, 1])
+                self.masses[row] = mass
+                self.moments[row] = (2 * mass * self.radii[row] ** 2) / 5  # a sphere's
+                self.stale[row] = False
+            return
+        rows = numpy.flatnonzero(self.stale[:self.size])
+        if len(rows):
+            masses = self.masses[rows] = self.dry_masses[rows] + (self.fuel[rows, 0] + self.fuel[rows, 1])
+            self.moments[rows] = (2 * masses * self.radii[rows] ** 2) / 5
+            self.stale[rows] = False
+
+
+def rows_of(entities):
+    """Where a list of entities is kept, if it's all in one store
+    :return: (store, (len(entities),) int array of rows), or (None, None) if the entities are
+    spread over more than one store, or there aren't any
+    """
+    if not entities:
+        return None, None
+    store = entities[0].store
+    if any(entity.store is not store for entity in entities):
+        return None, None
+    return store, numpy.fromiter((entity.row for entity in entities), dtype=numpy.intp, count=len(entities))
+
+
+# entities made without saying which store they go in end up here
+default = EntityStore()
@@ -0,0 +1,52 @@
+"""Conversion between unum quantities and the plain numbers used inside the simulation.
+
+The simulation core (corbit.objects, corbit.physics, corbit.gravity) stores everything as plain
+floats and float64 numpy arrays in fixed SI units (m, s, kg, N, rad), because going through unum
+for every += in the tick is far too slow. Units are only attached or checked at the edges of the
+program: loading and saving (mysqlio, json_serialize), the database, and the HUD.
+
+For debugging, set the environment variable CORBIT_STRICT_UNITS=1 before starting anything. Then
+the core keeps every quantity as a unum object like it used to, and any dimensional bug blows up
+with a unum error instead of quietly producing a wrong number. It's a lot slower, so only use it
+for tests.
+"""
+import os
+
+from unum import Unum
+
+STRICT = os.environ.get("CORBIT_STRICT_UNITS", "0") not in ("", "0")
+
+
+def number(quantity, unit):
+    """Strips the unit off a quantity
+    :param quantity: a unum quantity, or a plain number that's already in SI units
+    :param unit: the unit the quantity should be in, e.g. m/s. unum raises an error if it isn't
+    :return: a plain float or numpy array, in that unit
+    """
+    if isinstance(quantity, Unum):
+        return quantity.asNumber(unit)
+    if STRICT:
+        raise TypeError(str(quantity) + " has no units, expected " + str(unit))
+    return quantity
+
+
+def internal(value, unit):
+    """Converts a plain number into however the simulation core stores quantities: as is normally,
+    or as a unum quantity in strict mode
+    :param value: plain float or numpy array, in SI units
+    :param unit: the SI unit of the value, e.g. m/s
+    """
+    if STRICT:
+        return unit * value
+    return value
+
+
+def attach(value, unit):
+    """Puts units on a quantity from the simulation core, for displaying it and the like
+    :param value: a quantity from the core, either plain SI or unum (in strict mode)
+    :param unit: the SI unit of the value
+    :return: a unum quantity
+    """
+    if isinstance(value, Unum):
+        return value.asUnit(unit)
+    return unit * value
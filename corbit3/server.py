@@ -5,31 +5,86 @@ import corbit.network
 import corbit.physics
 import corbit.objects
 import corbit.mysqlio
-import scipy
+import corbit.gravity
+import corbit.integrators
+import corbit.encounters
+import corbit.ephemeris
+import corbit.collision
+import corbit.snapshot
+import corbit.units
 import unum.units as un
 import time
-import itertools
-import math
 import socket
 import threading
 import copy
+import argparse
 
 print("Corbit SERVER " + __version__)
 
-entities = []  # This object stores a list of all entities and children of entities.
+parser = argparse.ArgumentParser(description="Corbit server")
+parser.add_argument("--integrator", choices=sorted(corbit.integrators.integrators),
+                    help="integrator to use, instead of the one in the scenario's settings")
+arguments = parser.parse_args()
+
+registry = corbit.objects.EntityRegistry()  # ids and indexes of the entities, see corbit.objects.EntityRegistry
+entities = registry.entities  # This object stores a list of all entities and children of entities.
+settings = {}  # scenario settings, see corbit.mysqlio.default_settings
+nbody = corbit.gravity.NBody()  # array copy of the entities, for vectorized gravity
+integrator = None  # advances nbody every tick, see corbit.integrators
+scheduler = corbit.collision.Scheduler()  # stops the integrator at collisions
+close_encounters = set()  # (center, satellite) rows of the pairs corbit.encounters solved last tick
 G = 6.6720E-11 * un.N * un.m ** 2 / un.kg ** 2
 ADDRESS = "localhost"
 time_acc_index = 0
 ticks_per_second = 30 * un.Hz # also see: time_per_tick()
 time_acceleration = [1, 5, 10, 50, 100, 1000, 10000, 100000] # used in time_per_tick()
 
-with open("saves/OCESS.json", "r") as loadfile:
-    entities = corbit.mysqlio.load_json(loadfile)
+
+def load(filename):
+    """Loads a scenario file (JSON or a snapshot, see corbit.snapshot), replacing all the current entities and settings"""
+    global entities
+    global settings
+    global nbody
+    global integrator
+    global scheduler
+    global close_encounters
+
+    loaded, settings = corbit.snapshot.load_scenario(filename)  # JSON or snapshot
+    registry.load(loaded)
+    entities = registry.entities
+    if arguments.integrator is not None:
+        settings["integrator"] = arguments.integrator
+    nbody = corbit.gravity.NBody(settings["gravity solver"], settings["opening angle"])
+    # nothing about the last scenario's bodies carries over to this one's
+    scheduler = corbit.collision.Scheduler()
+    close_encounters = set()
+    integrator = corbit.integrators.create(settings["integrator"])
+    print("Integrator:", integrator.name)
+    if settings["close encounters"]:
+        integrator = corbit.encounters.Regularized(integrator)
+    nbody.gather(entities)
+    report = nbody.solver_error()
+    if report is not None:
+        print("Gravity solver:", nbody.solver, "error vs direct summation:", report)
+    if settings["ephemeris"]:
+        nbody.ephemeris = corbit.ephemeris.Ephemeris(settings["ephemeris"])
+        nbody.ephemeris.attach(entities, nbody)
+        print("From the ephemeris:", ", ".join(nbody.ephemeris.names[b] for b in nbody.ephemeris.bodies_used))
+    on_rails = settings["on rails"]
+    if on_rails == "auto":
+        # everything that can't thrust
+        on_rails = [entity.name for entity in entities if entity.id not in registry.habitats]
+    nbody.rails.pin(nbody, entities, on_rails, nbody.time)
+    if len(nbody.rails):
+        print("On rails:", ", ".join(nbody.rails.names))
+
+load("saves/OCESS.json")
 corbit.mysqlio.flush_db(entities, (ADDRESS, "root", "3.1415pi", "corbit"))
 
 
 def time_per_tick():
-    return time_acceleration[time_acc_index] / ticks_per_second
+    """How much simulated time passes each tick, in whatever units the simulation core uses (see corbit.units)"""
+    return corbit.units.internal(time_acceleration[time_acc_index] / ticks_per_second.asNumber(un.Hz), un.s)
 
 
 def accelerate_time(amount):
@@ -48,36 +103,29 @@ def accelerate_time(amount):
 
 
 def act_on_piloting_commands(commands):
-    global entities
-
+    """Carries out the commands from the clients. The target of a command is the id (or name) of an entity"""
     for command in commands:
         function, target, amount = command
         if function == "fire verniers":
-            corbit.objects.oneshot_vernier_thrusters(
-                corbit.objects.find_entity(name, entities), amount, time_per_tick())
+            corbit.objects.oneshot_vernier_thrusters(registry.find(target), float(amount), time_per_tick())
         elif function == "change_engines":
-            corbit.objects.find_entity(name, entities).main_engines.usage += amount
+            # the integrator burns the engines at this throttle from now on, see corbit.burns
+            engines = registry.find(target).engine_system
+            engines.throttle = min(max(engines.throttle + float(amount), 0), 1)
         elif function == "fire_rcs":
-            direction = amount
-            target_entity = corbit.objects.find_entity(target, entities)
-            rcs_thrust = target.rcs.thrust(time_per_tick())
-            theta = direction + target.angular_position
-            rcs_thrust_vector = un.N * scipy.array((math.cos(theta) * rcs_thrust.asNumber(),
-                                                    math.sin(theta) * rcs_thrust.asNumber()))
-            for angle in target.rcs.engine_positions:
-                target.accelerate(rcs_thrust_vector / len(target.rcs.engine_positions), angle)
+            # one tick of RCS thrust, amount is the direction to push in from where the ship's pointing
+            registry.find(target).rcs_system.pulse(float(amount))
         elif function == "accelerate_time":
                 accelerate_time(int(amount))
         elif function == "open":
-                filename = target
-                with open(filename, "r") as loadfile:
-                    entities = corbit.mysqlio.load_json(loadfile)
+                load(target)
 
+substeps_this_second = []  # how many steps an adaptive integrator took each tick, printed once a second
 ticks_to_simulate = 1
 def ticker():
     global ticks_to_simulate
     ticks_to_simulate += 1
-    threading.Timer(time_per_tick().asNumber(un.s), ticker).start()
+    threading.Timer(corbit.units.number(time_per_tick(), un.s), ticker).start()
 
 ticker()
 
@@ -89,28 +137,32 @@ while True:
 
         corbit.mysqlio.push_entities(entities)
 
-        for A, B in itertools.combinations(entities, 2):
-            gravity = corbit.physics.gravitational_force(A, B)
-            theta = corbit.physics.angle(A, B)
-            A.accelerate(gravity, theta)
-            B.accelerate(-gravity, theta)
-
-        collisions = []
-        for A, B in itertools.combinations(entities, 2):
-            affected_objects = corbit.physics.resolve_collision(A, B, time_per_tick())
-            if affected_objects is not None:
-                collisions += affected_objects
-
-        for entity in entities:
-            already_moved = False
-            for name in collisions:
-                if entity.name == name:
-                    already_moved = True
-
-            if not already_moved:
-                entity.move(time_per_tick())
+        nbody.gather(entities)
+        nbody.rails.check(nbody)
+        if nbody.ephemeris is not None:
+            nbody.ephemeris.check(nbody, corbit.units.number(time_per_tick(), un.s))
+
+        # the integrator moves everything, stopping at each collision to resolve it
+        collisions = scheduler.advance(nbody, integrator, corbit.units.number(time_per_tick(), un.s),
+                                       [entity.name for entity in entities])
+        for i, j, impact_time in collisions:
+            print("Collision:", entities[i].name, "and", entities[j].name, "in", impact_time, "s")
+        if settings["close encounters"]:
+            encounters = set(zip(integrator.centers, integrator.satellites))
+            for i, j in sorted(encounters - close_encounters):
+                print("Close encounter:", entities[j].name, "and", entities[i].name)
+            close_encounters = encounters
+        nbody.scatter(entities)
+        if integrator.adaptive:
+            substeps_this_second.append(integrator.substeps)
+            if len(substeps_this_second) >= ticks_per_second.asNumber(un.Hz):
+                print("Integrator substeps per tick: mean", sum(substeps_this_second) / len(substeps_this_second),
+                      "max", max(substeps_this_second))
+                substeps_this_second = []
+
+        corbit.objects.rotate(entities, time_per_tick())
 
         ticks_to_simulate -= 1  # ticks_to_simulate is incremented in the ticker() function every tick
         if ticks_to_simulate <= 0:
-            time.sleep(max(time_per_tick().asNumber(un.s) - (time.time() - start_time),
+            time.sleep(max(corbit.units.number(time_per_tick(), un.s) - (time.time() - start_time),
                            0))